@@ -0,0 +1,297 @@
+"""
+Benchmark ponta a ponta do UnifiedServer, todo em loopback e sem hardware.
+
+Sobe o main.py com uma configuração temporária de N pistas (PDVs 127.0.0.x, um pdv_port
+e um DVR por pista), reproduz cupons para todas as pistas ao mesmo tempo, registra
+visualizadores WebSocket simulados em cada pista e escuta os DVRs em sockets locais.
+
+Relata por pista e no total:
+- latência ingestão -> navegador (p50/p95/p99/máx) medida com um marcador em cada linha
+- linhas perdidas por visualizador e datagramas perdidos/truncados no DVR
+- precisão do alerta de inatividade (com --abandon a última transação fica sem TOTAL)
+- CPU do processo do servidor por pista
+
+Uso:
+    python bench_e2e.py --lanes 16 --viewers 2 --repeat 20 --speed 10
+    python bench_e2e.py --lanes 4 --receipts cupons.txt --abandon --pdv-timeout 5
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+import websockets
+from bench_pdv_parser import SAMPLE_RECEIPT, load_lines
+
+_TIME_RE = re.compile(r'\[(\d{2}):(\d{2}):(\d{2})\]')
+_MARK_RE = re.compile(r'#(\d+):(\d+)')
+
+def line_delays(lines, default_interval):
+    """Intervalo (s) antes de cada linha, a partir do horário [hh:mm:ss] do cupom quando houver"""
+    delays = []
+    previous = None
+    for line in lines:
+        match = _TIME_RE.search(line)
+        if match:
+            hours, minutes, seconds = (int(value) for value in match.groups())
+            current = hours * 3600 + minutes * 60 + seconds
+            delays.append(max(0, current - previous) if previous is not None else 0)
+            previous = current
+        else:
+            delays.append(default_interval)
+    return delays
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def process_cpu_seconds(pid):
+    """CPU (usuário + sistema) de um processo, lida de /proc"""
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+def fetch_metrics(port):
+    """Soma, por nome, as amostras do endpoint /metrics do servidor"""
+    totals = {}
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as response:
+        for line in response.read().decode().splitlines():
+            if not line or line.startswith("#"):
+                continue
+            name_labels, value = line.rsplit(" ", 1)
+            name = name_labels.split("{", 1)[0]
+            totals[name] = totals.get(name, 0) + float(value)
+    return totals
+
+def process_rss_mb(pid):
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+class Lane:
+    def __init__(self, index, base_port):
+        self.index = index
+        self.pdv_ip = f"127.0.0.{10 + index}"
+        self.pdv_port = base_port + index
+        self.dvr_port = base_port + 1000 + index
+        self.origin_port = base_port + 2000 + index
+
+        # { seq: (enviado_em, tamanho) }
+        self.sent = {}
+        self.last_activity = None
+        self.dvr_received = 0
+        self.dvr_short = 0
+        self.latencies = []
+        self.received = []       # por visualizador: conjunto de seqs recebidos
+        self.alerts = []         # horários de chegada dos alertas de timeout
+
+    def config(self):
+        return {
+            "pdv_ip": self.pdv_ip,
+            "pdv_port": self.pdv_port,
+            "dvr_ip": "127.0.0.1",
+            "dvr_port": self.dvr_port,
+            "origin_port": self.origin_port
+        }
+
+class DVRSink(asyncio.DatagramProtocol):
+    def __init__(self, lane):
+        self.lane = lane
+
+    def datagram_received(self, data, addr):
+        self.lane.dvr_received += 1
+        match = _MARK_RE.search(data.decode('utf-8', 'ignore'))
+        if match:
+            sent = self.lane.sent.get(int(match.group(2)))
+            if sent and len(data) < sent[1]:
+                self.lane.dvr_short += 1
+
+async def viewer(lane, viewer_index, ws_port, batch, ready):
+    received = set()
+    lane.received.append(received)
+    async with websockets.connect(f"ws://127.0.0.1:{ws_port}", max_size=None) as ws:
+        await ws.send(json.dumps({"command": "register", "pdv_ip": lane.pdv_ip, "batch": batch}))
+        ready.set()
+        async for message in ws:
+            now = time.time()
+            data = json.loads(message)
+            kind = data.get("type")
+            if kind == "pdv_data":
+                lines = [data["data"]]
+            elif kind in ("pdv_batch", "pdv_history"):
+                lines = data["lines"]
+            elif kind == "pdv_inativo_timeout":
+                if viewer_index == 0:
+                    lane.alerts.append(now)
+                continue
+            else:
+                continue
+            for line in lines:
+                match = _MARK_RE.search(line)
+                if not match:
+                    continue
+                seq = int(match.group(2))
+                sent = lane.sent.get(seq)
+                if sent and seq not in received:
+                    received.add(seq)
+                    lane.latencies.append(now - sent[0])
+
+async def replay(lane, lines, delays, repeat, speed, abandon):
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sender.bind((lane.pdv_ip, 0))
+    seq = 0
+    for receipt in range(repeat):
+        last = receipt == repeat - 1
+        for line, delay in zip(lines, delays):
+            # Na última transação com --abandon, o cupom para antes do TOTAL
+            if abandon and last and "TOTAL" in line:
+                break
+            if speed > 0 and delay:
+                await asyncio.sleep(delay / speed)
+            payload = f"{line} #{lane.index}:{seq}".encode()
+            lane.sent[seq] = (time.time(), len(payload))
+            sender.sendto(payload, ("127.0.0.1", lane.pdv_port))
+            if "Item" in line or "*PDV" in line:
+                lane.last_activity = time.time()
+            seq += 1
+        if speed <= 0:
+            # Devolve o loop aos visualizadores entre cupons
+            await asyncio.sleep(0)
+    sender.close()
+
+async def run(args):
+    lines = load_lines(args.receipts) if args.receipts else list(SAMPLE_RECEIPT)
+    delays = line_delays(lines, args.line_interval)
+    lanes = [Lane(index, args.base_port) for index in range(args.lanes)]
+
+    config_file = tempfile.NamedTemporaryFile("w", suffix=".json", delete=False)
+    json.dump([lane.config() for lane in lanes], config_file)
+    config_file.close()
+
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    command = [sys.executable, os.path.join(app_dir, "main.py"),
+               "--config", config_file.name,
+               "--ws-port", str(args.ws_port),
+               "--rtsp-ws-port", str(args.ws_port + 1),
+               "--pdv-timeout", str(args.pdv_timeout),
+               "--pdv-history-lines", "0",
+               "--metrics-port", str(args.ws_port + 2)] + args.server_args
+    server = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+
+    loop = asyncio.get_running_loop()
+    transports = []
+    viewers = []
+    try:
+        await asyncio.sleep(args.startup)
+
+        for lane in lanes:
+            transport, _ = await loop.create_datagram_endpoint(lambda lane=lane: DVRSink(lane), local_addr=("127.0.0.1", lane.dvr_port))
+            transports.append(transport)
+
+        for lane in lanes:
+            for viewer_index in range(args.viewers):
+                ready = asyncio.Event()
+                viewers.append(asyncio.create_task(viewer(lane, viewer_index, args.ws_port, args.batch, ready)))
+                await ready.wait()
+        await asyncio.sleep(0.5)
+
+        cpu_start = process_cpu_seconds(server.pid)
+        wall_start = time.perf_counter()
+        await asyncio.gather(*(replay(lane, lines, delays, args.repeat, args.speed, args.abandon) for lane in lanes))
+        send_time = time.perf_counter() - wall_start
+
+        # Espera as últimas linhas (e os alertas, com --abandon)
+        await asyncio.sleep(args.pdv_timeout + 2 if args.abandon else 2)
+        cpu_used = process_cpu_seconds(server.pid) - cpu_start
+        wall = time.perf_counter() - wall_start
+        rss = process_rss_mb(server.pid)
+        metrics = fetch_metrics(args.ws_port + 2)
+    finally:
+        for task in viewers:
+            task.cancel()
+        await asyncio.gather(*viewers, return_exceptions=True)
+        for transport in transports:
+            transport.close()
+        server.terminate()
+        output, _ = server.communicate(timeout=10)
+        os.unlink(config_file.name)
+
+    report(lanes, args, send_time, wall, cpu_used, rss, metrics, output)
+
+def report(lanes, args, send_time, wall, cpu_used, rss, metrics, output):
+    total_sent = sum(len(lane.sent) for lane in lanes)
+    latencies = [latency * 1000 for lane in lanes for latency in lane.latencies]
+    print(f"\n{args.lanes} pistas x {args.viewers} visualizadores, {total_sent} linhas enviadas em {send_time:.2f}s "
+          f"({total_sent / send_time:,.0f} linhas/s)")
+
+    print(f"{'pista':<14}{'enviadas':>9}{'perdidas':>10}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'máx ms':>9}"
+          f"{'DVR':>8}{'DVR curtos':>11}{'alerta (s)':>12}")
+    for lane in lanes:
+        sent = len(lane.sent)
+        missing = sum(sent - len(received) for received in lane.received)
+        lane_latencies = [latency * 1000 for latency in lane.latencies]
+        alert = "-"
+        if args.abandon:
+            if lane.alerts and lane.last_activity:
+                # Erro do alerta em relação ao prazo configurado
+                alert = f"{lane.alerts[0] - lane.last_activity - args.pdv_timeout:+.2f}"
+            else:
+                alert = "ausente"
+        print(f"{lane.pdv_ip:<14}{sent:>9}{missing:>10}{percentile(lane_latencies, 0.5):>9.1f}"
+              f"{percentile(lane_latencies, 0.95):>9.1f}{percentile(lane_latencies, 0.99):>9.1f}"
+              f"{max(lane_latencies, default=0):>9.1f}{lane.dvr_received:>8}{lane.dvr_short:>11}{alert:>12}")
+
+    missing_total = sum(len(lane.sent) - len(received) for lane in lanes for received in lane.received)
+    print(f"\nLatência total: p50 {percentile(latencies, 0.5):.1f} ms, p95 {percentile(latencies, 0.95):.1f} ms, "
+          f"p99 {percentile(latencies, 0.99):.1f} ms, máx {max(latencies, default=0):.1f} ms")
+    print(f"Linhas perdidas (soma dos visualizadores): {missing_total}")
+    print(f"DVR: {sum(lane.dvr_received for lane in lanes)}/{total_sent} recebidos, "
+          f"{sum(lane.dvr_short for lane in lanes)} truncados")
+    print(f"Servidor: {metrics.get('pdv_datagrams_received_total', 0):.0f} recebidos, "
+          f"{metrics.get('pdv_datagrams_truncated_total', 0):.0f} truncados na ingestão, "
+          f"{metrics.get('pdv_ingest_batches_dropped_total', 0):.0f} lotes descartados na fila do parsing, "
+          f"{metrics.get('pdv_socket_kernel_drops_total', 0):.0f} descartados pelo kernel, "
+          f"{metrics.get('dvr_datagrams_dropped_total', 0):.0f} descartados no repasse ao DVR, "
+          f"{metrics.get('pdv_ws_dropped_total', 0):.0f} descartados por cliente lento, "
+          f"{metrics.get('pdv_timeout_alerts_total', 0):.0f} alertas")
+    print(f"CPU do servidor: {cpu_used:.2f}s em {wall:.1f}s ({cpu_used / wall * 100:.0f}%), "
+          f"{cpu_used / len(lanes) * 1000:.1f} ms por pista, RSS {rss:.0f} MB")
+
+    if args.verbose:
+        print("\n--- log do servidor ---")
+        print(output[-5000:])
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark ponta a ponta do servidor (loopback)')
+    parser.add_argument('--lanes', type=int, default=8, help='Quantidade de pistas (PDVs) simuladas')
+    parser.add_argument('--viewers', type=int, default=1, help='Visualizadores WebSocket por pista')
+    parser.add_argument('--receipts', type=str, default=None, help='Arquivo com linhas gravadas dos PDVs (uma por linha)')
+    parser.add_argument('--repeat', type=int, default=10, help='Cupons reproduzidos por pista')
+    parser.add_argument('--speed', type=float, default=0, help='Aceleração do tempo real do cupom (0 = sem pausas)')
+    parser.add_argument('--line-interval', type=float, default=0.5, help='Intervalo (s) entre linhas sem horário')
+    parser.add_argument('--abandon', action='store_true', help='Deixa a última transação de cada pista sem TOTAL para medir o alerta')
+    parser.add_argument('--pdv-timeout', type=int, default=5, help='Timeout de inatividade passado ao servidor')
+    parser.add_argument('--batch', action='store_true', help='Visualizadores pedem o modo lote (pdv_batch)')
+    parser.add_argument('--base-port', type=int, default=41000, help='Primeira porta UDP das pistas')
+    parser.add_argument('--ws-port', type=int, default=18765, help='Porta do WebSocket PDV do servidor de teste')
+    parser.add_argument('--startup', type=float, default=2.0, help='Espera (s) pela subida do servidor')
+    parser.add_argument('--verbose', action='store_true', help='Mostra o final do log do servidor')
+    parser.add_argument('server_args', nargs=argparse.REMAINDER, help='Argumentos extras do main.py (depois de --)')
+    args = parser.parse_args()
+    if args.server_args and args.server_args[0] == '--':
+        args.server_args = args.server_args[1:]
+
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""
+Benchmark de vazão (linhas/s) da análise das linhas do PDV.
+
+Compara o caminho antigo (process_message com várias re.sub/re.match seguido das
+verificações de substring e do re.search do PDVTransaction sobre o texto bruto)
+com o tokenizador atual (parse_line, uma classificação por linha).
+
+Sem --receipts é usado um cupom sintético no formato dos PDVs; com --receipts
+o arquivo gravado é lido com uma linha (datagrama) por linha do arquivo. Antes de medir,
+confere que o parser atual dá a cada linha (e às variações de FORMAT_VARIANTS) o mesmo
+texto e a mesma classificação do caminho antigo, e termina com erro se alguma divergir.
+
+Uso:
+    python bench_pdv_parser.py --receipts cupons.txt --repeat 200
+"""
+import argparse
+import re
+import time
+from message_processor import parse_line
+
+SAMPLE_RECEIPT = [
+    "[08:15:02] ************ Abertura de Gaveta ******************",
+    "[08:15:10] ........................................",
+    "[08:15:11] *PDV 03 *Trans: 004512 *Atend: 117 ^",
+    "[08:15:11] ----------------------------------------",
+    "[08:15:14] 7891234567890 Item ARROZ TIPO 1 5KG   1 UN x 24,90   24,90^",
+    "[08:15:17] 7896004000015 Item FEIJAO CARIOCA 1KG  2 UN x 8,49   16,98^",
+    "[08:15:21] 7891000100103 Item LEITE INTEGRAL 1L   6 UN x 4,79   28,74^",
+    "[08:15:24] Produto cancelado: 7891000100103",
+    "[08:15:30] 2000000012340 Item PAO FRANCES KG   0,532 x 14,90   7,93^",
+    "[08:15:33] ========================================",
+    "[08:15:33] TOTAL R$ 78,55",
+    "[08:15:40] Pagamento Cartao Debito R$ 78,55",
+    "[08:15:41] ****************************************",
+    "[08:15:41] Obrigado pela preferencia ^^",
+]
+
+# Outros formatos vistos nos PDVs: marcadores colados ao valor, números longos, quebras de linha
+FORMAT_VARIANTS = [
+    "*PDV:001 *Trans:1234 *Atend:Joao",
+    "[08:15:11]*PDV 03*Trans: 004512*Atend: 117",
+    "*PDV 03 *Trans: 004512",
+    "TOTAL: R$12,50",
+    "TOTAL R$ 10,00",
+    "Pagamento: Dinheiro",
+    "Produto:ARROZ",
+    "Item:FEIJAO 2 x 8,49",
+    "Codigo 78912345678901234",
+    "Codigo 1234567",
+    "[12:00:00]",
+    "[12:00:00] ....",
+    "[12:00:00] **",
+    "[12:00:00] ........................................",
+    "Linha 1\nLinha 2\tcom tabulação",
+    "  espaços   duplicados  ^",
+    "************ Abertura de Gaveta ******************",
+    "*********** Relatorio Gerencial ******************",
+    "Gaveta aberta",
+    "",
+    "   ",
+]
+
+_RECEIPT_START_PATTERN = ("*PDV", "*Trans:", "*Atend:")
+
+def legacy_process_message(raw_message):
+    """Formatação anterior (message_processor.process_message antes do tokenizador)"""
+    cleaned_message = raw_message.strip()
+    cleaned_message = re.sub(r'(\*{3,}|\^{2,}|\.{5,}|\={5,}|\-{5,})', ' ', cleaned_message)
+    cleaned_message = re.sub(r' {2,}', ' ', cleaned_message)
+    cleaned_message = cleaned_message.replace('^', '')
+    if "Abertura de Gaveta" in cleaned_message:
+        return cleaned_message.replace("************", "").replace("******************", "")
+    if "Relatorio Gerencial" in cleaned_message:
+        return cleaned_message.replace("***********", "").replace("******************", "")
+    if re.match(r'^\[[\d:]+\]\s*\.+$', cleaned_message):
+        return ""
+    if re.match(r'^\[[\d:]+\]\s*\*+$', cleaned_message):
+        return ""
+    if "*PDV" in cleaned_message and "*Trans:" in cleaned_message:
+        cleaned_message = cleaned_message.replace("*PDV", "PDV").replace("*Trans:", "Trans:").replace("*Atend:", "Atend:")
+    return cleaned_message
+
+def legacy_monitor(message):
+    """Verificações anteriores do PDVTransaction sobre o texto bruto"""
+    if all(marker in message for marker in _RECEIPT_START_PATTERN):
+        return "header"
+    if "TOTAL" in message and "R$" in message or "Pagamento" in message:
+        return "end"
+    if re.search(r'\d{8,13}', message) or 'Produto' in message or 'Item' in message:
+        return "item"
+    return None
+
+def legacy_path(line):
+    return legacy_process_message(line), legacy_monitor(line)
+
+def current_path(line):
+    event = parse_line(line)
+    return event.text, event.kind
+
+# Tipo de evento atual -> resultado equivalente do monitor antigo
+_LEGACY_KIND = {"header": "header", "total": "end", "payment": "end", "item": "item"}
+
+def check_equivalence(lines):
+    """Retorna as linhas em que texto ou classificação diferem do caminho antigo"""
+    mismatches = []
+    for line in lines:
+        legacy_text, legacy_kind = legacy_path(line)
+        event = parse_line(line)
+        if event.text != legacy_text or _LEGACY_KIND.get(event.kind) != legacy_kind:
+            mismatches.append((line, (legacy_text, legacy_kind), (event.text, event.kind)))
+    return mismatches
+
+def load_lines(path):
+    if not path:
+        return list(SAMPLE_RECEIPT)
+    with open(path, encoding="utf-8", errors="replace") as f:
+        return [line.rstrip("\r\n") for line in f if line.strip()]
+
+def measure(label, parse, lines, repeat):
+    # Aquece o cache de regex do módulo re
+    for line in lines:
+        parse(line)
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for line in lines:
+            parse(line)
+    elapsed = time.perf_counter() - start
+
+    total = len(lines) * repeat
+    rate = total / elapsed
+    print(f"{label:<10} {total} linhas em {elapsed:.3f}s -> {rate:,.0f} linhas/s ({elapsed / total * 1e6:.2f} us/linha)")
+    return rate
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark do parser de linhas do PDV')
+    parser.add_argument('--receipts', type=str, default=None, help='Arquivo com linhas gravadas dos PDVs (uma por linha)')
+    parser.add_argument('--repeat', type=int, default=2000, help='Quantas vezes percorrer as linhas')
+    parser.add_argument('--show', action='store_true', help='Mostra a classificação de cada linha')
+    args = parser.parse_args()
+
+    lines = load_lines(args.receipts)
+    print(f"{len(lines)} linhas de cupom, {args.repeat} repetições")
+
+    if args.show:
+        for line in lines:
+            print(f"  {parse_line(line)!r}")
+
+    mismatches = check_equivalence(lines + FORMAT_VARIANTS)
+    for line, legacy, current in mismatches:
+        print(f"  DIVERGENTE {line!r}: antigo {legacy!r}, atual {current!r}")
+    if mismatches:
+        raise SystemExit(f"{len(mismatches)} linhas classificadas de forma diferente do caminho antigo")
+    print(f"Classificação idêntica ao caminho antigo em {len(lines) + len(FORMAT_VARIANTS)} linhas")
+
+    legacy = measure("antigo", legacy_path, lines, args.repeat)
+    current = measure("atual", current_path, lines, args.repeat)
+    print(f"Ganho: {current / legacy:.2f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Micro-benchmark do caminho quente de vídeo (um frame 1080p por iteração).
+
+Compara o caminho antigo (resize + blur + cvtColor BGR->RGB + VideoFrame rgb24,
+com cada encoder reformatando para yuv420p) com o caminho atual do FrameOutput
+(buffers pré-alocados + conversão única para I420 + VideoFrame yuv420p), tanto no
+modo live (slot único) quanto no modo fila padrão, e informa os buffers I420 alocados
+por cada saída e a memória residente do processo.
+
+Uso:
+    python bench_video_frames.py --frames 300 --preset medium --viewers 4
+"""
+import argparse
+import os
+import time
+import tracemalloc
+import cv2
+import numpy as np
+from av import VideoFrame
+from webrtc_conversion import FrameOutput, QUALITY_PRESETS
+
+def make_source_frame(width=1920, height=1080):
+    """Frame BGR sintético com textura, para o blur e o resize terem trabalho real"""
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    cv2.rectangle(frame, (width // 4, height // 4), (width // 2, height // 2), (0, 200, 0), -1)
+    return frame
+
+def encoder_input(video_frame):
+    """O que o encoder do aiortc faz com cada frame recebido (um por visualizador)"""
+    if video_frame.format.name != "yuv420p":
+        video_frame = video_frame.reformat(format="yuv420p")
+    return video_frame
+
+def legacy_path(frame, params):
+    """Caminho anterior: três alocações de frame inteiro antes do VideoFrame"""
+    width = int(frame.shape[1] / params["downscale_factor"])
+    height = int(frame.shape[0] / params["downscale_factor"])
+    resized = cv2.resize(frame, (width, height), interpolation=cv2.INTER_NEAREST)
+    if params["quality_reduce"] > 70:
+        resized = cv2.GaussianBlur(resized, (3, 3), 0)
+    frame_rgb = cv2.cvtColor(resized, cv2.COLOR_BGR2RGB)
+    return VideoFrame.from_ndarray(frame_rgb, format="rgb24")
+
+def current_path(frame, frame_output):
+    """Caminho atual: buffers reutilizados e entrega em I420 (devolvido após a cópia, como no VideoStreamTrack)"""
+    frame_output.push(frame, 0, 0.0)
+    yuv, _, _ = frame_output.poll()
+    video_frame = VideoFrame.from_ndarray(yuv, format="yuv420p")
+    frame_output.release(yuv)
+    return video_frame
+
+def resident_mb():
+    """Memória residente atual do processo (MB), de /proc/self/statm"""
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+def report_buffers(label, frame_output):
+    shape = frame_output._yuv_shape
+    size_mb = frame_output.yuv_buffers_allocated * shape[0] * shape[1] / (1024 * 1024) if shape else 0
+    print(f"{label:<8} buffers I420 alocados {frame_output.yuv_buffers_allocated} ({size_mb:.1f} MB), "
+          f"memória residente {resident_mb():.0f} MB")
+
+def measure(label, produce, frames, viewers):
+    # Aquece caches e buffers pré-alocados
+    for _ in range(5):
+        for _ in range(viewers):
+            encoder_input(produce())
+
+    tracemalloc.start()
+    baseline, _ = tracemalloc.get_traced_memory()
+    peak_total = 0
+
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    for _ in range(frames):
+        tracemalloc.reset_peak()
+        video_frame = produce()
+        for _ in range(viewers):
+            encoder_input(video_frame)
+        _, peak = tracemalloc.get_traced_memory()
+        peak_total += peak - baseline
+    cpu = time.process_time() - cpu_start
+    wall = time.perf_counter() - wall_start
+    tracemalloc.stop()
+
+    print(f"{label:<8} CPU {cpu / frames * 1000:7.3f} ms/frame | "
+          f"tempo {wall / frames * 1000:7.3f} ms/frame | "
+          f"pico alocado (numpy) {peak_total / frames / 1024:9.1f} KiB/frame")
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmark do caminho quente de vídeo')
+    parser.add_argument('--frames', type=int, default=300, help='Quantidade de frames medidos')
+    parser.add_argument('--preset', type=str, default='medium', choices=sorted(QUALITY_PRESETS), help='Preset de qualidade')
+    parser.add_argument('--viewers', type=int, default=1, help='Visualizadores (encoders) por preset')
+    parser.add_argument('--width', type=int, default=1920, help='Largura do frame de entrada')
+    parser.add_argument('--height', type=int, default=1080, help='Altura do frame de entrada')
+    args = parser.parse_args()
+
+    cv2.setNumThreads(1)
+    params = QUALITY_PRESETS[args.preset]
+    frame = make_source_frame(args.width, args.height)
+    live_output = FrameOutput(args.preset, live=True, **params)
+    queue_output = FrameOutput(args.preset, **params)
+
+    print(f"Entrada {args.width}x{args.height}, preset '{args.preset}', {args.viewers} visualizador(es), {args.frames} frames")
+    print("(alocações do PyAV/libav não passam pelo tracemalloc e não entram no pico)")
+    measure("antes", lambda: legacy_path(frame, params), args.frames, args.viewers)
+    measure("live", lambda: current_path(frame, live_output), args.frames, args.viewers)
+    report_buffers("live", live_output)
+    measure("fila", lambda: current_path(frame, queue_output), args.frames, args.viewers)
+    report_buffers("fila", queue_output)
+
+if __name__ == "__main__":
+    main()
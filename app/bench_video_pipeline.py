@@ -0,0 +1,296 @@
+"""
+Benchmark do pipeline de vídeo sem câmera: RTSPConnection -> FrameGrabber -> FrameOutput ->
+VideoStreamTrack -> MediaRelay -> K consumidores com encoder próprio (como cada RTCPeerConnection).
+
+A fonte é sintética (frame com textura e um retângulo em movimento) ou um arquivo de vídeo
+em loop, entregue no ritmo de --fps pela própria RTSPConnection, com o mesmo grab/retrieve,
+detecção de travamento e estados de uma câmera real.
+
+Relata por preset o tempo médio de cada etapa (decodificação, redimensionamento, conversão
+para I420, encode), frames descartados em cada ponto, idade dos frames e RSS do processo.
+
+Uso:
+    python bench_video_pipeline.py --presets low,medium --consumers 4 --duration 10
+    python bench_video_pipeline.py --source gravacao.mp4 --fps 15 --live
+    python bench_video_pipeline.py --static --motion-gating
+"""
+import argparse
+import asyncio
+import time
+import cv2
+import numpy as np
+from aiortc.contrib.media import MediaRelay
+from aiortc.mediastreams import MediaStreamError
+from rtsp_connection import RTSPConnection
+from webrtc_conversion import FrameOutput, FrameGrabber, VideoStreamTrack, QUALITY_PRESETS
+
+def process_rss_mb():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+class StageTimer:
+    """Acumula o tempo (s) e a quantidade de execuções de uma etapa"""
+    def __init__(self):
+        self.total = 0.0
+        self.count = 0
+
+    def add(self, elapsed):
+        self.total += elapsed
+        self.count += 1
+
+    def mean_ms(self):
+        return self.total / self.count * 1000 if self.count else 0.0
+
+class SyntheticCapture:
+    """
+    Substituto do cv2.VideoCapture: entrega frames no ritmo de fps, sintéticos ou de um
+    arquivo em loop, medindo o tempo de "decodificação" (sem contar a espera pelo próximo frame)
+    """
+    def __init__(self, source, width, height, fps, decode_timer, static=False):
+        self.fps = fps
+        self.static = static
+        self.decode_timer = decode_timer
+        self.next_frame_time = None
+        self.frame_index = 0
+        self.opened = True
+        self.frames_grabbed = 0
+
+        self.file = None
+        if source:
+            self.file = cv2.VideoCapture(source)
+            if not self.file.isOpened():
+                raise Exception(f"Não foi possível abrir o arquivo de vídeo: {source}")
+        else:
+            rng = np.random.default_rng(0)
+            self.base = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+            self.frame = np.empty_like(self.base)
+
+    def isOpened(self):
+        return self.opened
+
+    def grab(self):
+        # Ritmo da câmera
+        now = time.monotonic()
+        if self.next_frame_time is None:
+            self.next_frame_time = now
+        elif self.next_frame_time > now:
+            time.sleep(self.next_frame_time - now)
+        self.next_frame_time += 1 / self.fps
+
+        start = time.perf_counter()
+        if self.file:
+            if not self.file.grab():
+                # Fim do arquivo: volta ao início
+                self.file.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                self.file.grab()
+        self.decode_timer.add(time.perf_counter() - start)
+
+        self.frame_index += 1
+        self.frames_grabbed += 1
+        return True
+
+    def retrieve(self):
+        start = time.perf_counter()
+        if self.file:
+            ret, frame = self.file.retrieve()
+        else:
+            # Textura fixa com um retângulo que se move, para o encoder ter movimento real
+            # (parado com --static, como uma pista sem cliente)
+            np.copyto(self.frame, self.base)
+            height, width = self.frame.shape[:2]
+            x = 0 if self.static else (self.frame_index * 8) % (width - width // 4)
+            cv2.rectangle(self.frame, (x, height // 3), (x + width // 4, height // 3 + height // 4), (240, 240, 240), -1)
+            ret, frame = True, self.frame
+        self.decode_timer.add(time.perf_counter() - start)
+        return ret, frame
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_POS_MSEC:
+            return self.frame_index * 1000 / self.fps
+        return 0
+
+    def release(self):
+        self.opened = False
+        if self.file:
+            self.file.release()
+
+class SyntheticRTSPConnection(RTSPConnection):
+    """RTSPConnection cuja captura é a SyntheticCapture (o resto do comportamento é o real)"""
+    def __init__(self, source, width, height, fps, decode_timer, static=False):
+        super().__init__(source or f"synthetic://{width}x{height}@{fps}")
+        self.capture_args = (source, width, height, fps, decode_timer, static)
+        self.capture = None
+
+    def _open_capture(self):
+        self.capture = SyntheticCapture(*self.capture_args)
+        return self.capture
+
+class TimedFrameOutput(FrameOutput):
+    """FrameOutput que mede redimensionamento e conversão e guarda o horário de captura de cada pts"""
+    def __init__(self, quality_preset, **kwargs):
+        super().__init__(quality_preset, **kwargs)
+        self.resize_timer = StageTimer()
+        self.convert_timer = StageTimer()
+        self.published = 0
+        self.delivered = 0
+        self.capture_times = {}
+
+    def _publish(self, frame, timestamp, capture_time):
+        start = time.perf_counter()
+        resize_before = self.resize_timer.total
+        if not super()._publish(frame, timestamp, capture_time):
+            return False
+        # Conversão = publicação inteira menos o redimensionamento medido dentro dela
+        self.convert_timer.add(time.perf_counter() - start - (self.resize_timer.total - resize_before))
+        self.capture_times[timestamp] = capture_time
+        if len(self.capture_times) > 300:
+            del self.capture_times[next(iter(self.capture_times))]
+        self.published += 1
+        return True
+
+    def _downscale_frame(self, frame):
+        start = time.perf_counter()
+        resized = super()._downscale_frame(frame)
+        self.resize_timer.add(time.perf_counter() - start)
+        return resized
+
+    async def get(self):
+        item = await super().get()
+        if item is not None:
+            self.delivered += 1
+        return item
+
+def create_encoder(codec):
+    if codec == "vp8":
+        from aiortc.codecs.vpx import Vp8Encoder
+        return Vp8Encoder()
+    if codec == "h264":
+        from aiortc.codecs.h264 import H264Encoder
+        return H264Encoder()
+    return None
+
+class Consumer:
+    """Visualizador simulado: recebe do relay e codifica cada frame, como o RTCRtpSender faz"""
+    def __init__(self, relay_track, frame_output, codec):
+        self.relay_track = relay_track
+        self.frame_output = frame_output
+        self.encoder = create_encoder(codec)
+        self.encode_timer = StageTimer()
+        self.received = 0
+        self.ages = []
+
+    async def run(self):
+        while True:
+            try:
+                frame = await self.relay_track.recv()
+            except MediaStreamError:
+                break
+            self.received += 1
+            # O encoder reescala o pts do frame: guarda antes
+            capture_time = self.frame_output.capture_times.get(frame.pts)
+            if self.encoder:
+                start = time.perf_counter()
+                self.encoder.encode(frame)
+                self.encode_timer.add(time.perf_counter() - start)
+            if capture_time:
+                self.ages.append((time.time() - capture_time) * 1000)
+            # Cede o loop como faria o envio RTP
+            await asyncio.sleep(0)
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+async def run(args):
+    presets = [preset.strip() for preset in args.presets.split(",")]
+    for preset in presets:
+        if preset not in QUALITY_PRESETS:
+            raise SystemExit(f"Preset desconhecido: {preset} (disponíveis: {', '.join(QUALITY_PRESETS)})")
+
+    rss_start = process_rss_mb()
+    decode_timer = StageTimer()
+    connection = SyntheticRTSPConnection(args.source, args.width, args.height, args.fps, decode_timer, args.static)
+    connection.connect()
+    grabber = FrameGrabber(connection)
+
+    relay = MediaRelay()
+    outputs = {}
+    tracks = []
+    consumers = {}
+    for preset in presets:
+        output = TimedFrameOutput(preset, live=args.live, motion_gating=args.motion_gating, **QUALITY_PRESETS[preset])
+        track = VideoStreamTrack(output, label=f"bench ({preset})")
+        grabber.add_output(output)
+        outputs[preset] = output
+        tracks.append(track)
+        consumers[preset] = [Consumer(relay.subscribe(track, buffered=False), output, args.codec)
+                             for _ in range(args.consumers)]
+
+    tasks = [asyncio.create_task(consumer.run()) for group in consumers.values() for consumer in group]
+    grabber.start()
+    cpu_start = time.process_time()
+    await asyncio.sleep(args.duration)
+    cpu_used = time.process_time() - cpu_start
+    rss = process_rss_mb()
+
+    grabber.stop()
+    for track in tracks:
+        track.stop()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    connection.close()
+
+    grabbed = connection.capture.frames_grabbed
+    print(f"\nFonte: {connection.rtsp_url}, {grabbed} frames em {args.duration:.0f}s "
+          f"({grabbed / args.duration:.1f} fps), decodificação {decode_timer.mean_ms():.2f} ms/frame")
+    print(f"Modo {'live' if args.live else 'fila'}, {args.consumers} consumidores por preset, encoder {args.codec}")
+    print(f"{'preset':<12}{'publicados':>11}{'desc. fila':>11}{'desc. relay':>12}{'resize ms':>10}{'I420 ms':>9}"
+          f"{'encode ms':>10}{'idade p50':>10}{'idade p95':>10}{'idade máx':>10}")
+    for preset in presets:
+        output = outputs[preset]
+        group = consumers[preset]
+        received = sum(consumer.received for consumer in group)
+        encode = StageTimer()
+        ages = []
+        for consumer in group:
+            encode.total += consumer.encode_timer.total
+            encode.count += consumer.encode_timer.count
+            ages.extend(consumer.ages)
+        # Descartes: na saída (fila/slot sobrescrito) e no relay (consumidor lento, buffered=False)
+        output_drops = output.published - output.delivered
+        relay_drops = output.delivered * len(group) - received
+        print(f"{preset:<12}{output.published:>11}{output_drops:>11}{relay_drops:>12}"
+              f"{output.resize_timer.mean_ms():>10.2f}{output.convert_timer.mean_ms():>9.2f}{encode.mean_ms():>10.2f}"
+              f"{percentile(ages, 0.5):>10.0f}{percentile(ages, 0.95):>10.0f}{max(ages, default=0):>10.0f}")
+    print(f"\nFrames não usados por nenhum preset: {grabber.frames_skipped}")
+    if args.motion_gating:
+        gated = ', '.join(f"{preset}={outputs[preset].motion_gate.frames_gated}" for preset in presets)
+        print(f"Frames descartados com a cena parada: {gated}")
+    print(f"CPU do processo: {cpu_used:.2f}s em {args.duration:.0f}s ({cpu_used / args.duration * 100:.0f}%), "
+          f"RSS {rss:.0f} MB (+{rss - rss_start:.0f} MB)")
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark do pipeline de vídeo com fonte sintética')
+    parser.add_argument('--source', type=str, default=None, help='Arquivo de vídeo (em loop); sintético se omitido')
+    parser.add_argument('--width', type=int, default=1920, help='Largura da fonte sintética')
+    parser.add_argument('--height', type=int, default=1080, help='Altura da fonte sintética')
+    parser.add_argument('--fps', type=float, default=25, help='Frames por segundo da fonte')
+    parser.add_argument('--presets', type=str, default='medium-low', help='Presets separados por vírgula')
+    parser.add_argument('--consumers', type=int, default=2, help='Consumidores (visualizadores) por preset')
+    parser.add_argument('--codec', type=str, default='vp8', choices=['vp8', 'h264', 'none'], help='Encoder de cada consumidor')
+    parser.add_argument('--live', action='store_true', help='Saídas em modo live (slot único), como --live-video')
+    parser.add_argument('--motion-gating', action='store_true', help='Taxa adaptativa por movimento nas saídas, como --motion-gating')
+    parser.add_argument('--static', action='store_true', help='Fonte sintética sem movimento (pista ociosa)')
+    parser.add_argument('--duration', type=float, default=10, help='Duração da medição (s)')
+    args = parser.parse_args()
+
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
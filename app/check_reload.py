@@ -0,0 +1,88 @@
+"""
+Verificação da recarga da configuração (SIGHUP) com câmeras, sem hardware.
+
+Sobe o UnifiedServer no próprio processo com duas pistas, buffer pré-evento e câmeras quentes
+(URLs RTSP sem servidor: os FrameGrabbers ficam reconectando, o que basta para a verificação)
+e recarrega uma configuração com uma pista nova, uma removida e uma câmera trocada. Confere:
+- sockets dos PDVs: a porta da pista removida é liberada e a da nova é vinculada
+- ClipRecorder: buffers só das câmeras da configuração nova
+- pipelines: as câmeras que saíram da configuração são fechadas
+
+Uso:
+    python check_reload.py
+"""
+import asyncio
+import json
+import os
+import socket
+import sys
+import tempfile
+from main import UnifiedServer
+import webrtc_conversion
+
+LANE_1 = {"pdv_ip": "127.0.0.1", "pdv_port": 38851, "dvr_ip": "127.0.0.1", "dvr_port": 39951,
+          "origin_port": 40051, "rtsp_url": "rtsp://127.0.0.1:9/cam1"}
+LANE_2 = {"pdv_ip": "127.0.0.2", "pdv_port": 38852, "dvr_ip": "127.0.0.1", "dvr_port": 39952,
+          "origin_port": 40052, "rtsp_url": "rtsp://127.0.0.1:9/cam2"}
+LANE_3 = {"pdv_ip": "127.0.0.3", "pdv_port": 38853, "dvr_ip": "127.0.0.1", "dvr_port": 39953,
+          "origin_port": 40053, "rtsp_url": "rtsp://127.0.0.1:9/cam3"}
+
+def port_bound(port):
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        probe.bind(('0.0.0.0', port))
+        return False
+    except OSError:
+        return True
+    finally:
+        probe.close()
+
+async def run_check(config_path, clip_dir):
+    with open(config_path, 'w') as file:
+        json.dump([LANE_1, LANE_2], file)
+
+    server = UnifiedServer(ws_port=18865, rtsp_ws_port=18180, config_path=config_path,
+                           warm_cameras=True, clip_dir=clip_dir)
+    server_task = asyncio.create_task(server.start())
+    await asyncio.sleep(1.0)
+
+    # Pista 3 nova, pista 2 removida e câmera da pista 1 trocada
+    changed_lane = dict(LANE_1, rtsp_url="rtsp://127.0.0.1:9/cam1b")
+    with open(config_path, 'w') as file:
+        json.dump([changed_lane, LANE_3], file)
+    reloaded = await server.reload_config()
+    # As câmeras novas entram no ClipRecorder em segundo plano
+    await asyncio.sleep(0.5)
+
+    expected_cameras = {changed_lane['rtsp_url'], LANE_3['rtsp_url']}
+    checks = [
+        ("recarga aplicada", reloaded),
+        ("porta da pista removida liberada", not port_bound(LANE_2['pdv_port'])),
+        ("porta da pista nova vinculada", port_bound(LANE_3['pdv_port'])),
+        ("buffers pré-evento", server.clip_recorder.cameras == expected_cameras),
+        ("rings pré-evento", set(server.clip_recorder.rings) == expected_cameras),
+        ("pipelines abertos", set(webrtc_conversion.VideoPipeline._instances) == expected_cameras),
+    ]
+
+    server_task.cancel()
+    try:
+        await server_task
+    except asyncio.CancelledError:
+        pass
+    server.shutdown()
+    for pipeline in list(webrtc_conversion.VideoPipeline._instances.values()):
+        pipeline._shutdown()
+    return checks
+
+def main():
+    with tempfile.TemporaryDirectory() as work_dir:
+        checks = asyncio.run(run_check(os.path.join(work_dir, "config.json"), os.path.join(work_dir, "clips")))
+
+    print()
+    for name, ok in checks:
+        print(f"{'OK   ' if ok else 'FALHA'} {name}")
+    if not all(ok for _, ok in checks):
+        sys.exit("Recarga da configuração não aplicou as mudanças de câmeras")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+import asyncio
+import json
+import time
+from collections import deque
+from websockets.exceptions import ConnectionClosed
+from metrics import REGISTRY
+
+# Políticas para quando a fila de saída de um cliente lento enche
+POLICY_DROP_OLDEST = "drop_oldest"
+POLICY_COALESCE = "coalesce"
+POLICY_DISCONNECT = "disconnect"
+SLOW_CLIENT_POLICIES = (POLICY_DROP_OLDEST, POLICY_COALESCE, POLICY_DISCONNECT)
+
+# Tamanho padrão da fila de saída de cada cliente (mensagens)
+DEFAULT_CLIENT_QUEUE_SIZE = 256
+
+# Tempo entre o enfileiramento e o envio efetivo de cada mensagem (fila + escrita no socket)
+SEND_LATENCY = REGISTRY.histogram("pdv_ws_send_latency_seconds", "Atraso do fan-out: enfileiramento até o envio ao cliente WebSocket")
+
+class ClientSender:
+    """
+    Fila de saída limitada e tarefa escritora de um cliente WebSocket do PDV.
+
+    O fan-out apenas enfileira (sem await), então um navegador lento atrasa só
+    a própria fila. Quando ela enche, aplica a política configurada:
+    - drop_oldest: descarta a mensagem mais antiga
+    - coalesce: junta as linhas pdv_data pendentes de cada PDV em uma única mensagem
+    - disconnect: fecha a conexão do cliente
+    """
+    def __init__(self, websocket, max_queue=DEFAULT_CLIENT_QUEUE_SIZE, policy=POLICY_DROP_OLDEST):
+        self.websocket = websocket
+        self.max_queue = max_queue
+        self.policy = policy
+
+        # Cliente negociou no register o recebimento de pdv_data em lotes (pdv_batch)
+        self.batch = False
+
+        # Entradas: (mensagem_json, pdv_ip, linha, enfileirada_em) — pdv_ip/linha só para pdv_data, usados no coalesce
+        self.queue = deque()
+        self._ready = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        self.closed = False
+
+        # Métricas
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.max_depth = 0
+
+    def enqueue(self, message, pdv_ip=None, line=None):
+        """Enfileira uma mensagem JSON; retorna False se o cliente foi (ou está sendo) desconectado"""
+        if self.closed:
+            return False
+
+        if len(self.queue) >= self.max_queue:
+            if self.policy == POLICY_DISCONNECT:
+                print(f"Cliente WebSocket lento desconectado (fila com {len(self.queue)} mensagens)")
+                self.close(disconnect=True)
+                return False
+            elif self.policy == POLICY_COALESCE:
+                self._coalesce()
+
+            # drop_oldest, ou coalesce que não conseguiu liberar espaço
+            if len(self.queue) >= self.max_queue:
+                self.queue.popleft()
+                self.dropped += 1
+
+        self.queue.append((message, pdv_ip, line, time.monotonic()))
+        if len(self.queue) > self.max_depth:
+            self.max_depth = len(self.queue)
+        self._ready.set()
+        return True
+
+    def _coalesce(self):
+        """Junta as linhas pdv_data pendentes de cada PDV em uma mensagem, preservando a ordem"""
+        merged = deque()
+        for message, pdv_ip, line, enqueued_at in self.queue:
+            if pdv_ip is not None and merged and merged[-1][1] == pdv_ip:
+                # Mantém o horário da mensagem mais antiga do grupo
+                _, _, previous, first_enqueued_at = merged.pop()
+                combined = f"{previous}\n{line}"
+                merged.append((None, pdv_ip, combined, first_enqueued_at))
+                self.coalesced += 1
+            else:
+                merged.append((message, pdv_ip, line, enqueued_at))
+
+        # Regenera apenas o JSON das entradas combinadas
+        self.queue = deque(
+            (message if message is not None else json.dumps({"type": "pdv_data", "pdv_ip": pdv_ip, "data": line}), pdv_ip, line, enqueued_at)
+            for message, pdv_ip, line, enqueued_at in merged
+        )
+
+    async def _run(self):
+        """Tarefa escritora: envia a fila em ordem, um await por vez"""
+        try:
+            while True:
+                if not self.queue:
+                    self._ready.clear()
+                    await self._ready.wait()
+                    continue
+
+                message, _, _, enqueued_at = self.queue.popleft()
+                await self.websocket.send(message)
+                self.sent += 1
+                SEND_LATENCY.observe(time.monotonic() - enqueued_at)
+        except ConnectionClosed:
+            pass
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f"Erro ao enviar mensagem ao cliente WebSocket: {e}")
+        finally:
+            self.closed = True
+
+    def close(self, disconnect=False):
+        self.closed = True
+        self.queue.clear()
+        if not self._task.done():
+            self._task.cancel()
+        if disconnect:
+            # 1013: "try again later"
+            asyncio.ensure_future(self.websocket.close(code=1013, reason="cliente lento"))
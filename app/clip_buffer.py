@@ -0,0 +1,227 @@
+"""
+Buffer de vídeo pré-evento: cada câmera com PDV no config.json guarda em memória os últimos
+segundos em JPEG, e um alerta de inatividade grava esse trecho em um arquivo de clipe.
+
+A captura é uma saída a mais no FrameGrabber da câmera (a decodificação é compartilhada com
+os visualizadores), com FPS e largura próprios. A gravação do arquivo roda fora do loop de
+eventos e da thread de captura: o vídeo ao vivo não espera pelo disco.
+"""
+import asyncio
+import collections
+import fractions
+import os
+import threading
+import time
+import av
+import cv2
+from webrtc_conversion import FrameOutput, VideoPipeline
+from clip_settings import (DEFAULT_CLIP_SECONDS, DEFAULT_CLIP_FPS, DEFAULT_CLIP_WIDTH,
+                           DEFAULT_CLIP_JPEG_QUALITY, DEFAULT_CLIP_MEMORY_MB)
+
+class ClipRing:
+    """
+    Frames JPEG recentes de uma câmera, do mais antigo ao mais recente. Descarta os frames mais
+    velhos que max_seconds e, se o limite de bytes estourar, os mais antigos até caber
+    """
+    def __init__(self, max_seconds, max_bytes):
+        self.max_seconds = max_seconds
+        self.max_bytes = max_bytes
+        self.frames = collections.deque()  # (capture_time, jpeg)
+        self.bytes = 0
+        self.evicted = 0
+        self._lock = threading.Lock()
+
+    def append(self, capture_time, jpeg):
+        with self._lock:
+            self.frames.append((capture_time, jpeg))
+            self.bytes += jpeg.nbytes
+
+            oldest = capture_time - self.max_seconds
+            while self.frames and (self.frames[0][0] < oldest or self.bytes > self.max_bytes):
+                _, dropped = self.frames.popleft()
+                self.bytes -= dropped.nbytes
+                self.evicted += 1
+
+    def snapshot(self):
+        """Cópia da lista de frames (os JPEGs são compartilhados, não copiados)"""
+        with self._lock:
+            return list(self.frames)
+
+class ClipOutput(FrameOutput):
+    """Saída do FrameGrabber que comprime os frames em JPEG no ClipRing (ninguém consome a fila)"""
+    def __init__(self, ring, fps=DEFAULT_CLIP_FPS, width=DEFAULT_CLIP_WIDTH, jpeg_quality=DEFAULT_CLIP_JPEG_QUALITY):
+        super().__init__("clip", max_queue_size=1, quality_reduce=0, target_fps=fps)
+        self.ring = ring
+        self.width = width
+        self.encode_params = [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality]
+
+    def output_size(self, frame_shape):
+        """Largura fixa (sem ampliar), mantendo a proporção da câmera"""
+        source_height, source_width = frame_shape[:2]
+        width = min(self.width, source_width)
+        height = int(source_height * width / source_width)
+        return width & ~1, height & ~1
+
+    def _publish(self, frame, timestamp, capture_time):
+        resized = self._downscale_frame(frame)
+        ok, jpeg = cv2.imencode('.jpg', resized, self.encode_params)
+        if ok:
+            self.ring.append(capture_time, jpeg)
+        return False
+
+def write_clip(path, frames):
+    """Grava os frames JPEG em um Matroska MJPEG, sem recomprimir (bloqueante); retorna (duração, frames)"""
+    height, width = cv2.imdecode(frames[0][1], cv2.IMREAD_UNCHANGED).shape[:2]
+    first_time = frames[0][0]
+
+    container = av.open(path, "w")
+    try:
+        stream = container.add_stream("mjpeg")
+        stream.width = width
+        stream.height = height
+        stream.pix_fmt = "yuvj420p"
+        stream.time_base = fractions.Fraction(1, 1000)
+        last_pts = -1
+        for capture_time, jpeg in frames:
+            # pts em ms pelo horário de captura (FPS variável, como o buffer foi preenchido)
+            pts = max(int((capture_time - first_time) * 1000), last_pts + 1)
+            last_pts = pts
+            packet = av.Packet(jpeg.tobytes())
+            packet.pts = packet.dts = pts
+            packet.time_base = stream.time_base
+            packet.stream = stream
+            packet.is_keyframe = True
+            container.mux(packet)
+    finally:
+        container.close()
+    return frames[-1][0] - first_time, len(frames)
+
+def export_ring(ring, path):
+    """Grava o conteúdo atual do ring (bloqueante); retorna (duração, frames)"""
+    frames = ring.snapshot()
+    if not frames:
+        raise Exception("buffer pré-evento vazio")
+    return write_clip(path, frames)
+
+class ClipRecorder:
+    """
+    Buffers pré-evento das câmeras e exportação dos clipes. Com o DecoderPool, os buffers
+    ficam no processo decodificador da câmera, que também grava o arquivo
+    """
+    def __init__(self, clip_dir, seconds=DEFAULT_CLIP_SECONDS, fps=DEFAULT_CLIP_FPS, width=DEFAULT_CLIP_WIDTH,
+                 jpeg_quality=DEFAULT_CLIP_JPEG_QUALITY, max_bytes=DEFAULT_CLIP_MEMORY_MB * 1024 * 1024):
+        self.clip_dir = clip_dir
+        self.seconds = seconds
+        self.fps = fps
+        self.width = width
+        self.jpeg_quality = jpeg_quality
+        self.max_bytes = max_bytes
+
+        # Câmeras com buffer e, sem DecoderPool, seus rings { rtsp_url: ClipRing } e saídas { rtsp_url: ClipOutput }
+        self.cameras = set()
+        self.rings = {}
+        self.outputs = {}
+
+        # Câmeras esperando a abertura (no DecoderPool, repetida até a câmera responder)
+        self._adding = set()
+        self.decoder_pool = None
+
+        # Exportações em andamento por câmera: um segundo alerta não grava o mesmo trecho de novo
+        self._exporting = set()
+        self.clips_written = 0
+
+    async def start(self, rtsp_urls):
+        """
+        Abre as câmeras ao mesmo tempo e começa a preencher os buffers, dividindo o limite de
+        memória entre elas (uma câmera fora do ar não atrasa as outras)
+        """
+        self.decoder_pool = VideoPipeline.decoder_pool
+        if not rtsp_urls:
+            return
+        ring_bytes = self.max_bytes // len(rtsp_urls)
+        print(f"Buffer pré-evento: {len(rtsp_urls)} câmeras, {self.seconds}s a {self.fps} fps, "
+              f"até {ring_bytes / (1024 * 1024):.0f} MB por câmera")
+        await asyncio.gather(*(self.add_camera(rtsp_url, ring_bytes) for rtsp_url in rtsp_urls))
+
+    async def update_cameras(self, rtsp_urls):
+        """
+        Recarga da configuração: encerra os buffers das câmeras que saíram, redivide o limite de
+        memória e abre em segundo plano os das câmeras novas (os buffers das que ficaram não
+        perdem o conteúdo)
+        """
+        rtsp_urls = set(rtsp_urls)
+        for rtsp_url in sorted(self.cameras - rtsp_urls):
+            await self.remove_camera(rtsp_url)
+        if not rtsp_urls:
+            return
+
+        ring_bytes = self.max_bytes // len(rtsp_urls)
+        for rtsp_url in self.cameras:
+            if self.decoder_pool:
+                self.decoder_pool.set_clip_limit(rtsp_url, ring_bytes)
+            else:
+                self.rings[rtsp_url].max_bytes = ring_bytes
+        for rtsp_url in sorted(rtsp_urls - self.cameras - self._adding):
+            asyncio.ensure_future(self.add_camera(rtsp_url, ring_bytes))
+        print(f"Buffer pré-evento: {len(rtsp_urls)} câmeras, até {ring_bytes / (1024 * 1024):.0f} MB por câmera")
+
+    async def add_camera(self, rtsp_url, ring_bytes):
+        """Abre a câmera (mantida quente) e liga a ela um buffer de até ring_bytes"""
+        self._adding.add(rtsp_url)
+        try:
+            pipeline = VideoPipeline.get_instance(rtsp_url)
+            if self.decoder_pool:
+                await pipeline.keep_warm()
+                self.decoder_pool.add_clip_output(rtsp_url, (self.seconds, ring_bytes, self.fps, self.width, self.jpeg_quality))
+            else:
+                ring = ClipRing(self.seconds, ring_bytes)
+                clip_output = ClipOutput(ring, self.fps, self.width, self.jpeg_quality)
+                await pipeline.add_background_output(clip_output)
+                self.rings[rtsp_url] = ring
+                self.outputs[rtsp_url] = clip_output
+            self.cameras.add(rtsp_url)
+        except Exception as e:
+            print(f"Erro ao iniciar o buffer pré-evento da câmera {rtsp_url}: {e}")
+        finally:
+            self._adding.discard(rtsp_url)
+
+    async def remove_camera(self, rtsp_url):
+        """Encerra o buffer da câmera; quem fecha a câmera é o chamador (VideoPipeline.release_warm)"""
+        self.cameras.discard(rtsp_url)
+        self.rings.pop(rtsp_url, None)
+        clip_output = self.outputs.pop(rtsp_url, None)
+        if self.decoder_pool:
+            self.decoder_pool.remove_clip_output(rtsp_url)
+        elif clip_output:
+            pipeline = VideoPipeline._instances.get(rtsp_url)
+            if pipeline:
+                await pipeline.remove_background_output(clip_output)
+
+    def memory_bytes(self):
+        """Memória ocupada pelos buffers deste processo (sem os do DecoderPool)"""
+        return sum(ring.bytes for ring in self.rings.values())
+
+    async def export(self, rtsp_url, pdv_ip, reason="timeout"):
+        """Grava o buffer da câmera em um arquivo; retorna o caminho ou None"""
+        if rtsp_url not in self.cameras or rtsp_url in self._exporting:
+            return None
+
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        path = os.path.join(self.clip_dir, f"{pdv_ip}_{stamp}_{reason}.mkv")
+
+        self._exporting.add(rtsp_url)
+        try:
+            os.makedirs(self.clip_dir, exist_ok=True)
+            if self.decoder_pool:
+                duration, frames = await self.decoder_pool.export_clip(rtsp_url, path)
+            else:
+                duration, frames = await asyncio.get_running_loop().run_in_executor(
+                    None, export_ring, self.rings[rtsp_url], path)
+            self.clips_written += 1
+            print(f"Clipe de {duration:.0f}s ({frames} frames) da câmera do PDV {pdv_ip} gravado em {path}")
+            return path
+        except Exception as e:
+            print(f"Erro ao gravar clipe da câmera {rtsp_url}: {e}")
+            return None
+        finally:
+            self._exporting.discard(rtsp_url)
@@ -0,0 +1,13 @@
+"""
+Valores padrão do buffer pré-evento (clip_buffer.py), sem dependências de vídeo: o main.py os
+usa na linha de comando mesmo no modo pdv, em que o clip_buffer não é importado.
+"""
+
+# Segundos guardados por câmera, FPS e largura dos frames do buffer, qualidade JPEG
+DEFAULT_CLIP_SECONDS = 45
+DEFAULT_CLIP_FPS = 5
+DEFAULT_CLIP_WIDTH = 640
+DEFAULT_CLIP_JPEG_QUALITY = 70
+
+# Memória máxima (MB) somando os buffers de todas as câmeras
+DEFAULT_CLIP_MEMORY_MB = 512
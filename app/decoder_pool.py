@@ -0,0 +1,693 @@
+import asyncio
+import itertools
+import multiprocessing
+import multiprocessing.connection
+import os
+import struct
+import threading
+import time
+import cv2
+import numpy as np
+from multiprocessing import shared_memory
+from webrtc_conversion import FrameOutput, FrameGrabber
+from rtsp_connection import STATE_RECONNECTING
+
+# Quantidade padrão de slots em cada ring de frames
+DEFAULT_RING_SLOTS = 4
+
+# Tempo máximo (s) para um processo decodificador abrir uma câmera
+OPEN_CAMERA_TIMEOUT = 30.0
+
+# Intervalo mínimo (s) entre reinícios de um processo decodificador que morreu
+WORKER_RESTART_DELAY = 1.0
+
+# Notificação do processo decodificador: a resolução da câmera mudou e o ring da saída precisa
+# ser refeito: (RING_RESIZE, rtsp_url, (preset, formato))
+RING_RESIZE = "ring_resize"
+
+# Aviso de frame novo no ring de uma saída, escrito pelo processo decodificador no pipe lido pelo
+# loop de eventos: o id da saída (uint32); escritas menores que PIPE_BUF não se misturam
+FRAME_NOTIFY = struct.Struct("=I")
+
+class SharedFrameRing:
+    """
+    Ring de frames em memória compartilhada.
+
+    Layout: cabeçalho int64 [seq_mais_recente, timestamp_slot_0, ..., timestamp_slot_N-1,
+    captura_us_slot_0, ..., captura_us_slot_N-1] seguido de N slots de frames I420 com formato fixo. Existe um único escritor
+    (o processo decodificador), que escreve sempre no slot seguinte ao mais recente
+    e só então publica o novo número de sequência; o leitor obtém o slot mais
+    recente como uma view numpy, sem cópia. Como o escritor precisa completar
+    N-1 frames antes de voltar ao slot lido, o leitor tem esse intervalo para
+    consumir a view.
+    """
+    def __init__(self, shm, shape, slots, owner):
+        self.shm = shm
+        self.shape = tuple(shape)
+        self.slots = slots
+        self.owner = owner
+
+        header_size = 8 * (1 + 2 * slots)
+        self._header = np.ndarray((1 + 2 * slots,), dtype=np.int64, buffer=shm.buf)
+        self._frames = np.ndarray((slots,) + self.shape, dtype=np.uint8, buffer=shm.buf, offset=header_size)
+
+    @classmethod
+    def create(cls, shape, slots=DEFAULT_RING_SLOTS):
+        """Cria um novo ring (o criador é responsável por removê-lo)"""
+        size = 8 * (1 + 2 * slots) + slots * int(np.prod(shape))
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        ring = cls(shm, shape, slots, owner=True)
+        ring._header[:] = 0
+        ring._header[0] = -1
+        return ring
+
+    @classmethod
+    def attach(cls, name, shape, slots=DEFAULT_RING_SLOTS):
+        """Conecta a um ring existente pelo nome"""
+        return cls(shared_memory.SharedMemory(name=name), shape, slots, owner=False)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def next_slot(self):
+        """Retorna a view do slot onde o próximo frame deve ser escrito"""
+        return self._frames[(int(self._header[0]) + 1) % self.slots]
+
+    def commit(self, timestamp, capture_time):
+        """Publica o frame escrito em next_slot()"""
+        seq = int(self._header[0]) + 1
+        slot = seq % self.slots
+        self._header[1 + slot] = timestamp
+        self._header[1 + self.slots + slot] = int(capture_time * 1_000_000)
+        self._header[0] = seq
+
+    def read_latest(self, last_seq=-1):
+        """Retorna (seq, frame, timestamp, capture_time) do slot mais recente, ou None se não houver frame novo"""
+        seq = int(self._header[0])
+        if seq < 0 or seq == last_seq:
+            return None
+        slot = seq % self.slots
+        capture_time = int(self._header[1 + self.slots + slot]) / 1_000_000
+        return seq, self._frames[slot], int(self._header[1 + slot]), capture_time
+
+    def close(self):
+        self._header = None
+        self._frames = None
+        try:
+            self.shm.close()
+        except BufferError:
+            # Ainda há views em uso; o mapeamento é liberado quando forem coletadas
+            pass
+        if self.owner:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
+
+class RingFrameOutput(FrameOutput):
+    """
+    Saída de preset no processo decodificador: converte para I420 direto no slot do ring compartilhado.
+    Se a resolução da câmera mudar, o frame não cabe mais no ring: a saída descarta os frames e
+    chama on_resize(preset, formato) uma vez, até o servidor entregar um ring novo (replace_ring)
+    """
+    def __init__(self, quality_preset, ring, on_resize=None, on_frame=None, **kwargs):
+        super().__init__(quality_preset, max_queue_size=1, **kwargs)
+        self.ring = ring
+        self.on_resize = on_resize
+        self.on_frame = on_frame
+        self._resize_requested = None
+
+    def replace_ring(self, ring):
+        # O ring antigo pode estar em uso na thread de captura; é liberado quando for coletado
+        self.ring = ring
+        self._resize_requested = None
+
+    def _publish(self, frame, timestamp, capture_time):
+        ring = self.ring
+        resized = self._downscale_frame(frame)
+        shape = (resized.shape[0] * 3 // 2, resized.shape[1])
+        if shape != ring.shape:
+            if shape != self._resize_requested:
+                self._resize_requested = shape
+                print(f"Saída '{self.quality_preset}': frame {resized.shape[1]}x{resized.shape[0]} não cabe no ring "
+                      f"{ring.shape[1]}x{ring.shape[0] * 2 // 3}; pedindo um ring novo")
+                if self.on_resize:
+                    self.on_resize(self.quality_preset, shape)
+            return False
+        if self.motion_gate and not self.motion_gate.should_publish(resized):
+            return False
+        cv2.cvtColor(resized, cv2.COLOR_BGR2YUV_I420, dst=ring.next_slot())
+        ring.commit(timestamp, capture_time)
+        return True
+
+    def _notify(self):
+        # O consumidor está no processo do servidor: avisa pelo pipe de frames
+        if self.on_frame:
+            self.on_frame()
+
+class SharedRingOutput:
+    """
+    Lado do servidor de uma saída decodificada em outro processo; usada pelo VideoStreamTrack.
+    O DecoderPool acorda o consumidor (notify) quando o processo avisa que publicou um frame
+    """
+    def __init__(self, quality_preset, ring, notify_id=None):
+        self.quality_preset = quality_preset
+        self.ring = ring
+        self.notify_id = notify_id
+        self.last_seq = -1
+        self.closed = False
+        self._event = asyncio.Event()
+
+    def replace_ring(self, ring):
+        """Troca o ring (resolução da câmera mudou); chamado no loop de eventos, como poll"""
+        old_ring = self.ring
+        self.ring = ring
+        self.last_seq = -1
+        old_ring.close()
+
+    def poll(self):
+        """Retorna o frame mais recente ainda não lido (view sem cópia) ou None"""
+        if self.closed:
+            return None
+        latest = self.ring.read_latest(self.last_seq)
+        if latest is None:
+            return None
+        self.last_seq, frame, timestamp, capture_time = latest
+        return frame, timestamp, capture_time
+
+    def release(self, frame):
+        """Os frames são views do ring compartilhado: nada a devolver"""
+
+    async def get(self):
+        """Aguarda o próximo frame; retorna None se a saída for fechada"""
+        while not self.closed:
+            item = self.poll()
+            if item is not None:
+                return item
+
+            self._event.clear()
+            # Verifica de novo após limpar o evento, para não perder um aviso entre as duas etapas
+            item = self.poll()
+            if item is not None:
+                return item
+            await self._event.wait()
+        return None
+
+    def notify(self):
+        """Frame novo no ring (chamado no loop de eventos)"""
+        self._event.set()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.ring.close()
+            self._event.set()
+
+def _decoder_worker(command_queue, reply_queue, frame_pipe):
+    """Processo decodificador: mantém um FrameGrabber por câmera e atende comandos do servidor"""
+    from rtsp_connection import RTSPConnection
+
+    from clip_buffer import ClipRing, ClipOutput, export_ring
+
+    grabbers = {}  # { rtsp_url: FrameGrabber }
+    outputs = {}  # { (rtsp_url, preset): RingFrameOutput }
+    clip_outputs = {}  # { rtsp_url: ClipOutput }
+
+    # Não bloqueia a captura se o servidor atrasar a leitura: ele lê o frame mais recente do ring
+    # quando acordar por outro aviso
+    frame_fd = frame_pipe.fileno()
+    os.set_blocking(frame_fd, False)
+
+    def notify_frame(notify_id):
+        try:
+            os.write(frame_fd, FRAME_NOTIFY.pack(notify_id))
+        except BlockingIOError:
+            pass
+
+    def open_camera(request_id, rtsp_url, restore=None):
+        """
+        Abre a câmera e responde com a resolução. Com restore (lista de comandos), a câmera volta
+        de um processo que morreu: não espera a conexão (o FrameGrabber reconecta com backoff) e
+        recria as saídas que ela tinha
+        """
+        try:
+            rtsp_connection = RTSPConnection(rtsp_url)
+            # Mudanças de estado (queda, reconexão) são enviadas ao servidor sem request_id
+            rtsp_connection.add_state_listener(lambda state: reply_queue.put((None, rtsp_url, state)))
+            size = None
+            if restore is None:
+                rtsp_connection.connect()
+                size = (int(rtsp_connection.cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                        int(rtsp_connection.cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+
+            frame_grabber = FrameGrabber(rtsp_connection)
+            frame_grabber.start()
+            grabbers[rtsp_url] = frame_grabber
+            for command in restore or ():
+                handle(command)
+            reply_queue.put((request_id, True, size))
+        except Exception as e:
+            reply_queue.put((request_id, False, str(e)))
+
+    def export_clip(request_id, rtsp_url, path):
+        try:
+            reply_queue.put((request_id, True, export_ring(clip_outputs[rtsp_url].ring, path)))
+        except Exception as e:
+            reply_queue.put((request_id, False, str(e)))
+
+    def handle(command):
+        action = command[0]
+        if action == "open":
+            # A abertura do RTSP é lenta; não bloqueia os comandos das outras câmeras
+            _, request_id, rtsp_url, restore = command
+            threading.Thread(target=open_camera, args=(request_id, rtsp_url, restore), daemon=True).start()
+
+        elif action == "add_output":
+            _, rtsp_url, quality_preset, ring_name, shape, slots, params, lane_active, notify_id = command
+            ring = SharedFrameRing.attach(ring_name, shape, slots)
+            frame_output = RingFrameOutput(
+                quality_preset, ring,
+                on_resize=lambda preset, new_shape: reply_queue.put((RING_RESIZE, rtsp_url, (preset, new_shape))),
+                on_frame=lambda: notify_frame(notify_id),
+                **params)
+            if frame_output.motion_gate:
+                frame_output.motion_gate.forced = lane_active
+            outputs[(rtsp_url, quality_preset)] = frame_output
+            grabbers[rtsp_url].add_output(frame_output)
+
+        elif action == "replace_ring":
+            _, rtsp_url, quality_preset, ring_name, shape, slots = command
+            frame_output = outputs.get((rtsp_url, quality_preset))
+            if frame_output:
+                frame_output.replace_ring(SharedFrameRing.attach(ring_name, shape, slots))
+
+        elif action == "remove_output":
+            _, rtsp_url, quality_preset = command
+            frame_output = outputs.pop((rtsp_url, quality_preset), None)
+            if frame_output:
+                if rtsp_url in grabbers:
+                    grabbers[rtsp_url].remove_output(frame_output)
+                frame_output.ring.close()
+
+        elif action == "lane_active":
+            _, rtsp_url, active = command
+            for (url, _), frame_output in outputs.items():
+                if url == rtsp_url and frame_output.motion_gate:
+                    frame_output.motion_gate.forced = active
+
+        elif action == "add_clip":
+            _, rtsp_url, (seconds, max_bytes, fps, width, jpeg_quality) = command
+            clip_output = clip_outputs[rtsp_url] = ClipOutput(ClipRing(seconds, max_bytes), fps, width, jpeg_quality)
+            grabbers[rtsp_url].add_output(clip_output)
+
+        elif action == "clip_limit":
+            _, rtsp_url, max_bytes = command
+            if rtsp_url in clip_outputs:
+                clip_outputs[rtsp_url].ring.max_bytes = max_bytes
+
+        elif action == "remove_clip":
+            _, rtsp_url = command
+            clip_output = clip_outputs.pop(rtsp_url, None)
+            if clip_output and rtsp_url in grabbers:
+                grabbers[rtsp_url].remove_output(clip_output)
+
+        elif action == "export_clip":
+            # A gravação do arquivo não bloqueia os comandos
+            _, request_id, rtsp_url, path = command
+            threading.Thread(target=export_clip, args=(request_id, rtsp_url, path), daemon=True).start()
+
+        elif action == "close":
+            _, rtsp_url = command
+            clip_outputs.pop(rtsp_url, None)
+            frame_grabber = grabbers.pop(rtsp_url, None)
+            if frame_grabber:
+                frame_grabber.stop()
+                frame_grabber.rtsp_connection.close()
+
+    while True:
+        command = command_queue.get()
+        if command is None:
+            break
+        try:
+            handle(command)
+        except Exception as e:
+            print(f"Erro no processo decodificador ao executar '{command[0]}': {e}")
+
+    for frame_grabber in grabbers.values():
+        frame_grabber.stop()
+        frame_grabber.rtsp_connection.close()
+
+class DecoderPool:
+    """
+    Pool de processos decodificadores. Cada câmera é atribuída ao processo com
+    menos câmeras; a decodificação e o redimensionamento rodam fora do GIL do
+    servidor, que lê os frames dos rings em memória compartilhada.
+
+    Se um processo morrer, os pedidos pendentes nele falham (ninguém fica esperando com o
+    lock do VideoPipeline) e o processo é reiniciado com as mesmas câmeras e saídas.
+    """
+    def __init__(self, size, ring_slots=DEFAULT_RING_SLOTS, open_timeout=OPEN_CAMERA_TIMEOUT):
+        self.size = size
+        self.ring_slots = ring_slots
+        self.open_timeout = open_timeout
+
+        self._context = multiprocessing.get_context("spawn")
+        self._workers = []  # [(processo, fila de comandos)]
+        # Pipes dos avisos de frame de cada processo (lado de leitura, no loop de eventos)
+        self._frame_pipes = []
+        # Processos mortos à espera do reinício no loop de eventos
+        self._restarting = set()
+        self._reply_queue = None
+        self._reply_thread = None
+        self._watch_thread = None
+        self._stopping = False
+        self._loop = None
+
+        self._camera_worker = {}  # { rtsp_url: índice do processo }
+        self._camera_count = [0] * size
+        self._outputs = {}  # { (rtsp_url, preset): SharedRingOutput }
+        self._notify_outputs = {}  # { id do aviso de frame: SharedRingOutput }
+        self._notify_ids = itertools.count()
+        self._output_params = {}  # { (rtsp_url, preset): parâmetros do preset }, para recriar a saída
+        self._clip_params = {}  # { rtsp_url: parâmetros do buffer pré-evento }
+        self._camera_sizes = {}  # { rtsp_url: (largura, altura) }
+        self._active_lanes = set()  # câmeras com transação ativa (taxa cheia no MotionGate)
+
+        self._pending = {}  # { request_id: (loop, future, índice do processo) }
+        # Aberturas que expiraram: se o processo ainda abrir a câmera, ela é fechada { request_id: (índice, rtsp_url) }
+        self._abandoned_opens = {}
+        # Câmeras sendo reabertas após a morte do seu processo { request_id: rtsp_url }
+        self._restoring = {}
+
+        self.worker_restarts = 0
+
+        # Callback on_camera_state(rtsp_url, state), chamado na thread de respostas
+        self.on_camera_state = None
+        self._request_ids = itertools.count()
+
+    def _spawn_worker(self, index):
+        command_queue = self._context.Queue()
+        frame_reader, frame_writer = self._context.Pipe(duplex=False)
+        process = self._context.Process(
+            target=_decoder_worker,
+            args=(command_queue, self._reply_queue, frame_writer),
+            name=f"decoder-{index}",
+            daemon=True
+        )
+        process.start()
+        frame_writer.close()
+
+        os.set_blocking(frame_reader.fileno(), False)
+        if index < len(self._frame_pipes):
+            self._close_frame_pipe(index)
+            self._frame_pipes[index] = frame_reader
+        else:
+            self._frame_pipes.append(frame_reader)
+        if self._loop:
+            self._loop.add_reader(frame_reader.fileno(), self._read_frame_pipe, frame_reader)
+        return process, command_queue
+
+    def _close_frame_pipe(self, index):
+        frame_reader = self._frame_pipes[index]
+        if self._loop and not self._loop.is_closed():
+            self._loop.remove_reader(frame_reader.fileno())
+        frame_reader.close()
+
+    def _read_frame_pipe(self, frame_reader):
+        """Acorda as saídas com frame novo (no loop de eventos)"""
+        try:
+            data = os.read(frame_reader.fileno(), 65536)
+        except BlockingIOError:
+            return
+        if not data:
+            # Processo encerrado; o pipe é trocado no reinício
+            self._loop.remove_reader(frame_reader.fileno())
+            return
+        for (notify_id,) in FRAME_NOTIFY.iter_unpack(data[:len(data) - len(data) % FRAME_NOTIFY.size]):
+            output = self._notify_outputs.get(notify_id)
+            if output:
+                output.notify()
+
+    def start(self):
+        self._reply_queue = self._context.Queue()
+        # Chamado no loop de eventos do servidor: os avisos de frame são lidos nele
+        try:
+            self._loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._loop = None
+
+        for i in range(self.size):
+            self._workers.append(self._spawn_worker(i))
+
+        self._reply_thread = threading.Thread(target=self._dispatch_replies, daemon=True)
+        self._reply_thread.start()
+        self._watch_thread = threading.Thread(target=self._watch_workers, daemon=True)
+        self._watch_thread.start()
+        print(f"Pool de decodificação iniciado com {self.size} processos")
+
+    def _dispatch_replies(self):
+        """Entrega as respostas dos processos aos futures aguardados no loop de eventos"""
+        while True:
+            reply = self._reply_queue.get()
+            if reply is None:
+                break
+
+            request_id, success, result = reply
+            if request_id is None:
+                # Notificação de estado da câmera: (None, rtsp_url, state)
+                if self.on_camera_state:
+                    self.on_camera_state(success, result)
+                continue
+
+            if request_id == RING_RESIZE:
+                # (RING_RESIZE, rtsp_url, (preset, formato)); o ring é trocado no loop, junto das leituras
+                if self._loop and not self._loop.is_closed():
+                    self._loop.call_soon_threadsafe(self._replace_ring, success, *result)
+                continue
+
+            abandoned = self._abandoned_opens.pop(request_id, None)
+            if abandoned:
+                index, rtsp_url = abandoned
+                # Só fecha se a câmera não foi aberta de novo no mesmo processo depois disso
+                if success and self._camera_worker.get(rtsp_url) != index:
+                    print(f"Câmera {rtsp_url} abriu depois do tempo limite; fechando")
+                    self._workers[index][1].put(("close", rtsp_url))
+                continue
+
+            rtsp_url = self._restoring.pop(request_id, None)
+            if rtsp_url is not None:
+                if not success:
+                    print(f"Erro ao reabrir a câmera {rtsp_url} no processo decodificador reiniciado: {result}")
+                continue
+
+            loop, future, _ = self._pending.pop(request_id, (None, None, None))
+            if future is None:
+                continue
+
+            if success:
+                loop.call_soon_threadsafe(self._resolve, future, result, None)
+            else:
+                loop.call_soon_threadsafe(self._resolve, future, None, Exception(result))
+
+    @staticmethod
+    def _resolve(future, result, error):
+        # O future pode ter sido cancelado (tempo limite) ou falhado pela morte do processo
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def _watch_workers(self):
+        """
+        Detecta processos decodificadores que morreram; o reinício roda no loop de eventos, que é
+        quem altera as câmeras e saídas do pool
+        """
+        while not self._stopping:
+            sentinels = {process.sentinel: index for index, (process, _) in enumerate(self._workers)
+                         if index not in self._restarting}
+            ready = multiprocessing.connection.wait(list(sentinels), timeout=1.0)
+            if self._stopping:
+                break
+            for sentinel in ready:
+                index = sentinels[sentinel]
+                self._restarting.add(index)
+                self._workers[index][0].join(timeout=1.0)
+                if self._loop and not self._loop.is_closed():
+                    self._loop.call_soon_threadsafe(self._restart_worker, index)
+                else:
+                    # Sem loop de eventos ainda não há câmeras abertas
+                    self._restart_worker(index)
+                time.sleep(WORKER_RESTART_DELAY)
+
+    def _restart_worker(self, index):
+        if self._stopping:
+            return
+        process, _ = self._workers[index]
+        cameras = [rtsp_url for rtsp_url, worker in self._camera_worker.items() if worker == index]
+        print(f"Processo decodificador {index} encerrou (código {process.exitcode}); "
+              f"reiniciando com {len(cameras)} câmeras")
+        self.worker_restarts += 1
+
+        # Pedidos pendentes no processo morto falham em vez de esperar para sempre
+        error = Exception(f"processo decodificador {index} encerrou")
+        for request_id, (loop, future, worker) in list(self._pending.items()):
+            if worker == index and self._pending.pop(request_id, None):
+                loop.call_soon_threadsafe(self._resolve, future, None, error)
+
+        self._workers[index] = self._spawn_worker(index)
+        self._restarting.discard(index)
+        command_queue = self._workers[index][1]
+        for rtsp_url in cameras:
+            if self.on_camera_state:
+                self.on_camera_state(rtsp_url, STATE_RECONNECTING)
+            # As saídas voltam nos mesmos rings; o servidor continua lendo deles sem perceber a troca
+            restore = [("add_output", rtsp_url, quality_preset, output.ring.name, output.ring.shape, self.ring_slots,
+                        self._output_params[(url, quality_preset)], rtsp_url in self._active_lanes, output.notify_id)
+                       for (url, quality_preset), output in self._outputs.items() if url == rtsp_url]
+            if rtsp_url in self._clip_params:
+                restore.append(("add_clip", rtsp_url, self._clip_params[rtsp_url]))
+            request_id = next(self._request_ids)
+            self._restoring[request_id] = rtsp_url
+            command_queue.put(("open", request_id, rtsp_url, restore))
+
+    async def open_camera(self, rtsp_url):
+        """Abre a câmera no processo menos carregado e aguarda a resolução da fonte"""
+        index = self._camera_count.index(min(self._camera_count))
+
+        loop = asyncio.get_running_loop()
+        if self._loop is None:
+            # Pool iniciado fora do loop de eventos: passa a ler os avisos de frame neste
+            self._loop = loop
+            for frame_reader in self._frame_pipes:
+                loop.add_reader(frame_reader.fileno(), self._read_frame_pipe, frame_reader)
+        future = loop.create_future()
+        request_id = next(self._request_ids)
+        self._pending[request_id] = (loop, future, index)
+
+        self._workers[index][1].put(("open", request_id, rtsp_url, None))
+        try:
+            width, height = await asyncio.wait_for(future, self.open_timeout)
+        except asyncio.TimeoutError:
+            if self._pending.pop(request_id, None):
+                self._abandoned_opens[request_id] = (index, rtsp_url)
+            raise Exception(f"a câmera não abriu em {self.open_timeout:.0f}s no processo decodificador {index}")
+
+        self._camera_worker[rtsp_url] = index
+        self._camera_count[index] += 1
+        self._camera_sizes[rtsp_url] = (width, height)
+        print(f"Câmera {rtsp_url} ({width}x{height}) aberta no processo decodificador {index}")
+
+    def add_output(self, rtsp_url, quality_preset, params):
+        """Cria o ring da saída do preset e pede ao processo da câmera para alimentá-lo"""
+        width, height = self._camera_sizes[rtsp_url]
+        frame_output = FrameOutput(quality_preset, **params)
+        out_width, out_height = frame_output.output_size((height, width))
+
+        ring = SharedFrameRing.create((out_height * 3 // 2, out_width), self.ring_slots)
+        output = SharedRingOutput(quality_preset, ring, next(self._notify_ids))
+        self._outputs[(rtsp_url, quality_preset)] = output
+        self._output_params[(rtsp_url, quality_preset)] = params
+        self._notify_outputs[output.notify_id] = output
+
+        command_queue = self._workers[self._camera_worker[rtsp_url]][1]
+        command_queue.put(("add_output", rtsp_url, quality_preset, ring.name, ring.shape, self.ring_slots, params,
+                           rtsp_url in self._active_lanes, output.notify_id))
+        return output
+
+    def _replace_ring(self, rtsp_url, quality_preset, shape):
+        """Refaz o ring de uma saída com o formato dos frames atuais da câmera (no loop de eventos)"""
+        output = self._outputs.get((rtsp_url, quality_preset))
+        index = self._camera_worker.get(rtsp_url)
+        if not output or output.closed or index is None or output.ring.shape == tuple(shape):
+            return
+
+        ring = SharedFrameRing.create(shape, self.ring_slots)
+        output.replace_ring(ring)
+        self._workers[index][1].put(("replace_ring", rtsp_url, quality_preset, ring.name, ring.shape, self.ring_slots))
+        print(f"Ring da saída '{quality_preset}' de {rtsp_url} refeito para {shape[1]}x{shape[0] * 2 // 3}")
+
+    def set_lane_active(self, rtsp_url, active):
+        """Repassa ao processo da câmera se a pista tem transação ativa"""
+        if active:
+            self._active_lanes.add(rtsp_url)
+        else:
+            self._active_lanes.discard(rtsp_url)
+        index = self._camera_worker.get(rtsp_url)
+        if index is not None:
+            self._workers[index][1].put(("lane_active", rtsp_url, active))
+
+    def add_clip_output(self, rtsp_url, clip_params):
+        """Inicia o buffer pré-evento da câmera no seu processo decodificador"""
+        self._clip_params[rtsp_url] = clip_params
+        self._workers[self._camera_worker[rtsp_url]][1].put(("add_clip", rtsp_url, clip_params))
+
+    def set_clip_limit(self, rtsp_url, max_bytes):
+        """Altera o limite de memória do buffer pré-evento da câmera"""
+        if rtsp_url in self._clip_params:
+            seconds, _, fps, width, jpeg_quality = self._clip_params[rtsp_url]
+            self._clip_params[rtsp_url] = (seconds, max_bytes, fps, width, jpeg_quality)
+        index = self._camera_worker.get(rtsp_url)
+        if index is not None:
+            self._workers[index][1].put(("clip_limit", rtsp_url, max_bytes))
+
+    def remove_clip_output(self, rtsp_url):
+        """Encerra o buffer pré-evento da câmera (a câmera continua aberta)"""
+        self._clip_params.pop(rtsp_url, None)
+        index = self._camera_worker.get(rtsp_url)
+        if index is not None:
+            self._workers[index][1].put(("remove_clip", rtsp_url))
+
+    async def export_clip(self, rtsp_url, path):
+        """Pede ao processo da câmera para gravar o buffer pré-evento; retorna (duração, frames)"""
+        index = self._camera_worker[rtsp_url]
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        request_id = next(self._request_ids)
+        self._pending[request_id] = (loop, future, index)
+        self._workers[index][1].put(("export_clip", request_id, rtsp_url, path))
+        return await future
+
+    def remove_output(self, rtsp_url, quality_preset):
+        output = self._outputs.pop((rtsp_url, quality_preset), None)
+        self._output_params.pop((rtsp_url, quality_preset), None)
+        index = self._camera_worker.get(rtsp_url)
+        if index is not None:
+            self._workers[index][1].put(("remove_output", rtsp_url, quality_preset))
+        if output:
+            self._notify_outputs.pop(output.notify_id, None)
+            output.close()
+
+    def close_camera(self, rtsp_url):
+        for key in [key for key in self._outputs if key[0] == rtsp_url]:
+            self.remove_output(*key)
+
+        self._clip_params.pop(rtsp_url, None)
+        index = self._camera_worker.pop(rtsp_url, None)
+        self._camera_sizes.pop(rtsp_url, None)
+        if index is not None:
+            self._camera_count[index] -= 1
+            self._workers[index][1].put(("close", rtsp_url))
+
+    def stop(self):
+        self._stopping = True
+        for key in list(self._outputs):
+            self.remove_output(*key)
+
+        for process, command_queue in self._workers:
+            command_queue.put(None)
+        for process, command_queue in self._workers:
+            process.join(timeout=2.0)
+            if process.is_alive():
+                process.terminate()
+        self._workers = []
+
+        for index in range(len(self._frame_pipes)):
+            self._close_frame_pipe(index)
+        self._frame_pipes = []
+
+        if self._reply_queue:
+            self._reply_queue.put(None)
+        print("Pool de decodificação encerrado")
@@ -0,0 +1,66 @@
+class DVRForwarder:
+    """
+    Repasse dos datagramas dos PDVs para os DVRs (overlay de texto no vídeo).
+
+    É chamado pelo PDVIngest com o lote recém-lido, antes de qualquer parsing ou envio
+    aos navegadores, e usa envios não bloqueantes em sockets UDP conectados ao DVR:
+    um DVR lento ou fora do ar só gera descartes contabilizados, nunca trava o PDV.
+    """
+    def __init__(self):
+        # { chave_dvr: {'socket', 'address', 'connected', 'sent', 'dropped', 'errors'} }
+        self.targets = {}
+
+    def add_target(self, dvr_key, dvr_socket, dvr_ip, dvr_port):
+        """Registra o socket (já vinculado à porta de origem) de um DVR"""
+        dvr_socket.setblocking(False)
+        address = (dvr_ip, int(dvr_port))
+        connected = True
+        try:
+            # Socket conectado: o destino é resolvido uma vez e send() dispensa o endereço
+            dvr_socket.connect(address)
+        except OSError as e:
+            # O socket segue sem destino fixo: os envios usam sendto() com o endereço
+            connected = False
+            print(f"Erro ao conectar socket do DVR {dvr_key}: {e}; enviando com sendto()")
+
+        self.targets[dvr_key] = {
+            'socket': dvr_socket,
+            'address': address,
+            'connected': connected,
+            'sent': 0,
+            'dropped': 0,
+            'errors': 0
+        }
+
+    def remove_target(self, dvr_key):
+        self.targets.pop(dvr_key, None)
+
+    def forward(self, dvr_key, batch):
+        """Envia o lote [(data, addr), ...] ao DVR, descartando o que não puder sair imediatamente"""
+        target = self.targets.get(dvr_key)
+        if not target:
+            return
+
+        dvr_socket = target['socket']
+        address = None if target['connected'] else target['address']
+        sent = 0
+        for data, _ in batch:
+            try:
+                if address is None:
+                    dvr_socket.send(data)
+                else:
+                    dvr_socket.sendto(data, address)
+                sent += 1
+            except BlockingIOError:
+                # Buffer de envio cheio: descarta para manter o overlay em tempo real
+                target['dropped'] += 1
+            except OSError:
+                # Ex.: ECONNREFUSED por ICMP de um DVR fora do ar
+                target['dropped'] += 1
+                target['errors'] += 1
+        target['sent'] += sent
+
+    def report(self):
+        """Imprime o resumo de envios e descartes por DVR"""
+        for dvr_key, target in self.targets.items():
+            print(f"[DVR] {dvr_key}: enviados {target['sent']}, descartados {target['dropped']}, erros {target['errors']}")
@@ -0,0 +1,39 @@
+import logging
+
+# Formato padrão do servidor: eventos em uma linha, com campos chave=valor
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s %(message)s"
+
+class SampledLog:
+    """
+    Log estruturado de um evento frequente (por pacote, por frame): registra as primeiras
+    `first` ocorrências e depois uma a cada `every`, sempre com o total em n=.
+    Com o nível desativado o custo é uma comparação; use enabled() para evitar montar os campos.
+    """
+    def __init__(self, logger, level, event, first=10, every=1000):
+        self.logger = logger
+        self.level = level
+        self.event = event
+        self.first = first
+        self.every = every
+        self.count = 0
+
+    def enabled(self):
+        return self.logger.isEnabledFor(self.level)
+
+    def __call__(self, **fields):
+        self.count += 1
+        if self.count > self.first and self.count % self.every:
+            return
+        if not self.logger.isEnabledFor(self.level):
+            return
+        details = ' '.join(f"{key}={value}" for key, value in fields.items())
+        self.logger.log(self.level, "event=%s %s n=%d", self.event, details, self.count)
+
+# Bibliotecas muito verbosas em DEBUG (um log por frame/pacote): ficam no máximo em INFO
+QUIET_LOGGERS = ("websockets", "aiortc", "aioice")
+
+def setup_logging(level_name):
+    level = getattr(logging, level_name.upper(), logging.INFO)
+    logging.basicConfig(level=level, format=LOG_FORMAT)
+    for name in QUIET_LOGGERS:
+        logging.getLogger(name).setLevel(max(level, logging.INFO))
@@ -1,33 +1,159 @@
+import time
+
+# Início da importação dos módulos, para o relatório de inicialização
+IMPORT_START = time.perf_counter()
+
 import argparse
 import asyncio
 import json
 import logging
+import resource
 import socket
-import time
 import re
 import os
+import signal
 import websockets
-from aiortc import RTCSessionDescription
 from typing import Dict, Set, List
-from webrtc_conversion import WebRTCConversion
-from rtsp_connection import RTSPConnection
-from message_processor import process_message
+from message_processor import parse_line
 from pdv_transaction import PDVTransaction
+from pdv_ingest import PDVIngest, MAX_DATAGRAM_SIZE
+from dvr_forwarder import DVRForwarder
+from client_sender import ClientSender, DEFAULT_CLIENT_QUEUE_SIZE, POLICY_DROP_OLDEST, SLOW_CLIENT_POLICIES
+from pdv_batcher import PDVBatcher, DEFAULT_BATCH_WINDOW_MS, DEFAULT_BATCH_MAX_LINES
+from pdv_history import PDVHistory, DEFAULT_HISTORY_LINES, DEFAULT_HISTORY_MEMORY_MB
+from pdv_journal import PDVJournal, DEFAULT_FSYNC_INTERVAL, DEFAULT_MAX_BACKLOG_BATCHES
+from pdv_subscriptions import PDVSubscriptions, ALL_LANES
+from udp_sockets import set_socket_buffers, check_buffer_size, socket_inode, read_udp_socket_stats
+from clip_settings import (DEFAULT_CLIP_SECONDS, DEFAULT_CLIP_FPS, DEFAULT_CLIP_WIDTH,
+                           DEFAULT_CLIP_JPEG_QUALITY, DEFAULT_CLIP_MEMORY_MB)
+from metrics import REGISTRY, start_metrics_server, url_label
+from log_utils import SampledLog, setup_logging
+from supervisor import Supervisor, lane_shard, worker_socket_paths
+
+IMPORT_SECONDS = time.perf_counter() - IMPORT_START
+
+# Modos de execução: só o repasse dos PDVs, só o vídeo das câmeras, ou os dois
+MODE_PDV = "pdv"
+MODE_VIDEO = "video"
+MODE_ALL = "all"
+RUN_MODES = (MODE_PDV, MODE_VIDEO, MODE_ALL)
+
+# Loops de eventos: o padrão do asyncio ou o uvloop (opcional, se instalado)
+LOOP_ASYNCIO = "asyncio"
+LOOP_UVLOOP = "uvloop"
+EVENT_LOOPS = (LOOP_ASYNCIO, LOOP_UVLOOP)
 
-pdv_clients = {}
+# Módulos de vídeo (aiortc, cv2, numpy, av), importados por load_video_modules() só quando o
+# servidor RTSP é ativado: uma caixa só de repasse PDV -> DVR não paga o tempo nem a memória
+RTCSessionDescription = None
+WebRTCConversion = VideoPipeline = DEFAULT_QUALITY_PRESET = None
+MosaicSession = MosaicStream = None
+ClipRecorder = None
+
+def load_video_modules():
+    """Importa as dependências de vídeo (uma vez); retorna o tempo gasto em segundos"""
+    global RTCSessionDescription, WebRTCConversion, VideoPipeline, DEFAULT_QUALITY_PRESET
+    global MosaicSession, MosaicStream, ClipRecorder
+    if VideoPipeline is not None:
+        return 0.0
+    
+    start = time.perf_counter()
+    from aiortc import RTCSessionDescription
+    from webrtc_conversion import WebRTCConversion, VideoPipeline, DEFAULT_QUALITY_PRESET
+    from mosaic import MosaicSession, MosaicStream
+    from clip_buffer import ClipRecorder
+    return time.perf_counter() - start
+
+logger = logging.getLogger("selfcheckout")
+
+# Tempo de classificação de cada linha recebida, por PDV
+PDV_PARSE_SECONDS = REGISTRY.histogram("pdv_parse_seconds", "Tempo de parse_line por linha do PDV", ("pdv",))
+
+# Log por datagrama (nível DEBUG, amostrado): desligado em produção
+LOG_PDV_RECV = SampledLog(logger, logging.DEBUG, "pdv_recv", first=100, every=100)
+
+def skip_duplicate_ports(selfs_config):
+    """
+    Retira as pistas que repetem o pdv_port ou o origin_port de uma pista anterior (a primeira
+    fica com a porta). Com SO_REUSEPORT o segundo bind não falharia e o kernel dividiria os
+    datagramas entre as duas pistas
+    """
+    owners = {}
+    kept = []
+    for config in selfs_config:
+        pdv_ip = config.get('pdv_ip')
+        if not pdv_ip:
+            kept.append(config)
+            continue
+        ports = [('pdv_port', int(config.get('pdv_port', 38800)))]
+        if config.get('dvr_ip') and config.get('dvr_port') and config.get('origin_port'):
+            ports.append(('origin_port', int(config['origin_port'])))
+        
+        claimed = {}
+        for field, port in ports:
+            other = owners.get(port) or claimed.get(port)
+            if other:
+                print(f"AVISO: PDV {pdv_ip} ignorado: {field} {port} já usado como {other[0]} do PDV {other[1]}")
+                break
+            claimed[port] = (field, pdv_ip)
+        else:
+            owners.update(claimed)
+            kept.append(config)
+    return kept
 
 class UnifiedServer:
-    def __init__(self, ws_port=8765, rtsp_ws_port=8080, pdv_timeout=180, config_path=None):
+    def __init__(self, ws_port=8765, rtsp_ws_port=8080, pdv_timeout=180, config_path=None,
+                 decoder_processes=0, live_video=False, warm_cameras=False,
+                 pdv_buffer_size=MAX_DATAGRAM_SIZE, client_queue_size=DEFAULT_CLIENT_QUEUE_SIZE,
+                 slow_client_policy=POLICY_DROP_OLDEST, ws_ping_interval=20,
+                 batch_window_ms=DEFAULT_BATCH_WINDOW_MS, batch_max_lines=DEFAULT_BATCH_MAX_LINES,
+                 ws_compression=True, history_lines=DEFAULT_HISTORY_LINES,
+                 history_memory_mb=DEFAULT_HISTORY_MEMORY_MB, journal_dir=None,
+                 journal_fsync_interval=DEFAULT_FSYNC_INTERVAL, journal_max_backlog=DEFAULT_MAX_BACKLOG_BATCHES,
+                 metrics_port=0, motion_gating=False,
+                 clip_dir=None, clip_seconds=DEFAULT_CLIP_SECONDS, clip_fps=DEFAULT_CLIP_FPS,
+                 clip_width=DEFAULT_CLIP_WIDTH, clip_jpeg_quality=DEFAULT_CLIP_JPEG_QUALITY,
+                 clip_memory_mb=DEFAULT_CLIP_MEMORY_MB, shard_index=0, shard_count=1, unix_socket_dir=None,
+                 mode=MODE_ALL, pdv_rcvbuf=0, dvr_sndbuf=0, reuseport=False):
         self.ws_port = ws_port
         self.rtsp_ws_port = rtsp_ws_port
         self.config_path = config_path
         
+        # Modo de execução (ver RUN_MODES): as dependências de vídeo só são importadas
+        # quando o servidor RTSP é ativado
+        self.mode = mode
+        self.pdv_enabled = mode in (MODE_PDV, MODE_ALL)
+        self.video_enabled = mode in (MODE_VIDEO, MODE_ALL)
+        self.video_import_seconds = load_video_modules() if self.video_enabled else 0.0
+        
+        # Modo supervisor: este processo atende só as pistas do seu shard, e os WebSockets
+        # ficam em sockets Unix atrás do roteador (ver supervisor.py)
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self.unix_socket_dir = unix_socket_dir
+        
+        # Quantidade de processos decodificadores (0 = decodifica em threads no próprio processo)
+        self.decoder_processes = decoder_processes
+        self.decoder_pool = None
+        
+        # Modo de vídeo de baixa latência (sempre o frame mais recente, sem fila)
+        self.live_video = live_video
+        
+        # Mantém abertas as câmeras configuradas (campo 'rtsp_url' do config.json)
+        self.warm_cameras = warm_cameras
+        
+        # Reduz para ~1 fps as câmeras paradas sem transação em andamento na pista
+        self.motion_gating = motion_gating
+        
         self.active_rtsp_connections = set()
-        self.webrtc_conversions: Dict[str, WebRTCConversion] = {}
+        self.webrtc_conversions: Dict[str, "WebRTCConversion"] = {}
+        self.mosaic_sessions: Dict[str, "MosaicSession"] = {}
         
         self.rtsp_client_count: Dict[str, int] = {}
 
         self.pdv_monitor = PDVTransaction(timeout_seconds=pdv_timeout)
+        self.pdv_monitor.on_transaction_change = self.on_transaction_change
+        self.pdv_monitor.on_timeout = self.on_pdv_timeout
         
         self.selfs_config = []
         
@@ -35,125 +161,553 @@ class UnifiedServer:
         
         self.pdv_listen_sockets = {}
         
+        # SO_RCVBUF dos sockets dos PDVs e SO_SNDBUF dos sockets dos DVRs (0 = padrão do kernel);
+        # SO_REUSEPORT permite vincular a porta enquanto outro processo (reinício) ainda a usa
+        self.pdv_rcvbuf = pdv_rcvbuf
+        self.dvr_sndbuf = dvr_sndbuf
+        self.reuseport = reuseport
+        
+        # Tarefas de escuta dos sockets dos PDVs: { chave_pdv: asyncio.Task }
+        self.pdv_listen_tasks = {}
+        
+        # Uma recarga do config.json (SIGHUP) por vez
+        self._reload_lock = asyncio.Lock()
+        
+        # Leitura em lote dos sockets UDP dos PDVs
+        self.pdv_ingest = PDVIngest(buffer_size=pdv_buffer_size)
+        
         self.dvr_sockets = {}
         
-    def load_config(self):
+        # Repasse não bloqueante dos datagramas aos DVRs
+        self.dvr_forwarder = DVRForwarder()
+        
+        # Pistas assinadas por cada cliente WebSocket do PDV (índices direto e reverso)
+        self.pdv_subscriptions = PDVSubscriptions()
+        
+        # Fila de saída por cliente WebSocket do PDV: { websocket: ClientSender }
+        self.client_queue_size = client_queue_size
+        self.slow_client_policy = slow_client_policy
+        self.pdv_senders = {}
+        
+        # Intervalo de ping do WebSocket PDV (0 = desativado); clientes sem pong são desconectados
+        self.ws_ping_interval = ws_ping_interval
+        
+        # Compressão permessage-deflate no WebSocket PDV
+        self.ws_compression = ws_compression
+        
+        # Agrupamento de pdv_data para clientes que pedem "batch" no register: { ip_pdv: PDVBatcher },
+        # criado na primeira linha de uma pista com clientes em modo lote
+        self.batch_window_ms = batch_window_ms
+        self.batch_max_lines = batch_max_lines
+        self.pdv_batchers = {}
+        
+        # Últimas linhas de cada PDV, enviadas ao cliente no register (None = desativado)
+        self.pdv_history = None
+        if history_lines > 0:
+            self.pdv_history = PDVHistory(history_lines, int(history_memory_mb * 1024 * 1024))
+        
+        # Diário em disco de todo o tráfego dos PDVs, para auditoria (None = desativado)
+        self.pdv_journal = None
+        if journal_dir and self.pdv_enabled:
+            self.pdv_journal = PDVJournal(journal_dir, fsync_interval=journal_fsync_interval,
+                                          max_backlog_batches=journal_max_backlog)
+        
+        # Buffer pré-evento das câmeras, gravado em clipe nos alertas de inatividade (None = desativado);
+        # precisa do vídeo e dos alertas dos PDVs no mesmo processo
+        self.clip_recorder = None
+        if clip_dir and mode != MODE_ALL:
+            print(f"AVISO: buffer pré-evento desativado no modo {mode} (requer o modo {MODE_ALL})")
+        elif clip_dir:
+            self.clip_recorder = ClipRecorder(clip_dir, seconds=clip_seconds, fps=clip_fps, width=clip_width,
+                                              jpeg_quality=clip_jpeg_quality, max_bytes=int(clip_memory_mb * 1024 * 1024))
+        
+        # Endpoint HTTP local de métricas (0 = desativado)
+        self.metrics_port = metrics_port
+        REGISTRY.add_collector(self.collect_metrics)
+        
+        # Métricas acumuladas dos clientes PDV já desconectados
+        self.pdv_client_stats = {
+            'sent': 0,
+            'dropped': 0,
+            'coalesced': 0,
+            'slow_disconnects': 0,
+            'keepalive_evictions': 0
+        }
+        
+    def read_config(self):
+        """Lê o config.json (só as pistas do shard deste processo); retorna a lista ou None em caso de erro"""
         if not self.config_path or not os.path.exists(self.config_path):
             print(f"Arquivo de configuração não encontrado: {self.config_path}")
-            return False
+            return None
             
         try:
             with open(self.config_path, 'r') as file:
-                self.selfs_config = json.load(file)
-                
-            self.pdv_ip_to_config = {}
-            for config in self.selfs_config:
-                pdv_ip = config.get('pdv_ip')
-                if pdv_ip:
-                    self.pdv_ip_to_config[pdv_ip] = config
-            
-            pdv_ips = [config.get('pdv_ip') for config in self.selfs_config]
-            print(f"Configuração carregada: {len(self.selfs_config)} SelfCheckouts encontrados.")
-            print(f"IPs dos PDVs: {', '.join(pdv_ips)}")
-                
-            return True
+                selfs_config = json.load(file)
+            
+            # Antes do shard: todos os workers vinculam em 0.0.0.0 e as portas valem para o arquivo todo
+            selfs_config = skip_duplicate_ports(selfs_config)
+            
+            if self.shard_count > 1:
+                selfs_config = [config for config in selfs_config
+                                if lane_shard(config.get('pdv_ip', ''), self.shard_count) == self.shard_index]
+            return selfs_config
         except Exception as e:
             print(f"Erro ao carregar configuração: {e}")
+            return None
+    
+    def apply_config(self, selfs_config):
+        self.selfs_config = selfs_config
+        self.pdv_ip_to_config = {}
+        for config in self.selfs_config:
+            pdv_ip = config.get('pdv_ip')
+            if pdv_ip:
+                self.pdv_ip_to_config[pdv_ip] = config
+        
+        print(f"Configuração carregada: {len(self.selfs_config)} SelfCheckouts encontrados.")
+        print(f"IPs dos PDVs: {', '.join(self.pdv_ip_to_config)}")
+    
+    def load_config(self):
+        selfs_config = self.read_config()
+        if selfs_config is None:
             return False
+        self.apply_config(selfs_config)
+        return True
+    
+    def open_pdv_socket(self, config):
+        """Vincula o socket de escuta de uma pista; retorna a chave do socket ou None"""
+        pdv_ip = config.get('pdv_ip')
+        pdv_port = int(config.get('pdv_port', 38800))
+        if not pdv_ip:
+            return None
+        
+        try:
+            pdv_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            rcvbuf, _ = set_socket_buffers(pdv_socket, rcvbuf=self.pdv_rcvbuf, reuseport=self.reuseport)
+            check_buffer_size("SO_RCVBUF", self.pdv_rcvbuf, rcvbuf)
+            
+            pdv_socket.bind(('0.0.0.0', pdv_port))
+            pdv_socket.setblocking(False)
             
+            pdv_key = f"{pdv_ip}:{pdv_port}"
+            self.pdv_listen_sockets[pdv_key] = {
+                'socket': pdv_socket,
+                'pdv_ip': pdv_ip,
+                'pdv_port': pdv_port,
+                'config': config
+            }
+            
+            print(f"Socket de escuta configurado para PDV {pdv_ip}:{pdv_port}")
+            return pdv_key
+        except Exception as e:
+            print(f"Erro ao configurar socket para PDV {pdv_ip}:{pdv_port}: {e}")
+            return None
+    
+    def close_pdv_socket(self, pdv_key):
+        """Para a escuta de uma pista e fecha o seu socket"""
+        self.stop_pdv_listener(pdv_key)
+        self.pdv_ingest.forget(pdv_key)
+        socket_data = self.pdv_listen_sockets.pop(pdv_key, None)
+        if socket_data:
+            socket_data['socket'].close()
+            print(f"Socket de escuta do PDV {pdv_key} fechado")
+    
     def setup_pdv_sockets(self):
         for config in self.selfs_config:
-            pdv_ip = config.get('pdv_ip')
-            pdv_port = int(config.get('pdv_port', 38800))
+            self.open_pdv_socket(config)
+    
+    def open_dvr_socket(self, config):
+        pdv_ip = config.get('pdv_ip')
+        dvr_ip = config.get('dvr_ip')
+        dvr_port = config.get('dvr_port')
+        origin_port = config.get('origin_port')
+
+        if dvr_ip and dvr_port and origin_port:
+            dvr_key = f"{pdv_ip}_{dvr_ip}:{dvr_port}"
             
-            if pdv_ip:
-                try:
-                    pdv_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                    
-                    pdv_socket.bind(('0.0.0.0', pdv_port))
-                    pdv_socket.setblocking(False)
-                    
-                    self.pdv_listen_sockets[f"{pdv_ip}:{pdv_port}"] = {
-                        'socket': pdv_socket,
-                        'pdv_ip': pdv_ip,
-                        'pdv_port': pdv_port,
-                        'config': config
-                    }
-                    
-                    print(f"Socket de escuta configurado para PDV {pdv_ip}:{pdv_port}")
-                except Exception as e:
-                    print(f"Erro ao configurar socket para PDV {pdv_ip}:{pdv_port}: {e}")
+            try:
+                dvr_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                _, sndbuf = set_socket_buffers(dvr_socket, sndbuf=self.dvr_sndbuf, reuseport=self.reuseport)
+                check_buffer_size("SO_SNDBUF", self.dvr_sndbuf, sndbuf)
+                
+                dvr_socket.bind(('0.0.0.0', int(origin_port)))
+
+                self.dvr_sockets[dvr_key] = {
+                    'socket': dvr_socket,
+                    'dvr_ip': dvr_ip,
+                    'dvr_port': int(dvr_port),
+                    'pdv_ip': pdv_ip,
+                    'origin_port': int(origin_port)
+                }
+                self.dvr_forwarder.add_target(dvr_key, dvr_socket, dvr_ip, dvr_port)
+                
+                print(f"Socket de envio configurado para DVR {dvr_ip}:{dvr_port} com origem na porta {origin_port} para PDV {pdv_ip}")
+            except Exception as e:
+                print(f"Erro ao configurar socket para DVR {dvr_key}: {e}")
     
-    def setup_dvr_sockets(self):
-        for sock_data in self.dvr_sockets.values():
+    def close_dvr_socket(self, dvr_key):
+        self.dvr_forwarder.remove_target(dvr_key)
+        sock_data = self.dvr_sockets.pop(dvr_key, None)
+        if sock_data:
             try:
                 sock_data['socket'].close()
             except:
                 pass
-        
-        self.dvr_sockets = {}
+    
+    def setup_dvr_sockets(self):
+        for dvr_key in list(self.dvr_sockets):
+            self.close_dvr_socket(dvr_key)
         
         for config in self.selfs_config:
-            pdv_ip = config.get('pdv_ip')
-            dvr_ip = config.get('dvr_ip')
-            dvr_port = config.get('dvr_port')
-            origin_port = config.get('origin_port')
-
-            if dvr_ip and dvr_port and origin_port:
-                dvr_key = f"{pdv_ip}_{dvr_ip}:{dvr_port}"
-                
-                try:
-                    dvr_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                    
-                    dvr_socket.bind(('0.0.0.0', int(origin_port)))
-
-                    self.dvr_sockets[dvr_key] = {
-                        'socket': dvr_socket,
-                        'dvr_ip': dvr_ip,
-                        'dvr_port': int(dvr_port),
-                        'pdv_ip': pdv_ip,
-                        'origin_port': int(origin_port)
-                    }
-                    
-                    print(f"Socket de envio configurado para DVR {dvr_ip}:{dvr_port} com origem na porta {origin_port} para PDV {pdv_ip}")
-                except Exception as e:
-                    print(f"Erro ao configurar socket para DVR {dvr_key}: {e}")
+            self.open_dvr_socket(config)
+    
+    def start_pdv_listener(self, pdv_key):
+        self.pdv_listen_tasks[pdv_key] = asyncio.create_task(
+            self.listen_pdv_socket(pdv_key, self.pdv_listen_sockets[pdv_key]))
+    
+    def stop_pdv_listener(self, pdv_key):
+        task = self.pdv_listen_tasks.pop(pdv_key, None)
+        if task:
+            task.cancel()
+        self.pdv_ingest.remove_socket(pdv_key)
     
-    async def register_pdv_client(self, websocket, pdv_ip):
-        if pdv_ip not in pdv_clients:
-            pdv_clients[pdv_ip] = set()
+    async def reload_config(self):
+        """
+        Relê o config.json e aplica só a diferença: fecha e vincula os sockets das pistas
+        removidas, novas ou alteradas e reinicia só as escutas afetadas. As conexões WebSocket,
+        as sessões WebRTC e as transações em andamento das demais pistas não são tocadas
+        """
+        async with self._reload_lock:
+            selfs_config = self.read_config()
+            if selfs_config is None:
+                print("Recarga cancelada: a configuração atual foi mantida")
+                return False
+            
+            old_configs = self.pdv_ip_to_config
+            new_configs = {config['pdv_ip']: config for config in selfs_config if config.get('pdv_ip')}
+            
+            removed = [pdv_ip for pdv_ip in old_configs if pdv_ip not in new_configs]
+            added = [pdv_ip for pdv_ip in new_configs if pdv_ip not in old_configs]
+            changed = [pdv_ip for pdv_ip in new_configs
+                       if pdv_ip in old_configs and new_configs[pdv_ip] != old_configs[pdv_ip]]
+            
+            def pdv_key(config):
+                return f"{config['pdv_ip']}:{int(config.get('pdv_port', 38800))}"
+            
+            def in_transaction(pdv_ip):
+                return self.pdv_monitor.pdv_states.get(pdv_ip, {}).get('active_transaction', False)
+            
+            # O que reabrir em cada pista: { pdv_ip: (socket do PDV, socket do DVR) }
+            reopen = {pdv_ip: (True, True) for pdv_ip in added}
             
-        pdv_clients[pdv_ip].add(websocket)
-        print(f"Cliente WebSocket registrado para o PDV {pdv_ip}")
+            # Primeiro fecha: uma porta liberada por uma pista pode ser reutilizada por outra
+            for pdv_ip in removed + changed:
+                old = old_configs[pdv_ip]
+                new = new_configs.get(pdv_ip)
+                pdv_changed = not new or pdv_key(new) != pdv_key(old)
+                dvr_changed = pdv_changed or any(new.get(field) != old.get(field)
+                                                 for field in ('dvr_ip', 'dvr_port', 'origin_port'))
+                
+                if (pdv_changed or new.get('rtsp_url') != old.get('rtsp_url')) and in_transaction(pdv_ip):
+                    # A câmera antiga deixa de acompanhar a transação da pista
+                    self.on_transaction_change(pdv_ip, False)
+                
+                if self.pdv_enabled:
+                    if pdv_changed:
+                        # Pista removida ou em outra porta: a transação em andamento não continua
+                        self.close_pdv_socket(pdv_key(old))
+                        self.pdv_monitor.remove_pdv(pdv_ip)
+                    elif dvr_changed:
+                        # Mesmo socket do PDV: só a escuta é reiniciada com o novo DVR
+                        self.stop_pdv_listener(pdv_key(old))
+                    if dvr_changed:
+                        self.close_dvr_socket(f"{pdv_ip}_{old.get('dvr_ip')}:{old.get('dvr_port')}")
+                
+                if new:
+                    reopen[pdv_ip] = (pdv_changed, dvr_changed)
+            
+            # Pistas cujo socket não chegou a ser vinculado (porta ocupada na inicialização ou na
+            # recarga anterior) tentam de novo
+            if self.pdv_enabled:
+                for pdv_ip, config in new_configs.items():
+                    pdv_reopen, dvr_reopen = reopen.get(pdv_ip, (False, False))
+                    dvr_key = f"{pdv_ip}_{config.get('dvr_ip')}:{config.get('dvr_port')}"
+                    missing_pdv = pdv_key(config) not in self.pdv_listen_sockets
+                    missing_dvr = bool(config.get('dvr_ip') and config.get('dvr_port') and config.get('origin_port')) \
+                        and dvr_key not in self.dvr_sockets
+                    if missing_pdv or missing_dvr:
+                        reopen[pdv_ip] = (pdv_reopen or missing_pdv, dvr_reopen or missing_dvr)
+            
+            self.apply_config(selfs_config)
+            
+            for pdv_ip, (pdv_changed, dvr_changed) in reopen.items():
+                config = new_configs[pdv_ip]
+                if self.pdv_enabled:
+                    if dvr_changed:
+                        self.open_dvr_socket(config)
+                    if pdv_changed:
+                        listen_key = self.open_pdv_socket(config)
+                    else:
+                        listen_key = pdv_key(config)
+                        socket_data = self.pdv_listen_sockets.get(listen_key)
+                        if socket_data:
+                            socket_data['config'] = config
+                        else:
+                            listen_key = None
+                    if listen_key and listen_key not in self.pdv_listen_tasks:
+                        self.start_pdv_listener(listen_key)
+                
+                if pdv_ip in changed and config.get('rtsp_url') != old_configs[pdv_ip].get('rtsp_url') and in_transaction(pdv_ip):
+                    self.on_transaction_change(pdv_ip, True)
+            
+            if self.video_enabled:
+                old_cameras = {config.get('rtsp_url') for config in old_configs.values()} - {None, ''}
+                new_cameras = {config.get('rtsp_url') for config in new_configs.values()} - {None, ''}
+                
+                if self.clip_recorder:
+                    await self.clip_recorder.update_cameras(new_cameras)
+                
+                # Câmeras que saíram da configuração (pista removida ou rtsp_url trocada): fecha as
+                # quentes; as que têm visualizadores fecham quando o último sair
+                for rtsp_url in sorted(old_cameras - new_cameras):
+                    pipeline = VideoPipeline._instances.get(rtsp_url)
+                    if pipeline:
+                        await pipeline.release_warm()
+                
+                if self.warm_cameras:
+                    self.warm_up_cameras([config for config in self.selfs_config
+                                          if config.get('rtsp_url') not in old_cameras])
+            
+            print(f"Configuração recarregada: {len(added)} pistas novas, {len(removed)} removidas, "
+                  f"{len(changed)} alteradas, {len(new_configs) - len(added) - len(changed)} sem mudança")
+            return True
+
+    async def register_pdv_client(self, websocket, pdv_ip, batch=False):
+        if not pdv_ip:
+            return False
+        
+        sender = self.pdv_senders[websocket]
+        if batch:
+            sender.batch = True
+        self.pdv_subscriptions.subscribe(sender, pdv_ip)
+        # Um lote pendente da pista já inclui o novo cliente (o histórico enviado não repete essas linhas)
+        self.refresh_pdv_batchers((pdv_ip,))
+        
+        print(f"Cliente WebSocket registrado para o PDV {pdv_ip}{' (lotes)' if batch else ''}")
         return True
 
+    def refresh_pdv_batchers(self, lanes):
+        """Atualiza os lotes das pistas cujas assinaturas mudaram, encerrando os que ficaram sem clientes"""
+        if ALL_LANES in lanes:
+            lanes = list(self.pdv_batchers)
+        for ip in lanes:
+            batcher = self.pdv_batchers.get(ip)
+            if not batcher:
+                continue
+            batcher.clients = self.pdv_subscriptions.subscribers(ip)[2]
+            if not batcher.clients:
+                batcher.close()
+                del self.pdv_batchers[ip]
+
     async def unregister_pdv_client(self, websocket):
-        for ip, clients in list(pdv_clients.items()):
-            if websocket in clients:
-                clients.remove(websocket)
-                print(f"Cliente WebSocket removido do PDV {ip}")
-                if len(clients) == 0:
-                    del pdv_clients[ip]
-                    print(f"Conjunto de clientes para o PDV {ip} removido (vazio)")
-                break
+        sender = self.pdv_senders.pop(websocket, None)
+        if not sender:
+            return
+        
+        # Índice reverso: só as pistas que o cliente assinava
+        lanes = self.pdv_subscriptions.remove(sender)
+        for ip in lanes:
+            print(f"Cliente WebSocket removido do PDV {ip}")
+        self.refresh_pdv_batchers(lanes)
+        
+        # Contabiliza as métricas do cliente antes de descartá-lo
+        stats = self.pdv_client_stats
+        stats['sent'] += sender.sent
+        stats['dropped'] += sender.dropped
+        stats['coalesced'] += sender.coalesced
+        if websocket.close_code == 1013:
+            stats['slow_disconnects'] += 1
+        elif websocket.close_code == 1011:
+            # 1011 é o código usado pelo websockets quando o ping fica sem resposta
+            stats['keepalive_evictions'] += 1
+        sender.close()
+
+    def collect_metrics(self):
+        """Amostras lidas dos contadores mantidos pelos componentes, no momento da coleta"""
+        for pdv_key, stats in self.pdv_ingest.stats.items():
+            labels = {"pdv": pdv_key}
+            yield "pdv_datagrams_received_total", "counter", "Datagramas recebidos dos PDVs", labels, stats['datagrams']
+            yield "pdv_datagrams_truncated_total", "counter", "Datagramas maiores que o buffer de recepção", labels, stats['truncated']
+            yield "pdv_ingest_batches_total", "counter", "Despertares de leitura com dados", labels, stats['batches']
+            yield "pdv_ingest_batches_dropped_total", "counter", "Lotes descartados com a fila do parsing cheia", labels, stats['dropped_batches']
+        
+        # Descartes do kernel (buffer de recepção cheio), lidos de /proc/net/udp pelo inode de cada socket
+        inodes = {}
+        for pdv_key, socket_data in list(self.pdv_listen_sockets.items()):
+            try:
+                inodes[socket_inode(socket_data['socket'])] = pdv_key
+            except OSError:
+                continue
+        for inode, (rx_queue, drops) in read_udp_socket_stats(inodes).items():
+            labels = {"pdv": inodes[inode]}
+            yield "pdv_socket_kernel_drops_total", "counter", "Datagramas dos PDVs descartados pelo kernel (SO_RCVBUF cheio)", labels, drops
+            yield "pdv_socket_rx_queue_bytes", "gauge", "Bytes aguardando leitura no socket do PDV", labels, rx_queue
+        
+        for dvr_key, target in self.dvr_forwarder.targets.items():
+            labels = {"dvr": dvr_key}
+            yield "dvr_datagrams_forwarded_total", "counter", "Datagramas repassados aos DVRs", labels, target['sent']
+            yield "dvr_datagrams_dropped_total", "counter", "Datagramas não repassados aos DVRs", labels, target['dropped']
+            yield "dvr_send_errors_total", "counter", "Erros de envio aos DVRs", labels, target['errors']
+        
+        depth = sum(len(sender.queue) for sender in self.pdv_senders.values())
+        yield "pdv_ws_clients", "gauge", "Clientes WebSocket do PDV conectados", {}, len(self.pdv_senders)
+        yield "pdv_ws_queue_depth", "gauge", "Mensagens aguardando envio aos clientes PDV", {}, depth
+        dropped = self.pdv_client_stats['dropped'] + sum(sender.dropped for sender in self.pdv_senders.values())
+        yield "pdv_ws_dropped_total", "counter", "Mensagens descartadas por clientes lentos", {}, dropped
+        
+        yield "pdv_timeout_alerts_total", "counter", "Alertas de inatividade disparados", {}, self.pdv_monitor.alerts_fired
+        
+        if self.pdv_journal:
+            journal = self.pdv_journal
+            yield "pdv_journal_records_total", "counter", "Datagramas gravados no diário", {}, journal.records
+            yield "pdv_journal_writes_total", "counter", "Escritas em lote no diário", {}, journal.writes
+            yield "pdv_journal_fsyncs_total", "counter", "fsyncs em grupo do diário", {}, journal.fsyncs
+            yield "pdv_journal_errors_total", "counter", "Erros de gravação do diário", {}, journal.errors
+            yield "pdv_journal_backlog_batches", "gauge", "Lotes aguardando gravação no diário", {}, journal.backlog()
+            yield "pdv_journal_dropped_batches_total", "counter", "Lotes descartados com a fila do diário cheia", {}, journal.dropped_batches
+        if not self.video_enabled:
+            return
+        
+        yield "webrtc_peer_connections", "gauge", "Conexões WebRTC ativas", {}, len(self.webrtc_conversions)
+        yield "mosaic_viewers", "gauge", "Visualizadores de mosaico conectados", {}, len(self.mosaic_sessions)
+        
+        if self.decoder_pool:
+            yield "decoder_worker_restarts_total", "counter", "Processos decodificadores reiniciados após morrer", {}, self.decoder_pool.worker_restarts
+        
+        if self.clip_recorder:
+            yield "clip_buffer_bytes", "gauge", "Memória dos buffers pré-evento das câmeras", {}, self.clip_recorder.memory_bytes()
+            yield "clips_written_total", "counter", "Clipes pré-evento gravados", {}, self.clip_recorder.clips_written
+        
+        for rtsp_urls, mosaic in list(MosaicStream._instances.items()):
+            labels = {"layout": ','.join(url_label(rtsp_url) for rtsp_url in rtsp_urls)}
+            yield "mosaic_frames_encoded_total", "counter", "Frames do mosaico codificados (um encode para todos os visualizadores)", labels, mosaic.frames_encoded
+            yield "mosaic_bytes_encoded_total", "counter", "Bytes VP8 gerados pelo mosaico", labels, mosaic.bytes_encoded
+        
+        for rtsp_url, pipeline in list(VideoPipeline._instances.items()):
+            camera = url_label(rtsp_url)
+            labels = {"camera": camera}
+            grabber = pipeline.frame_grabber
+            if grabber:
+                yield "camera_frames_decoded_total", "counter", "Frames decodificados por câmera", labels, grabber.frame_count
+                yield "camera_frames_skipped_total", "counter", "Frames descartados sem decodificar", labels, grabber.frames_skipped
+                yield "camera_reconnects_total", "counter", "Reconexões RTSP", labels, grabber.rtsp_connection.reconnect_count
+            for preset, (output, track) in list(pipeline.outputs.items()):
+                labels = {"camera": camera, "preset": preset}
+                yield "camera_frames_sent_total", "counter", "Frames entregues aos encoders", labels, track.frames_sent
+                motion_gate = getattr(output, 'motion_gate', None)
+                if motion_gate:
+                    yield "camera_frames_gated_total", "counter", "Frames descartados com a cena parada", labels, motion_gate.frames_gated
+                output_queue = getattr(output, 'queue', None)
+                if output_queue is not None:
+                    yield "camera_output_queue_depth", "gauge", "Frames aguardando na fila da saída", labels, output_queue.qsize()
+
+    def on_transaction_change(self, pdv_ip, active):
+        """Transação iniciada/finalizada: a câmera da pista ('rtsp_url' do config.json) segue em taxa cheia enquanto ativa"""
+        rtsp_url = self.pdv_ip_to_config.get(pdv_ip, {}).get('rtsp_url')
+        if rtsp_url and self.video_enabled:
+            VideoPipeline.set_lane_active(rtsp_url, active)
+
+    def on_pdv_timeout(self, pdv_ip, inactive_time):
+        """Alerta de inatividade: grava em segundo plano o buffer pré-evento da câmera da pista"""
+        rtsp_url = self.pdv_ip_to_config.get(pdv_ip, {}).get('rtsp_url')
+        if self.clip_recorder and rtsp_url:
+            asyncio.ensure_future(self.clip_recorder.export(rtsp_url, pdv_ip))
+
+    def report_pdv_clients(self):
+        """Imprime as métricas das filas de saída dos clientes PDV"""
+        stats = dict(self.pdv_client_stats)
+        depth = 0
+        max_depth = 0
+        for sender in self.pdv_senders.values():
+            stats['sent'] += sender.sent
+            stats['dropped'] += sender.dropped
+            stats['coalesced'] += sender.coalesced
+            depth += len(sender.queue)
+            max_depth = max(max_depth, sender.max_depth)
+        print(f"[PDV-WS] clientes {len(self.pdv_senders)}, enviadas {stats['sent']}, descartadas {stats['dropped']}, "
+              f"agrupadas {stats['coalesced']}, na fila {depth} (máx {max_depth}), "
+              f"desconectados por lentidão {stats['slow_disconnects']}, por keepalive {stats['keepalive_evictions']}")
+
+    def send_pdv_history(self, sender, pdv_ip):
+        """Envia ao cliente recém-registrado, em um único frame, as últimas linhas do PDV"""
+        if not self.pdv_history:
+            return
+        
+        lines = self.pdv_history.lines(pdv_ip)
+        timestamps = self.pdv_history.timestamps(pdv_ip)
+        
+        # As linhas ainda pendentes no lote chegarão pelo próximo pdv_batch (o histórico não
+        # guarda as linhas vazias, que o lote repassa)
+        batcher = self.pdv_batchers.get(pdv_ip)
+        if sender.batch and batcher and batcher.lines:
+            pending = sum(1 for line in batcher.lines if line)
+            keep = max(0, len(lines) - pending)
+            lines = lines[:keep]
+            timestamps = timestamps[:keep]
+        
+        if lines:
+            sender.enqueue(json.dumps({
+                "type": "pdv_history",
+                "pdv_ip": pdv_ip,
+                "lines": lines,
+                # Horário de chegada de cada linha (epoch, ms)
+                "timestamps": [int(timestamp * 1000) for timestamp in timestamps]
+            }))
 
     async def pdv_websocket_handler(self, websocket):
         """Manipula as conexões WebSocket para o serviço PDV"""
+        sender = ClientSender(websocket, max_queue=self.client_queue_size, policy=self.slow_client_policy)
+        self.pdv_senders[websocket] = sender
         try:
             async for message in websocket:
                 data = json.loads(message)
                 command = data.get("command")
                 
+                # Uma pista ("pdv_ip"), várias ("pdv_ips") ou todas ("pdv_ip": "*")
+                pdv_ips = data.get("pdv_ips") or [data.get("pdv_ip")]
+                
                 if command == "register":
-                    pdv_ip = data.get("pdv_ip")
-                    success = await self.register_pdv_client(websocket, pdv_ip)
-                    
-                    response = {
-                        "type": "register_response",
-                        "success": success,
-                        "pdv_ip": pdv_ip
-                    }
-                    await websocket.send(json.dumps(response))
+                    batch = bool(data.get("batch"))
+                    for pdv_ip in pdv_ips:
+                        success = await self.register_pdv_client(websocket, pdv_ip, batch)
+                        
+                        response = {
+                            "type": "register_response",
+                            "success": success,
+                            "pdv_ip": pdv_ip
+                        }
+                        if batch:
+                            # Confirma o modo lote e informa a janela usada pelo servidor
+                            response["batch"] = {
+                                "window_ms": self.batch_window_ms,
+                                "max_lines": self.batch_max_lines
+                            }
+                        sender.enqueue(json.dumps(response))
+                        
+                        if success:
+                            for history_ip in (self.pdv_ip_to_config if pdv_ip == ALL_LANES else (pdv_ip,)):
+                                self.send_pdv_history(sender, history_ip)
+                
+                elif command == "unregister":
+                    for pdv_ip in pdv_ips:
+                        success = self.pdv_subscriptions.unsubscribe(sender, pdv_ip)
+                        if success:
+                            self.refresh_pdv_batchers((pdv_ip,))
+                            print(f"Cliente WebSocket removido do PDV {pdv_ip}")
+                        sender.enqueue(json.dumps({
+                            "type": "unregister_response",
+                            "success": success,
+                            "pdv_ip": pdv_ip
+                        }))
         except websockets.exceptions.ConnectionClosed:
             pass
         finally:
@@ -181,29 +735,31 @@ class UnifiedServer:
                 print(f"Erro ao limpar conversão WebRTC para {conversion_key}: {e}")
                 self.webrtc_conversions.pop(conversion_key, None)
         
-    async def get_or_create_webrtc_conversion(self, rtsp_url, session_id, quality_preset="medium"):
-        """Cria sempre uma nova conversão para cada sessão com qualidade ajustável"""
+    def warm_up_cameras(self, configs):
+        """
+        Abre em segundo plano as câmeras das pistas e as mantém abertas sem visualizadores: a
+        ingestão dos PDVs não espera pelas câmeras, e uma câmera fora do ar não atrasa as outras
+        """
+        for config in configs:
+            rtsp_url = config.get('rtsp_url')
+            if rtsp_url:
+                asyncio.ensure_future(self.warm_camera(rtsp_url, config.get('pdv_ip')))
+        
+    async def warm_camera(self, rtsp_url, pdv_ip):
+        try:
+            await VideoPipeline.get_instance(rtsp_url).keep_warm()
+            print(f"Câmera {rtsp_url} mantida aberta para o PDV {pdv_ip}")
+        except Exception as e:
+            print(f"Erro ao abrir câmera {rtsp_url}: {e}")
+        
+    async def get_or_create_webrtc_conversion(self, rtsp_url, session_id, quality_preset=None, on_camera_state=None):
+        """Cria uma nova sessão WebRTC, assinando o preset no pipeline compartilhado da câmera"""
+        quality_preset = quality_preset or DEFAULT_QUALITY_PRESET
         try:
             conversion_key = f"{rtsp_url}_{session_id}"
             
-            # Definir presets de qualidade
-            quality_presets = {
-                "low": {"downscale_factor": 4.5, "frame_skip": 2, "quality_reduce": 85},
-                "medium-low": {"downscale_factor": 3.7, "frame_skip": 1, "quality_reduce": 80},
-                "medium": {"downscale_factor": 2.5, "frame_skip": 1, "quality_reduce": 60},
-                "high": {"downscale_factor": 1.5, "frame_skip": 1, "quality_reduce": 30}
-            }
-            
-            # Obter configurações do preset selecionado (ou usar medium-low como padrão se não existir)
-            preset = quality_presets.get(quality_preset, quality_presets["medium-low"])
-            
             print(f"Criando nova conversão WebRTC para {rtsp_url} (Sessão: {session_id}, Qualidade: {quality_preset})")
-            conversion = WebRTCConversion.get_instance(
-                rtsp_url, 
-                downscale_factor=preset["downscale_factor"], 
-                frame_skip=preset["frame_skip"], 
-                quality_reduce=preset["quality_reduce"]
-            )
+            conversion = WebRTCConversion(quality_preset=quality_preset, on_camera_state=on_camera_state)
             
             await conversion.connect(rtsp_url)
             
@@ -218,12 +774,25 @@ class UnifiedServer:
         rtsp_url = None
         session_id = f"{id(websocket)}_{time.time()}"
         conversion_key = None
-        quality_preset = "medium-low"
+        quality_preset = DEFAULT_QUALITY_PRESET
         
         await self.register_rtsp_client(websocket)
         
+        def notify_camera_state(state):
+            # Informa o navegador sobre quedas e reconexões da câmera
+            message = json.dumps({"type": "camera_state", "rtsp_url": rtsp_url, "state": state})
+            asyncio.ensure_future(websocket.send(message))
+        
         try:
             rtsp_url = await websocket.recv()
+            
+            if rtsp_url.startswith('{"mosaic":'):
+                # Mosaico: {"mosaic": [url1, url2, ...]} em vez de uma única URL RTSP
+                rtsp_urls = json.loads(rtsp_url)['mosaic']
+                rtsp_url = None
+                await self.mosaic_session(websocket, rtsp_urls, session_id)
+                return
+            
             print(f"Recebida URL RTSP: {rtsp_url} (Sessão: {session_id})")
             
             try:
@@ -241,7 +810,7 @@ class UnifiedServer:
             self.rtsp_client_count[rtsp_url] = self.rtsp_client_count.get(rtsp_url, 0) + 1
             print(f"Clientes conectados para URL {rtsp_url}: {self.rtsp_client_count[rtsp_url]}")
             
-            webrtc_conversion, conversion_key = await self.get_or_create_webrtc_conversion(rtsp_url, session_id, quality_preset)
+            webrtc_conversion, conversion_key = await self.get_or_create_webrtc_conversion(rtsp_url, session_id, quality_preset, notify_camera_state)
                     
             offer = await webrtc_conversion.create_offer()
             
@@ -268,10 +837,14 @@ class UnifiedServer:
                                 new_quality = quality_json['change_quality']
                                 print(f"Alterando qualidade para: {new_quality} (Sessão: {session_id})")
                                 
-                                if conversion_key in self.webrtc_conversions:
-                                    await self.cleanup_conversion(conversion_key)
+                                # Assina o novo preset antes de liberar o anterior, para que o
+                                # pipeline da câmera não seja encerrado e reaberto na troca
+                                old_conversion = self.webrtc_conversions.pop(conversion_key, None)
                                 
-                                webrtc_conversion, conversion_key = await self.get_or_create_webrtc_conversion(rtsp_url, session_id, new_quality)
+                                webrtc_conversion, conversion_key = await self.get_or_create_webrtc_conversion(rtsp_url, session_id, new_quality, notify_camera_state)
+                                
+                                if old_conversion:
+                                    await old_conversion.close()
                                 
                                 offer = await webrtc_conversion.create_offer()
                                 offer_dict = {"sdp": offer.sdp, "type": offer.type}
@@ -306,11 +879,38 @@ class UnifiedServer:
                 except Exception as e:
                     print(f"Erro ao decrementar contador RTSP para {rtsp_url}: {e} (Sessão: {session_id})")
 
+    async def mosaic_session(self, websocket, rtsp_urls, session_id):
+        """Negocia um visualizador do mosaico das câmeras e o mantém até o cliente sair"""
+        print(f"Recebido pedido de mosaico: {', '.join(rtsp_urls)} (Sessão: {session_id})")
+        session = MosaicSession(rtsp_urls)
+        self.mosaic_sessions[session_id] = session
+        try:
+            await session.connect()
+            
+            offer = await session.create_offer()
+            await websocket.send(json.dumps({"sdp": offer.sdp, "type": offer.type}))
+            
+            answer_dict = json.loads(await websocket.recv())
+            await session.process_answer(RTCSessionDescription(sdp=answer_dict["sdp"], type=answer_dict["type"]))
+            print(f"Conexão WebRTC de mosaico estabelecida (Sessão: {session_id})")
+            
+            while True:
+                try:
+                    message = await websocket.recv()
+                    if message == "CLOSE":
+                        break
+                except websockets.exceptions.ConnectionClosed:
+                    print(f"Conexão de mosaico fechada (Sessão: {session_id})")
+                    break
+        finally:
+            self.mosaic_sessions.pop(session_id, None)
+            await session.close()
+
     async def listen_pdv_socket(self, pdv_key, pdv_socket_data):
         """
-        Escuta em um socket específico de um PDV e processa as mensagens
+        Escuta em um socket específico de um PDV e processa as mensagens.
+        Os datagramas chegam em lotes do PDVIngest, que esvazia o socket a cada despertar
         """
-        loop = asyncio.get_running_loop()
         pdv_socket = pdv_socket_data['socket']
         pdv_ip = pdv_socket_data['pdv_ip']
         pdv_port = pdv_socket_data['pdv_port']
@@ -320,110 +920,243 @@ class UnifiedServer:
         dvr_port = config.get('dvr_port')
 
         dvr_key = f"{pdv_ip}_{dvr_ip}:{dvr_port}"
+        if dvr_key not in self.dvr_sockets:
+            print(f"Socket DVR não encontrado para {dvr_key}")
         
+        def on_batch(batch):
+            if LOG_PDV_RECV.enabled():
+                for data, addr in batch:
+                    LOG_PDV_RECV(pdv=f"{addr[0]}:{addr[1]}", bytes=len(data), dvr=dvr_key)
+            
+            # Repasse ao DVR e gravação no diário na leitura do lote, antes e independentes do processamento abaixo
+            self.dvr_forwarder.forward(dvr_key, batch)
+            if self.pdv_journal:
+                self.pdv_journal.append_batch(batch)
+        
+        batches = self.pdv_ingest.add_socket(pdv_key, pdv_socket, on_batch=on_batch)
         print(f"Iniciando escuta para PDV {pdv_ip}:{pdv_port}")
         
+        parse_seconds = PDV_PARSE_SECONDS.labels(pdv_ip)
+        perf_counter = time.perf_counter
+        
         while True:
-            try:
-                data, addr = await loop.sock_recvfrom(pdv_socket, 1024)
-                client_ip = addr[0]
-                client_port = addr[1]
-                
-                if data:
-                    print(f"[PDV-RECV] Recebido {len(data)} bytes de {client_ip}:{client_port}")
+            batch = await batches.get()
+            received_at = time.time()
+            
+            for data, addr in batch:
+                try:
+                    client_ip = addr[0]
+                    
+                    if not data:
+                        continue
                     
-                    try:
-                        # Usa o socket específico vinculado à porta de origem correta para este PDV
-                        if dvr_key in self.dvr_sockets:
-                            dvr_socket = self.dvr_sockets[dvr_key]['socket']
-                            origin_port = self.dvr_sockets[dvr_key]['origin_port']
-                            dvr_socket.sendto(data, (dvr_ip, int(dvr_port)))
-                            print(f"[DVR-SEND] Enviado de {client_ip}:{client_port} (origem: porta {origin_port}) para {dvr_ip}:{dvr_port}")
-                        else:
-                            print(f"Socket DVR não encontrado para {dvr_key}")
-                    except Exception as e:
-                        print(f"Erro ao redirecionar para DVR: {e}")
-                        
                     raw_message = data.decode('utf-8', 'ignore')
-                    processed_message = process_message(raw_message, client_ip)
+                    # Uma única classificação da linha serve à exibição e ao monitor de transações
+                    parse_start = perf_counter()
+                    event = parse_line(raw_message)
+                    parse_seconds.observe(perf_counter() - parse_start)
+                    processed_message = event.text
                     
-                    self.pdv_monitor.process_pdv_message(
-                        raw_message, 
-                        client_ip, 
-                        pdv_clients, 
-                        loop
-                    )
+                    if self.pdv_history:
+                        self.pdv_history.append(client_ip, processed_message, received_at)
                     
-                    if client_ip in pdv_clients:
+                    self.pdv_monitor.process_pdv_event(event, client_ip)
+                    
+                    # Tuplas prontas do registro: nenhuma cópia de conjunto por datagrama
+                    _, line_clients, batch_clients = self.pdv_subscriptions.subscribers(client_ip)
+                    
+                    # Clientes em modo lote recebem a linha no próximo pdv_batch
+                    if batch_clients:
+                        batcher = self.pdv_batchers.get(client_ip)
+                        if batcher is None:
+                            batcher = self.pdv_batchers[client_ip] = PDVBatcher(client_ip, self.batch_window_ms, self.batch_max_lines)
+                        batcher.clients = batch_clients
+                        batcher.add(processed_message)
+                    
+                    if line_clients:
                         message_to_send = json.dumps({
                             "type": "pdv_data",
                             "pdv_ip": client_ip,
                             "data": processed_message
                         })
                         
-                        for client in pdv_clients[client_ip]:
-                            try:
-                                await client.send(message_to_send)
-                            except websockets.exceptions.ConnectionClosed:
-                                pass
-            except BlockingIOError:
-                await asyncio.sleep(0.01)
-            except Exception as e:
-                print(f"Erro ao processar dados do PDV {pdv_ip}:{pdv_port}: {e}")
-                await asyncio.sleep(0.1)
+                        # Apenas enfileira: cada cliente tem sua própria tarefa escritora
+                        for sender in line_clients:
+                            sender.enqueue(message_to_send, client_ip, processed_message)
+                except Exception as e:
+                    print(f"Erro ao processar dados do PDV {pdv_ip}:{pdv_port}: {e}")
 
     async def cleanup_stale_connections(self):
         """Limpa conexões obsoletas periodicamente"""
         while True:
             try:
                 await asyncio.sleep(60)
+                
+                self.dvr_forwarder.report()
+                self.report_pdv_clients()
                     
             except Exception as e:
                 print(f"Erro na limpeza de conexões: {e}")
                 await asyncio.sleep(60)
 
     async def start(self):
-        logging.basicConfig(level=logging.INFO)
         
         success = self.load_config()
         if not success:
             print("AVISO: Não foi possível carregar a configuração. O servidor continuará com configuração vazia.")
         
-        self.setup_pdv_sockets()
+        if self.pdv_enabled:
+            self.setup_pdv_sockets()
+            
+            self.setup_dvr_sockets()
+        
+        if self.video_enabled:
+            VideoPipeline.live_mode = self.live_video
+            VideoPipeline.motion_gating = self.motion_gating
+            
+            if self.decoder_processes > 0:
+                from decoder_pool import DecoderPool
+                
+                self.decoder_pool = DecoderPool(self.decoder_processes)
+                self.decoder_pool.on_camera_state = VideoPipeline.dispatch_camera_state
+                self.decoder_pool.start()
+                VideoPipeline.decoder_pool = self.decoder_pool
+            
         
-        self.setup_dvr_sockets()
+        websocket_servers = []
+        if self.unix_socket_dir:
+            # Atrás do roteador local: o ping e a compressão ficam na conexão com o navegador
+            pdv_path, rtsp_path = worker_socket_paths(self.unix_socket_dir, self.shard_index)
+            if self.pdv_enabled:
+                websocket_servers.append(await websockets.unix_serve(
+                    self.pdv_websocket_handler, pdv_path, ping_interval=None, compression=None))
+                print(f"Worker {self.shard_index}: WebSocket PDV em {pdv_path}")
+            if self.video_enabled:
+                websocket_servers.append(await websockets.unix_serve(
+                    self.rtsp_websocket_handler, rtsp_path, ping_interval=None, compression=None))
+                print(f"Worker {self.shard_index}: WebSocket RTSP em {rtsp_path}")
+        else:
+            if self.pdv_enabled:
+                websocket_servers.append(await websockets.serve(
+                    self.pdv_websocket_handler, 
+                    "0.0.0.0", 
+                    self.ws_port,
+                    ping_interval=self.ws_ping_interval or None,
+                    ping_timeout=self.ws_ping_interval or None,
+                    compression="deflate" if self.ws_compression else None
+                ))
+                print(f"Servidor WebSocket PDV iniciado em 0.0.0.0:{self.ws_port}")
+            
+            if self.video_enabled:
+                websocket_servers.append(await websockets.serve(
+                    self.rtsp_websocket_handler,
+                    "0.0.0.0", 
+                    self.rtsp_ws_port
+                ))
+                print(f"Servidor WebSocket RTSP iniciado em 0.0.0.0:{self.rtsp_ws_port}")
         
-        pdv_websocket_server = await websockets.serve(
-            self.pdv_websocket_handler, 
-            "0.0.0.0", 
-            self.ws_port,
-            ping_interval=None
-        )
-        print(f"Servidor WebSocket PDV iniciado em 0.0.0.0:{self.ws_port}")
+        for pdv_key in list(self.pdv_listen_sockets):
+            self.start_pdv_listener(pdv_key)
         
-        rtsp_websocket_server = await websockets.serve(
-            self.rtsp_websocket_handler,
-            "0.0.0.0", 
-            self.rtsp_ws_port
-        )
-        print(f"Servidor WebSocket RTSP iniciado em 0.0.0.0:{self.rtsp_ws_port}")
+        # systemctl reload (SIGHUP): recarrega o config.json sem derrubar conexões
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGHUP, lambda: asyncio.ensure_future(self.reload_config()))
         
-        pdv_listen_tasks = []
-        for pdv_key, pdv_socket_data in self.pdv_listen_sockets.items():
-            task = asyncio.create_task(self.listen_pdv_socket(pdv_key, pdv_socket_data))
-            pdv_listen_tasks.append(task)
+        # systemctl stop / supervisor (SIGTERM): o start() termina normalmente e quem o chamou faz o shutdown()
+        main_task = asyncio.current_task()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, main_task.cancel)
             
+        if self.pdv_journal:
+            self.pdv_journal.start()
+        
+        if self.metrics_port:
+            await start_metrics_server(self.metrics_port)
+        
         cleanup_task = asyncio.create_task(self.cleanup_stale_connections())
         
+        background_tasks = [cleanup_task]
+        if self.pdv_enabled:
+            # Agendador único dos timeouts de inatividade de todos os PDVs
+            background_tasks.append(asyncio.create_task(self.pdv_monitor.run_timeout_scheduler(self.pdv_subscriptions)))
+        
+        if self.video_enabled and self.warm_cameras:
+            self.warm_up_cameras(self.selfs_config)
+        if self.clip_recorder:
+            # Como as câmeras quentes, fora do caminho de inicialização da ingestão
+            asyncio.ensure_future(self.clip_recorder.start([config['rtsp_url'] for config in self.pdv_ip_to_config.values()
+                                                            if config.get('rtsp_url')]))
+        
+        self.report_startup()
         print("Todos os servidores iniciados. Pressione Ctrl+C para sair.")
-        print("Escutando em portas específicas para cada PDV configurado.")
+        if self.pdv_enabled:
+            print("Escutando em portas específicas para cada PDV configurado.")
+
+        try:
+            await asyncio.gather(
+                *(server.wait_closed() for server in websocket_servers),
+                *background_tasks
+            )
+        except asyncio.CancelledError:
+            print("Servidor finalizado (SIGTERM)")
+        
+    def report_startup(self):
+        """Imprime o tempo de importação dos módulos e o tempo, desde o início das importações, até os servidores ficarem prontos"""
+        ready_seconds = time.perf_counter() - IMPORT_START
+        # ru_maxrss em KB no Linux
+        rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        video = f", vídeo {self.video_import_seconds * 1000:.0f} ms" if self.video_enabled else " (vídeo não carregado)"
+        loop_name = type(asyncio.get_running_loop()).__module__.split('.')[0]
+        print(f"Inicialização no modo {self.mode} (loop {loop_name}): importações {IMPORT_SECONDS * 1000:.0f} ms{video}, "
+              f"pronto em {ready_seconds * 1000:.0f} ms, memória {rss_mb:.0f} MB")
+        
+    def shutdown(self):
+        """Fecha os sockets dos PDVs/DVRs e encerra os processos e threads auxiliares"""
+        for config in self.pdv_listen_sockets.values():
+            if 'socket' in config:
+                config['socket'].close()
+        for config in self.dvr_sockets.values():
+            if 'socket' in config:
+                config['socket'].close()
+        if self.decoder_pool:
+            self.decoder_pool.stop()
+        if self.pdv_journal:
+            self.pdv_journal.stop()
 
-        await asyncio.gather(
-            pdv_websocket_server.wait_closed(),
-            rtsp_websocket_server.wait_closed(),
-            cleanup_task,
-            *pdv_listen_tasks
-        )
+def run_event_loop(main_coroutine, event_loop=LOOP_ASYNCIO):
+    """asyncio.run no loop escolhido; sem o uvloop instalado, usa o loop padrão do asyncio"""
+    if event_loop == LOOP_UVLOOP:
+        try:
+            import uvloop
+        except ImportError:
+            print("AVISO: uvloop não instalado (pip install uvloop); usando o loop padrão do asyncio")
+        else:
+            with asyncio.Runner(loop_factory=uvloop.new_event_loop) as runner:
+                return runner.run(main_coroutine)
+    return asyncio.run(main_coroutine)
+
+def exit_on_sigterm():
+    """SIGTERM antes de o start() instalar o seu tratador no loop sai pelo SystemExit, passando pelo shutdown() no finally"""
+    def terminate(signum, frame):
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, terminate)
+
+def run_worker(server_kwargs, log_level, event_loop=LOOP_ASYNCIO):
+    """Processo de trabalho do modo supervisor: um UnifiedServer com as pistas do seu shard"""
+    setup_logging(log_level)
+    
+    # O supervisor encerra os workers com SIGTERM: fecha os sockets e o diário antes de sair
+    exit_on_sigterm()
+    
+    # Um SIGHUP repassado pelo supervisor antes de o servidor instalar o seu tratador não encerra o worker
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    
+    unified_server = UnifiedServer(**server_kwargs)
+    try:
+        run_event_loop(unified_server.start(), event_loop)
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        unified_server.shutdown()
 
 def main():
     parser = argparse.ArgumentParser(description='Servidor Unificado: PDV + RTSP/WebRTC')
@@ -431,25 +1164,95 @@ def main():
     parser.add_argument('--rtsp-ws-port', type=int, default=8080, help='Porta do servidor WebSocket para RTSP')
     parser.add_argument('--pdv-timeout', type=int, default=180, help='Tempo (em segundos) para timeout de inatividade do PDV')
     parser.add_argument('--config', type=str, default='./config.json', help='Caminho para o arquivo de configuração')
+    parser.add_argument('--decoder-processes', type=int, default=0, help='Quantidade de processos para decodificar o RTSP fora do processo principal (0 = threads no próprio processo)')
+    parser.add_argument('--live-video', action='store_true', help='Modo de vídeo de baixa latência: entrega sempre o frame mais recente, descartando os atrasados')
+    parser.add_argument('--warm-cameras', action='store_true', help="Mantém abertas as câmeras com 'rtsp_url' no config.json, para troca de quadrante imediata")
+    parser.add_argument('--pdv-buffer-size', type=int, default=MAX_DATAGRAM_SIZE, help='Tamanho máximo (bytes) de um datagrama recebido dos PDVs')
+    parser.add_argument('--client-queue-size', type=int, default=DEFAULT_CLIENT_QUEUE_SIZE, help='Mensagens pendentes por cliente WebSocket do PDV antes de aplicar a política de cliente lento')
+    parser.add_argument('--slow-client-policy', type=str, default=POLICY_DROP_OLDEST, choices=SLOW_CLIENT_POLICIES, help='O que fazer quando a fila de um cliente lento enche')
+    parser.add_argument('--ws-ping-interval', type=int, default=20, help='Intervalo (s) de ping do WebSocket PDV para detectar clientes mortos (0 = desativado)')
+    parser.add_argument('--pdv-batch-window-ms', type=int, default=DEFAULT_BATCH_WINDOW_MS, help='Janela (ms) de agrupamento de pdv_data para clientes em modo lote')
+    parser.add_argument('--pdv-batch-max-lines', type=int, default=DEFAULT_BATCH_MAX_LINES, help='Máximo de linhas por lote pdv_batch')
+    parser.add_argument('--no-ws-compression', action='store_true', help='Desativa a compressão permessage-deflate no WebSocket PDV')
+    parser.add_argument('--pdv-history-lines', type=int, default=DEFAULT_HISTORY_LINES, help='Linhas recentes guardadas por PDV e enviadas no registro (0 = desativado)')
+    parser.add_argument('--pdv-history-memory-mb', type=float, default=DEFAULT_HISTORY_MEMORY_MB, help='Memória máxima (MB) do histórico somando todos os PDVs')
+    parser.add_argument('--journal-dir', type=str, default=None, help='Diretório do diário em disco do tráfego dos PDVs (desativado se omitido)')
+    parser.add_argument('--journal-fsync-interval', type=float, default=DEFAULT_FSYNC_INTERVAL, help='Intervalo máximo (s) entre fsyncs do diário')
+    parser.add_argument('--journal-max-backlog', type=int, default=DEFAULT_MAX_BACKLOG_BATCHES, help='Máximo de lotes aguardando gravação no diário; os excedentes são descartados')
+    parser.add_argument('--metrics-port', type=int, default=0, help='Porta local (127.0.0.1) do endpoint HTTP /metrics (0 = desativado)')
+    parser.add_argument('--motion-gating', action='store_true', help='Reduz para ~1 fps as câmeras sem movimento e sem transação ativa na pista')
+    parser.add_argument('--clip-dir', type=str, default=None, help="Diretório dos clipes pré-evento gravados nos alertas de inatividade (desativado se omitido; câmera pelo 'rtsp_url' do config.json)")
+    parser.add_argument('--clip-seconds', type=float, default=DEFAULT_CLIP_SECONDS, help='Segundos de vídeo guardados por câmera antes do alerta')
+    parser.add_argument('--clip-fps', type=float, default=DEFAULT_CLIP_FPS, help='Frames por segundo do buffer pré-evento')
+    parser.add_argument('--clip-width', type=int, default=DEFAULT_CLIP_WIDTH, help='Largura (px) dos frames do buffer pré-evento')
+    parser.add_argument('--clip-jpeg-quality', type=int, default=DEFAULT_CLIP_JPEG_QUALITY, help='Qualidade JPEG (0-100) dos frames do buffer pré-evento')
+    parser.add_argument('--clip-memory-mb', type=float, default=DEFAULT_CLIP_MEMORY_MB, help='Memória máxima (MB) dos buffers pré-evento, dividida entre as câmeras; ao estourar, descarta os frames mais antigos')
+    parser.add_argument('--workers', type=int, default=1, help='Processos de trabalho; acima de 1, as pistas do config.json são divididas entre eles e um roteador local atende as portas WebSocket')
+    parser.add_argument('--mode', type=str, default=MODE_ALL, choices=RUN_MODES, help='pdv: só o repasse dos PDVs aos DVRs e o WebSocket PDV, sem importar as bibliotecas de vídeo; video: só o WebSocket RTSP e as câmeras; all: os dois')
+    parser.add_argument('--event-loop', type=str, default=LOOP_ASYNCIO, choices=EVENT_LOOPS, help='Loop de eventos; uvloop é opcional e, se não estiver instalado, o servidor usa o do asyncio')
+    parser.add_argument('--pdv-rcvbuf', type=int, default=0, help='SO_RCVBUF (bytes) dos sockets dos PDVs, para absorver picos de várias pistas (0 = padrão do kernel; limitado por net.core.rmem_max)')
+    parser.add_argument('--dvr-sndbuf', type=int, default=0, help='SO_SNDBUF (bytes) dos sockets de envio aos DVRs (0 = padrão do kernel; limitado por net.core.wmem_max)')
+    parser.add_argument('--reuseport', action='store_true', help='SO_REUSEPORT nos sockets dos PDVs e DVRs: um novo processo vincula as portas antes de o anterior soltá-las')
+    parser.add_argument('--log-level', type=str, default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], help='Nível de log; DEBUG inclui o log amostrado por datagrama')
     args = parser.parse_args()
     
-    unified_server = UnifiedServer(
+    setup_logging(args.log_level)
+    
+    server_kwargs = dict(
         ws_port=args.ws_port,
         rtsp_ws_port=args.rtsp_ws_port,
         pdv_timeout=args.pdv_timeout,
-        config_path=args.config
+        config_path=args.config,
+        decoder_processes=args.decoder_processes,
+        live_video=args.live_video,
+        warm_cameras=args.warm_cameras,
+        pdv_buffer_size=args.pdv_buffer_size,
+        client_queue_size=args.client_queue_size,
+        slow_client_policy=args.slow_client_policy,
+        ws_ping_interval=args.ws_ping_interval,
+        batch_window_ms=args.pdv_batch_window_ms,
+        batch_max_lines=args.pdv_batch_max_lines,
+        ws_compression=not args.no_ws_compression,
+        history_lines=args.pdv_history_lines,
+        history_memory_mb=args.pdv_history_memory_mb,
+        journal_dir=args.journal_dir,
+        journal_fsync_interval=args.journal_fsync_interval,
+        journal_max_backlog=args.journal_max_backlog,
+        metrics_port=args.metrics_port,
+        motion_gating=args.motion_gating,
+        clip_dir=args.clip_dir,
+        clip_seconds=args.clip_seconds,
+        clip_fps=args.clip_fps,
+        clip_width=args.clip_width,
+        clip_jpeg_quality=args.clip_jpeg_quality,
+        clip_memory_mb=args.clip_memory_mb,
+        mode=args.mode,
+        pdv_rcvbuf=args.pdv_rcvbuf,
+        dvr_sndbuf=args.dvr_sndbuf,
+        reuseport=args.reuseport
     )
     
+    if args.workers > 1:
+        supervisor = Supervisor(args.workers, run_worker, server_kwargs, log_level=args.log_level,
+                                event_loop=args.event_loop)
+        try:
+            run_event_loop(supervisor.run(), args.event_loop)
+        except KeyboardInterrupt:
+            print("Servidor finalizado pelo usuário")
+        finally:
+            supervisor.stop()
+        return
+    
+    unified_server = UnifiedServer(**server_kwargs)
+    
+    # systemctl stop: fecha os sockets e grava o diário pendente, como no Ctrl+C
+    exit_on_sigterm()
     try:
-        asyncio.run(unified_server.start())
+        run_event_loop(unified_server.start(), args.event_loop)
     except KeyboardInterrupt:
         print("Servidor finalizado pelo usuário")
-        for config in unified_server.pdv_listen_sockets.values():
-            if 'socket' in config:
-                config['socket'].close()
-        for config in unified_server.dvr_sockets.values():
-            if 'socket' in config:
-                config['socket'].close()
+    finally:
+        unified_server.shutdown()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,50 +1,133 @@
 import re
 
+# Tipos de evento de uma linha do PDV
+EVENT_HEADER = "header"          # *PDV ... *Trans: ... *Atend: (início de transação)
+EVENT_ITEM = "item"              # produto registrado (código de barras, Produto/Item)
+EVENT_TOTAL = "total"            # TOTAL R$ ...
+EVENT_PAYMENT = "payment"        # Pagamento
+EVENT_DRAWER = "drawer"          # Abertura de Gaveta
+EVENT_REPORT = "report"          # Relatorio Gerencial
+EVENT_SEPARATOR = "separator"    # linhas só de pontos/asteriscos
+EVENT_TEXT = "text"              # qualquer outra linha
+
+# Sequências de caracteres de formatação repetidos (só usadas se a linha as contiver)
+_RUNS_RE = re.compile(r'\*{3,}|\^{2,}|\.{5,}|={5,}|-{5,}')
+_SPACES_RE = re.compile(r' {2,}')
+
+# Linhas de separação: horário seguido só de pontos ou só de asteriscos
+_SEPARATOR_RE = re.compile(r'\[[\d:]+\]\s*(?:\.+|\*+)$')
+
+# Código de barras: qualquer sequência de 8 a 13 dígitos na linha (também dentro de números maiores)
+_BARCODE_RE = re.compile(r'\d{8,13}')
+
+# Marcadores do cabeçalho de transação, exibidos sem o asterisco
+_HEADER_MARKERS = ('*PDV', '*Trans:', '*Atend:')
+
+class PDVEvent:
+    """Linha do PDV já classificada, consumida pela exibição e pelo monitor de transações"""
+    __slots__ = ('kind', 'text', 'barcode', 'quantity', 'price')
+
+    def __init__(self, kind, text, barcode=None, quantity=None, price=None):
+        self.kind = kind
+        self.text = text
+        self.barcode = barcode
+        self.quantity = quantity
+        self.price = price
+
+    def __repr__(self):
+        return f"PDVEvent({self.kind!r}, {self.text!r}, barcode={self.barcode!r}, quantity={self.quantity!r}, price={self.price!r})"
+
+def _clean_text(raw_message):
+    """Texto de exibição: remove a formatação repetida, os espaços duplicados e os ^ (mantém quebras e tabulações)"""
+    line = raw_message.strip()
+    # Substituições apenas nas linhas que têm o padrão (verificação barata em C)
+    if '***' in line or '^^' in line or '.....' in line or '=====' in line or '-----' in line:
+        line = _RUNS_RE.sub(' ', line)
+    if '  ' in line:
+        line = _SPACES_RE.sub(' ', line)
+    if '^' in line:
+        line = line.replace('^', '')
+    return line
+
+def _amounts(line):
+    """Quantidade e preço da linha ("2 UN x 8,49", "0,532 x 14,90" ou o último valor monetário)"""
+    quantity = price = None
+    previous = None
+    pending_quantity = None
+    for word in line.split():
+        if word[0].isdigit():
+            digits = word.rstrip(',.;:')
+            if ',' in digits and not digits.isdigit():
+                # Valor monetário: preço unitário depois de "x", senão o último valor da linha
+                if pending_quantity is not None:
+                    quantity = pending_quantity
+                    price = digits
+                    pending_quantity = None
+                elif quantity is None:
+                    price = digits
+        elif word == 'x' or word == 'X':
+            pending_quantity = previous
+        elif word == 'UN':
+            continue
+        previous = word
+    return quantity, price
+
+def parse_line(raw_message):
+    """
+    Limpa e classifica uma linha recebida do PDV.
+
+    A classificação usa os mesmos marcadores (busca de substring na linha bruta) e a mesma
+    busca de código de barras que o process_message e o PDVTransaction anteriores: formatos
+    como "*PDV:001", "TOTAL: R$12,50" ou "Produto:ARROZ" são reconhecidos.
+
+    Args:
+        raw_message (str): Mensagem bruta recebida do PDV
+
+    Returns:
+        PDVEvent: Evento com o tipo da linha, o texto formatado para exibição e,
+        quando houver, código de barras, quantidade e preço
+    """
+    text = _clean_text(raw_message)
+
+    if "Abertura de Gaveta" not in text and "Relatorio Gerencial" not in text:
+        # Linhas de separação não são exibidas
+        if text.startswith('[') and _SEPARATOR_RE.match(text):
+            text = ""
+        elif "*PDV" in text and "*Trans:" in text:
+            # Deixa o cabeçalho de transação mais visível
+            for marker in _HEADER_MARKERS:
+                text = text.replace(marker, marker[1:])
+
+    if "*PDV" in raw_message and "*Trans:" in raw_message and "*Atend:" in raw_message:
+        return PDVEvent(EVENT_HEADER, text)
+    if "TOTAL" in raw_message and "R$" in raw_message:
+        return PDVEvent(EVENT_TOTAL, text, price=_amounts(text)[1])
+    if "Pagamento" in raw_message:
+        return PDVEvent(EVENT_PAYMENT, text, price=_amounts(text)[1])
+
+    match = _BARCODE_RE.search(raw_message)
+    if match or 'Produto' in raw_message or 'Item' in raw_message:
+        quantity, price = _amounts(text)
+        return PDVEvent(EVENT_ITEM, text, match.group() if match else None, quantity, price)
+
+    if "Gaveta" in raw_message:
+        return PDVEvent(EVENT_DRAWER, text)
+    if "Gerencial" in raw_message:
+        return PDVEvent(EVENT_REPORT, text)
+    if not text:
+        return PDVEvent(EVENT_SEPARATOR, text)
+    return PDVEvent(EVENT_TEXT, text)
+
 def process_message(raw_message, client_ip):
     """
     Processa a mensagem recebida de um PDV, preservando todas as informações
     essenciais e aplicando apenas formatação básica para melhorar a legibilidade.
-    
+
     Args:
         raw_message (str): Mensagem bruta recebida do PDV
         client_ip (str): IP do cliente PDV que enviou a mensagem
-        
+
     Returns:
         str: Mensagem processada com formatação mínima
     """
-    # Remove caracteres de controle e espaços extras
-    cleaned_message = raw_message.strip()
-    
-    # Remove caracteres de formatação repetidos
-    cleaned_message = re.sub(r'(\*{3,}|\^{2,}|\.{5,}|\={5,}|\-{5,})', ' ', cleaned_message)
-    
-    # Remove múltiplos espaços em branco
-    cleaned_message = re.sub(r' {2,}', ' ', cleaned_message)
-    
-    # Remove ^ no final das linhas
-    cleaned_message = cleaned_message.replace('^', '')
-    
-    # Simplificação para algumas mensagens padrão
-    # Abertura de gaveta
-    if "Abertura de Gaveta" in cleaned_message:
-        return cleaned_message.replace("************", "").replace("******************", "")
-    
-    # Relatório gerencial
-    if "Relatorio Gerencial" in cleaned_message:
-        return cleaned_message.replace("***********", "").replace("******************", "")
-    
-    # Linhas de separação
-    if re.match(r'^\[[\d:]+\]\s*\.+$', cleaned_message):
-        return "" # Remove linhas que são apenas pontos
-    
-    # Linhas de separação
-    if re.match(r'^\[[\d:]+\]\s*\*+$', cleaned_message):
-        return "" # Remove linhas que são apenas asteriscos
-    
-    # Para transações
-    if "*PDV" in cleaned_message and "*Trans:" in cleaned_message:
-        # Deixa o cabeçalho de transação mais visível
-        cleaned_message = cleaned_message.replace("*PDV", "PDV").replace("*Trans:", "Trans:").replace("*Atend:", "Atend:")
-        # Poderia adicionar separadores, mas preferimos manter o texto original
-    
-    return cleaned_message
\ No newline at end of file
+    return parse_line(raw_message).text
@@ -0,0 +1,352 @@
+"""
+Mosaico no servidor: compõe as câmeras de várias pistas em um único quadro e o codifica
+uma única vez para todos os visualizadores do mesmo layout.
+
+Cada câmera continua no seu VideoPipeline (uma decodificação por câmera); o mosaico assina
+um preset de cada uma e guarda só o frame mais recente. Uma thread compõe os frames I420
+direto nos planos de um canvas pré-alocado (sem conversão de cor), codifica em VP8 e
+entrega os pacotes prontos às tracks dos visualizadores, que o RTCRtpSender apenas empacota.
+"""
+import asyncio
+import fractions
+import math
+import threading
+import time
+import av
+import cv2
+import numpy as np
+from aiortc import MediaStreamTrack, RTCPeerConnection, RTCConfiguration, RTCRtpSender
+from aiortc.mediastreams import MediaStreamError
+from webrtc_conversion import VideoPipeline
+
+# Tamanho (largura, altura) de cada quadro do mosaico; 4 câmeras formam um canvas 1280x720
+MOSAIC_TILE_SIZE = (640, 360)
+
+# Preset assinado em cada câmera (fonte dos quadros, já reduzida pelo pipeline)
+MOSAIC_SOURCE_PRESET = "medium"
+
+# Máximo de câmeras em um mosaico
+MOSAIC_MAX_TILES = 9
+
+# Frames por segundo do mosaico e intervalo (s) entre keyframes. Os pacotes são compartilhados,
+# então um visualizador não pode pedir um keyframe só para ele: quem entra (ou perde pacotes)
+# aguarda o próximo, forçado na hora ou no máximo em MOSAIC_KEYFRAME_INTERVAL
+MOSAIC_FPS = 15
+MOSAIC_KEYFRAME_INTERVAL = 2.0
+MOSAIC_BITRATE = 1500000
+
+# Pacotes pendentes por visualizador antes de descartar e esperar o próximo keyframe
+MOSAIC_VIEWER_QUEUE = 30
+
+# Valores de preto em YUV (faixa limitada), usados nos quadros sem imagem
+_BLACK_Y = 16
+_BLACK_UV = 128
+
+def i420_planes(buffer, width, height):
+    """Views (Y, U, V) de um buffer I420 contíguo (height * 3 / 2, width), sem cópia"""
+    flat = buffer.reshape(-1)
+    y_size = width * height
+    uv_size = y_size // 4
+    y = flat[:y_size].reshape(height, width)
+    u = flat[y_size:y_size + uv_size].reshape(height // 2, width // 2)
+    v = flat[y_size + uv_size:y_size + 2 * uv_size].reshape(height // 2, width // 2)
+    return y, u, v
+
+class MosaicTrack(MediaStreamTrack):
+    """Track de um visualizador do mosaico: entrega pacotes VP8 já codificados"""
+    kind = "video"
+
+    def __init__(self, mosaic):
+        super().__init__()
+        self.mosaic = mosaic
+        self.queue = asyncio.Queue(maxsize=MOSAIC_VIEWER_QUEUE)
+        # Pacotes só fazem sentido a partir de um keyframe
+        self.waiting_keyframe = True
+        self.packets_dropped = 0
+
+    def deliver(self, packet, keyframe):
+        """Chamado no loop de eventos para cada pacote codificado"""
+        if self.waiting_keyframe:
+            if not keyframe:
+                return
+            self.waiting_keyframe = False
+
+        if self.queue.full():
+            # Visualizador atrasado: descarta o que tem e volta a esperar um keyframe
+            self.packets_dropped += self.queue.qsize()
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.waiting_keyframe = True
+            self.mosaic.request_keyframe()
+            return
+
+        self.queue.put_nowait(packet)
+
+    async def recv(self):
+        if self.readyState != "live":
+            raise MediaStreamError
+
+        packet = await self.queue.get()
+        if packet is None:
+            raise MediaStreamError
+        return packet
+
+    def stop(self):
+        super().stop()
+        if self.queue.empty():
+            self.queue.put_nowait(None)
+
+class MosaicStream:
+    """
+    Mosaico compartilhado por layout (lista ordenada de URLs): uma composição e um encode
+    por frame, independente da quantidade de visualizadores
+    """
+    # Mosaicos ativos por layout
+    _instances = {}
+
+    @classmethod
+    def get_instance(cls, rtsp_urls):
+        key = tuple(rtsp_urls)
+        if key not in cls._instances:
+            cls._instances[key] = MosaicStream(key)
+        return cls._instances[key]
+
+    def __init__(self, rtsp_urls, tile_size=MOSAIC_TILE_SIZE, fps=MOSAIC_FPS):
+        if not 1 <= len(rtsp_urls) <= MOSAIC_MAX_TILES:
+            raise ValueError(f"Mosaico precisa de 1 a {MOSAIC_MAX_TILES} câmeras")
+
+        self.rtsp_urls = tuple(rtsp_urls)
+        self.fps = fps
+        self.tile_width, self.tile_height = tile_size
+
+        # Grade o mais quadrada possível: 4 câmeras = 2x2, 6 = 3x2
+        self.columns = math.ceil(math.sqrt(len(rtsp_urls)))
+        self.rows = math.ceil(len(rtsp_urls) / self.columns)
+        self.width = self.columns * self.tile_width
+        self.height = self.rows * self.tile_height
+
+        # Canvas I420 pré-alocado e as views de cada quadro em cada plano
+        self.canvas = np.empty((self.height * 3 // 2, self.width), dtype=np.uint8)
+        canvas_y, canvas_u, canvas_v = i420_planes(self.canvas, self.width, self.height)
+        canvas_y[:] = _BLACK_Y
+        canvas_u[:] = _BLACK_UV
+        canvas_v[:] = _BLACK_UV
+        self.tiles = []
+        for index in range(len(rtsp_urls)):
+            x = (index % self.columns) * self.tile_width
+            y = (index // self.columns) * self.tile_height
+            self.tiles.append((
+                canvas_y[y:y + self.tile_height, x:x + self.tile_width],
+                canvas_u[y // 2:(y + self.tile_height) // 2, x // 2:(x + self.tile_width) // 2],
+                canvas_v[y // 2:(y + self.tile_height) // 2, x // 2:(x + self.tile_width) // 2],
+            ))
+
+        # Frame mais recente de cada câmera (escrito no loop de eventos, lido pela thread de composição)
+        self._latest = [None] * len(rtsp_urls)
+        self._drawn = [None] * len(rtsp_urls)
+
+        self.viewers = set()
+        self._relay_tracks = []
+        self._reader_tasks = []
+        self._thread = None
+        self._running = False
+        self._force_keyframe = False
+        self._loop = None
+        self._lock = asyncio.Lock()
+
+        self.frames_encoded = 0
+        self.bytes_encoded = 0
+
+    async def subscribe(self):
+        """Adiciona um visualizador e retorna a sua MosaicTrack"""
+        async with self._lock:
+            if not self._running:
+                # Um mosaico encerrado enquanto este visualizador aguardava volta a ser o do layout
+                MosaicStream._instances.setdefault(self.rtsp_urls, self)
+                await self._start()
+            track = MosaicTrack(self)
+            self.viewers.add(track)
+            self.request_keyframe()
+            return track
+
+    async def unsubscribe(self, track):
+        async with self._lock:
+            self.viewers.discard(track)
+            track.stop()
+            if not self.viewers:
+                await self._stop()
+
+    def request_keyframe(self):
+        self._force_keyframe = True
+
+    async def _start(self):
+        self._loop = asyncio.get_running_loop()
+        for index, rtsp_url in enumerate(self.rtsp_urls):
+            try:
+                relay_track = await VideoPipeline.get_instance(rtsp_url).subscribe(MOSAIC_SOURCE_PRESET)
+            except Exception as e:
+                # Câmera indisponível: o quadro fica preto e as demais seguem no mosaico
+                print(f"Erro ao abrir câmera {rtsp_url} para o mosaico: {e}")
+                continue
+            self._relay_tracks.append((rtsp_url, relay_track))
+            self._reader_tasks.append(asyncio.create_task(self._read_camera(index, relay_track)))
+
+        if not self._relay_tracks:
+            raise Exception("Nenhuma câmera do mosaico pôde ser aberta")
+
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name=f"mosaic-{len(self.rtsp_urls)}", daemon=True)
+        self._thread.start()
+        print(f"Mosaico {self.columns}x{self.rows} ({self.width}x{self.height}) iniciado para: {', '.join(self.rtsp_urls)}")
+
+    async def _stop(self):
+        self._running = False
+        if self._thread:
+            await self._loop.run_in_executor(None, self._thread.join, 2.0)
+            self._thread = None
+        for task in self._reader_tasks:
+            task.cancel()
+        await asyncio.gather(*self._reader_tasks, return_exceptions=True)
+        self._reader_tasks = []
+        self._latest = [None] * len(self.rtsp_urls)
+        await self._release_cameras()
+
+        if MosaicStream._instances.get(self.rtsp_urls) is self:
+            MosaicStream._instances.pop(self.rtsp_urls, None)
+        print(f"Mosaico de {', '.join(self.rtsp_urls)} encerrado")
+
+    async def _release_cameras(self):
+        for rtsp_url, relay_track in self._relay_tracks:
+            try:
+                pipeline = VideoPipeline._instances.get(rtsp_url)
+                if pipeline:
+                    await pipeline.unsubscribe(MOSAIC_SOURCE_PRESET, relay_track)
+            except Exception as e:
+                print(f"Erro ao liberar câmera {rtsp_url} do mosaico: {e}")
+        self._relay_tracks = []
+
+    async def _read_camera(self, index, relay_track):
+        """Guarda só o frame mais recente da câmera; a composição roda na própria thread"""
+        while True:
+            try:
+                self._latest[index] = await relay_track.recv()
+            except MediaStreamError:
+                break
+
+    def _compose(self):
+        """Redimensiona os planos dos frames novos direto nas views do canvas"""
+        for index, (tile_y, tile_u, tile_v) in enumerate(self.tiles):
+            frame = self._latest[index]
+            if frame is None or frame is self._drawn[index]:
+                continue
+            self._drawn[index] = frame
+
+            source = frame.to_ndarray()
+            source_y, source_u, source_v = i420_planes(source, frame.width, frame.height)
+            cv2.resize(source_y, (self.tile_width, self.tile_height), dst=tile_y, interpolation=cv2.INTER_AREA)
+            cv2.resize(source_u, (self.tile_width // 2, self.tile_height // 2), dst=tile_u, interpolation=cv2.INTER_AREA)
+            cv2.resize(source_v, (self.tile_width // 2, self.tile_height // 2), dst=tile_v, interpolation=cv2.INTER_AREA)
+
+    def _create_codec(self):
+        # Mesmos parâmetros de tempo real do encoder VP8 do aiortc, com keyframes periódicos
+        codec = av.CodecContext.create("libvpx", "w")
+        codec.width = self.width
+        codec.height = self.height
+        codec.pix_fmt = "yuv420p"
+        codec.bit_rate = MOSAIC_BITRATE
+        codec.time_base = fractions.Fraction(1, 90000)
+        codec.gop_size = int(self.fps * MOSAIC_KEYFRAME_INTERVAL)
+        codec.qmin = 2
+        codec.qmax = 56
+        codec.options = {
+            "bufsize": str(MOSAIC_BITRATE),
+            "cpu-used": "-6",
+            "deadline": "realtime",
+            "lag-in-frames": "0",
+            "minrate": str(MOSAIC_BITRATE),
+            "maxrate": str(MOSAIC_BITRATE),
+            "static-thresh": "1",
+            "undershoot-pct": "100",
+        }
+        return codec
+
+    def _run(self):
+        """Thread de composição: compõe, codifica e entrega um frame a cada 1/fps"""
+        codec = self._create_codec()
+        time_base = fractions.Fraction(1, 90000)
+        interval = 1.0 / self.fps
+        start = time.monotonic()
+        next_frame = start
+
+        while self._running:
+            now = time.monotonic()
+            if now < next_frame:
+                time.sleep(next_frame - now)
+                continue
+            next_frame += interval
+            if now - next_frame > interval:
+                # Atrasado (encode lento): não tenta recuperar os frames perdidos
+                next_frame = now + interval
+
+            try:
+                self._compose()
+
+                video_frame = av.VideoFrame.from_ndarray(self.canvas, format="yuv420p")
+                video_frame.pts = int((now - start) * 90000)
+                video_frame.time_base = time_base
+                if self._force_keyframe:
+                    self._force_keyframe = False
+                    video_frame.pict_type = av.video.frame.PictureType.I
+
+                for packet in codec.encode(video_frame):
+                    packet.pts = video_frame.pts
+                    packet.time_base = time_base
+                    self.frames_encoded += 1
+                    self.bytes_encoded += packet.size
+                    self._loop.call_soon_threadsafe(self._deliver, packet, packet.is_keyframe)
+            except Exception as e:
+                print(f"Erro ao compor o mosaico: {e}")
+                time.sleep(interval)
+
+    def _deliver(self, packet, keyframe):
+        for track in list(self.viewers):
+            track.deliver(packet, keyframe)
+
+class MosaicSession:
+    """Sessão WebRTC de um visualizador do mosaico (equivalente ao WebRTCConversion de uma câmera)"""
+    def __init__(self, rtsp_urls):
+        self.rtsp_urls = tuple(rtsp_urls)
+        self.mosaic = None
+        self.track = None
+        self.pc = None
+
+    async def connect(self):
+        self.mosaic = MosaicStream.get_instance(self.rtsp_urls)
+        self.track = await self.mosaic.subscribe()
+
+    async def create_offer(self):
+        if self.pc:
+            await self.pc.close()
+
+        self.pc = RTCPeerConnection(configuration=RTCConfiguration(iceServers=[]))
+        transceiver = self.pc.addTransceiver(self.track, direction="sendonly")
+        # Os pacotes já vêm em VP8: o navegador não pode negociar outro codec
+        transceiver.setCodecPreferences([codec for codec in RTCRtpSender.getCapabilities("video").codecs
+                                         if codec.mimeType == "video/VP8"])
+        offer = await self.pc.createOffer()
+        await self.pc.setLocalDescription(offer)
+        return self.pc.localDescription
+
+    async def process_answer(self, answer):
+        await self.pc.setRemoteDescription(answer)
+
+    async def close(self):
+        if self.pc:
+            try:
+                await self.pc.close()
+            except Exception as e:
+                print(f"Erro ao fechar peer connection do mosaico: {e}")
+            self.pc = None
+        if self.mosaic and self.track:
+            await self.mosaic.unsubscribe(self.track)
+            self.track = None
@@ -0,0 +1,58 @@
+import asyncio
+import json
+
+# Janela padrão de agrupamento das linhas de um PDV e limite de linhas por lote
+DEFAULT_BATCH_WINDOW_MS = 40
+DEFAULT_BATCH_MAX_LINES = 50
+
+class PDVBatcher:
+    """
+    Agrupa as linhas pdv_data de um PDV para os clientes que pediram lote no register.
+
+    As linhas são acumuladas por até window_ms (ou max_lines) e enviadas como uma única
+    mensagem {"type": "pdv_batch", "pdv_ip", "lines": [...]}: um json.dumps e um frame
+    WebSocket por janela, compartilhados por todos os clientes em modo lote do PDV.
+    """
+    def __init__(self, pdv_ip, window_ms=DEFAULT_BATCH_WINDOW_MS, max_lines=DEFAULT_BATCH_MAX_LINES):
+        self.pdv_ip = pdv_ip
+        # ClientSender do PDV em modo lote (tupla mantida pelo registro de assinaturas)
+        self.clients = ()
+        self.window = window_ms / 1000
+        self.max_lines = max_lines
+
+        self.lines = []
+        self._flush_handle = None
+
+        # Métricas
+        self.batches = 0
+        self.lines_sent = 0
+
+    def add(self, line):
+        """Acrescenta uma linha ao lote atual, enviando-o se atingir max_lines"""
+        self.lines.append(line)
+        if len(self.lines) >= self.max_lines:
+            self.flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.window, self.flush)
+
+    def flush(self):
+        """Envia as linhas pendentes aos clientes em modo lote"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self.lines:
+            return
+
+        message = json.dumps({"type": "pdv_batch", "pdv_ip": self.pdv_ip, "lines": self.lines})
+        for sender in self.clients:
+            sender.enqueue(message)
+
+        self.batches += 1
+        self.lines_sent += len(self.lines)
+        self.lines = []
+
+    def close(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self.lines = []
@@ -0,0 +1,91 @@
+import sys
+import time
+
+# Linhas guardadas por PDV e limite de memória somado de todos os PDVs
+DEFAULT_HISTORY_LINES = 200
+DEFAULT_HISTORY_MEMORY_MB = 16
+
+class LineRing:
+    """Buffer circular pré-alocado com as últimas linhas exibidas de um PDV e o horário de chegada de cada uma"""
+    def __init__(self, size):
+        self.slots = [None] * size
+        self.times = [0.0] * size
+        self.sizes = [0] * size
+        self.size = size
+        self.head = 0       # próxima posição de escrita
+        self.count = 0
+        self.bytes = 0
+
+    def append(self, line, line_bytes, timestamp):
+        """Grava a linha sobre a mais antiga; retorna a variação de bytes ocupados"""
+        head = self.head
+        freed = self.sizes[head]
+        self.slots[head] = line
+        self.times[head] = timestamp
+        self.sizes[head] = line_bytes
+        self.head = (head + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+        self.bytes += line_bytes - freed
+        return line_bytes - freed
+
+    def drop_oldest(self):
+        """Descarta a linha mais antiga; retorna os bytes liberados"""
+        if not self.count:
+            return 0
+        tail = (self.head - self.count) % self.size
+        freed = self.sizes[tail]
+        self.slots[tail] = None
+        self.sizes[tail] = 0
+        self.count -= 1
+        self.bytes -= freed
+        return freed
+
+    def lines(self):
+        """Linhas da mais antiga para a mais recente"""
+        return self._ordered(self.slots)
+
+    def timestamps(self):
+        """Horários de chegada (epoch, s) das linhas, na mesma ordem de lines()"""
+        return self._ordered(self.times)
+
+    def _ordered(self, values):
+        tail = (self.head - self.count) % self.size
+        if tail + self.count <= self.size:
+            return values[tail:tail + self.count]
+        return values[tail:] + values[:self.head]
+
+class PDVHistory:
+    """
+    Histórico recente de cada PDV, enviado de uma vez ao cliente que se registra.
+
+    Cada PDV tem um LineRing de lines_per_pdv posições; a soma de todos os PDVs é
+    limitada a max_bytes: ao estourar, o PDV que acabou de receber a linha descarta
+    suas linhas mais antigas, de modo que um PDV movimentado não apaga o dos outros.
+    """
+    def __init__(self, lines_per_pdv=DEFAULT_HISTORY_LINES, max_bytes=DEFAULT_HISTORY_MEMORY_MB * 1024 * 1024):
+        self.lines_per_pdv = lines_per_pdv
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+
+        # { ip_pdv: LineRing }
+        self.rings = {}
+
+    def append(self, pdv_ip, line, timestamp=None):
+        if not line:
+            return
+        ring = self.rings.get(pdv_ip)
+        if ring is None:
+            ring = self.rings[pdv_ip] = LineRing(self.lines_per_pdv)
+
+        self.total_bytes += ring.append(line, sys.getsizeof(line), time.time() if timestamp is None else timestamp)
+        while self.total_bytes > self.max_bytes and ring.count > 1:
+            self.total_bytes -= ring.drop_oldest()
+
+    def lines(self, pdv_ip):
+        ring = self.rings.get(pdv_ip)
+        return ring.lines() if ring else []
+
+    def timestamps(self, pdv_ip):
+        ring = self.rings.get(pdv_ip)
+        return ring.timestamps() if ring else []
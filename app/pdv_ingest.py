@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import socket
+from log_utils import SampledLog
+
+logger = logging.getLogger("pdv_ingest")
+
+# Maior payload possível de um datagrama UDP sobre IPv4
+MAX_DATAGRAM_SIZE = 65507
+
+# Limite de datagramas lidos por despertar de um socket, para não monopolizar o loop
+DEFAULT_MAX_BATCH = 512
+
+# Limite de lotes aguardando o parsing por socket; cheio, o lote mais antigo é descartado
+DEFAULT_MAX_QUEUED_BATCHES = 1024
+
+class PDVIngest:
+    """
+    Ingestão UDP dos PDVs. Cada socket é registrado no loop de eventos com add_reader;
+    a cada despertar todos os datagramas enfileirados no kernel são lidos de uma vez
+    e entregues como um lote [(data, addr), ...] na fila do socket.
+
+    O callback opcional on_batch recebe o lote na hora da leitura, antes da fila:
+    é onde fica o repasse aos DVRs, que assim não espera pelo parsing. Se o parsing ficar para
+    trás, a fila é limitada a max_queued_batches lotes e os mais antigos são descartados
+    (o repasse aos DVRs e o diário já os receberam).
+    """
+    def __init__(self, buffer_size=MAX_DATAGRAM_SIZE, max_batch=DEFAULT_MAX_BATCH,
+                 max_queued_batches=DEFAULT_MAX_QUEUED_BATCHES):
+        self.buffer_size = buffer_size
+        self.max_batch = max_batch
+        self.max_queued_batches = max_queued_batches
+        self.loop = None
+
+        # { chave_pdv: (socket, fila de lotes, on_batch) }
+        self.sockets = {}
+
+        # Contadores: { chave_pdv: {'datagrams': int, 'batches': int, 'truncated': int, 'dropped_batches': int} }
+        self.stats = {}
+        
+        # Eventos por pacote: amostrados para não pesar em volume
+        self.log_truncated = SampledLog(logger, logging.WARNING, "pdv_truncated")
+        self.log_read_error = SampledLog(logger, logging.ERROR, "pdv_read_error")
+        self.log_dropped = SampledLog(logger, logging.WARNING, "pdv_batch_dropped")
+
+    def add_socket(self, pdv_key, pdv_socket, on_batch=None):
+        """Passa a ler o socket e retorna a asyncio.Queue que recebe os lotes de datagramas"""
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+
+        batches = asyncio.Queue(maxsize=self.max_queued_batches)
+        self.sockets[pdv_key] = (pdv_socket, batches, on_batch)
+        # Os contadores continuam de onde estavam se a escuta da pista for reiniciada
+        self.stats.setdefault(pdv_key, {'datagrams': 0, 'batches': 0, 'truncated': 0, 'dropped_batches': 0})
+        self.loop.add_reader(pdv_socket.fileno(), self._drain, pdv_key)
+        return batches
+
+    def remove_socket(self, pdv_key):
+        """Para de ler o socket; os contadores da pista são mantidos (ver forget)"""
+        entry = self.sockets.pop(pdv_key, None)
+        if entry and self.loop:
+            self.loop.remove_reader(entry[0].fileno())
+
+    def forget(self, pdv_key):
+        """Descarta os contadores de uma pista que saiu da configuração"""
+        self.remove_socket(pdv_key)
+        self.stats.pop(pdv_key, None)
+
+    def _drain(self, pdv_key):
+        """Lê todos os datagramas disponíveis no socket (chamado pelo loop quando há dados)"""
+        pdv_socket, batches, on_batch = self.sockets[pdv_key]
+        stats = self.stats[pdv_key]
+        batch = []
+
+        while len(batch) < self.max_batch:
+            try:
+                data, _, flags, addr = pdv_socket.recvmsg(self.buffer_size)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                self.log_read_error(pdv=pdv_key, error=e)
+                break
+
+            if flags & socket.MSG_TRUNC:
+                stats['truncated'] += 1
+                self.log_truncated(pdv=pdv_key, buffer_size=self.buffer_size)
+
+            batch.append((data, addr))
+
+        if batch:
+            stats['datagrams'] += len(batch)
+            stats['batches'] += 1
+            if on_batch:
+                try:
+                    on_batch(batch)
+                except Exception as e:
+                    print(f"Erro ao repassar lote do PDV {pdv_key}: {e}")
+            if batches.full():
+                dropped = batches.get_nowait()
+                stats['dropped_batches'] += 1
+                self.log_dropped(pdv=pdv_key, datagrams=len(dropped))
+            batches.put_nowait(batch)
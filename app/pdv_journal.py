@@ -0,0 +1,246 @@
+"""
+Diário (journal) em disco, somente de acréscimo, de todo o tráfego UDP dos PDVs.
+
+Formato:
+    journal-<inicio_ms>.seg  registros binários <ts:float64><tam_ip:uint16><tam_dados:uint32><ip><dados>
+    journal-<inicio_ms>.idx  uma linha por lote gravado: "<ts_min> <ts_max> <offset> <fim> <ip1,ip2,...>"
+
+O índice aponta para trechos do segmento, então o leitor (mmap) só decodifica os lotes
+que contêm o PDV pedido e se sobrepõem ao intervalo de tempo, sem varrer o arquivo todo.
+"""
+import logging
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+from log_utils import SampledLog
+
+logger = logging.getLogger("pdv_journal")
+
+_RECORD_HEADER = struct.Struct('<dHI')
+
+# Novo segmento a cada 64 MB ou 1 hora
+DEFAULT_SEGMENT_BYTES = 64 * 1024 * 1024
+DEFAULT_SEGMENT_SECONDS = 3600
+
+# Intervalo máximo entre fsyncs em grupo
+DEFAULT_FSYNC_INTERVAL = 0.5
+
+# Limite de lotes aguardando gravação; com o disco travado, os lotes além dele são descartados
+DEFAULT_MAX_BACKLOG_BATCHES = 4096
+
+class PDVJournal:
+    """
+    Gravador do diário. append_batch() só enfileira (chamado no loop de eventos, na ingestão);
+    uma thread própria junta tudo o que estiver pendente em uma única escrita por segmento
+    e faz um fsync em grupo a cada fsync_interval. Se o disco não acompanhar, a fila guarda
+    no máximo max_backlog_batches lotes e os que chegarem além disso ficam fora do diário.
+    """
+    def __init__(self, directory, segment_bytes=DEFAULT_SEGMENT_BYTES, segment_seconds=DEFAULT_SEGMENT_SECONDS,
+                 fsync_interval=DEFAULT_FSYNC_INTERVAL, max_backlog_batches=DEFAULT_MAX_BACKLOG_BATCHES):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.fsync_interval = fsync_interval
+        self.max_backlog_batches = max_backlog_batches
+
+        self.pending = queue.SimpleQueue()
+        self.thread = None
+        self.running = False
+
+        self.segment = None
+        self.index = None
+        self.segment_start = 0
+        self.segment_size = 0
+
+        # Métricas
+        self.records = 0
+        self.writes = 0
+        self.fsyncs = 0
+        self.errors = 0
+        self.dropped_batches = 0
+
+        self.log_dropped = SampledLog(logger, logging.WARNING, "journal_batch_dropped")
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="pdv-journal", daemon=True)
+        self.thread.start()
+        print(f"Diário dos PDVs gravando em {self.directory}")
+
+    def append_batch(self, batch):
+        """Enfileira um lote [(data, addr), ...] recebido agora (não bloqueia o loop)"""
+        if not self.running:
+            return
+        if self.pending.qsize() >= self.max_backlog_batches:
+            self.dropped_batches += 1
+            self.log_dropped(datagrams=len(batch), backlog=self.max_backlog_batches)
+            return
+        self.pending.put((time.time(), batch))
+
+    def backlog(self):
+        """Lotes enfileirados que a thread ainda não gravou"""
+        return self.pending.qsize()
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        self.pending.put(None)
+        self.thread.join(timeout=5)
+
+    def _run(self):
+        last_fsync = time.monotonic()
+        dirty = False
+        stopping = False
+
+        while not stopping:
+            try:
+                item = self.pending.get(timeout=self.fsync_interval)
+            except queue.Empty:
+                item = ()
+
+            # Junta tudo o que já está pendente em uma única escrita
+            items = []
+            while True:
+                if item is None:
+                    stopping = True
+                elif item:
+                    items.append(item)
+                try:
+                    item = self.pending.get_nowait()
+                except queue.Empty:
+                    break
+
+            try:
+                if items:
+                    self._write(items)
+                    dirty = True
+
+                now = time.monotonic()
+                if dirty and (stopping or now - last_fsync >= self.fsync_interval):
+                    self._fsync()
+                    last_fsync = now
+                    dirty = False
+            except OSError as e:
+                self.errors += 1
+                print(f"Erro ao gravar diário dos PDVs: {e}")
+
+        self._close_segment()
+
+    def _write(self, items):
+        chunk = bytearray()
+        ips = set()
+        first_ts = items[0][0]
+        last_ts = items[-1][0]
+        count = 0
+        for ts, batch in items:
+            for data, addr in batch:
+                ip = addr[0].encode()
+                chunk += _RECORD_HEADER.pack(ts, len(ip), len(data))
+                chunk += ip
+                chunk += data
+                ips.add(addr[0])
+                count += 1
+
+        if self.segment is None or self.segment_size >= self.segment_bytes or \
+                first_ts - self.segment_start >= self.segment_seconds:
+            self._open_segment(first_ts)
+
+        offset = self.segment_size
+        self.segment.write(chunk)
+        self.segment_size += len(chunk)
+        self.index.write(f"{first_ts:.6f} {last_ts:.6f} {offset} {self.segment_size} {','.join(sorted(ips))}\n")
+
+        self.records += count
+        self.writes += 1
+
+    def _fsync(self):
+        self.segment.flush()
+        os.fsync(self.segment.fileno())
+        self.index.flush()
+        os.fsync(self.index.fileno())
+        self.fsyncs += 1
+
+    def _open_segment(self, start_ts):
+        if self.segment is not None:
+            self._fsync()
+            self._close_segment()
+        name = os.path.join(self.directory, f"journal-{int(start_ts * 1000)}")
+        self.segment = open(f"{name}.seg", "ab")
+        self.index = open(f"{name}.idx", "a")
+        self.segment_start = start_ts
+        self.segment_size = self.segment.tell()
+
+    def _close_segment(self):
+        if self.segment is not None:
+            self.segment.close()
+            self.index.close()
+            self.segment = None
+            self.index = None
+
+def read_journal(directory, pdv_ip, start_ts, end_ts):
+    """
+    Lê do diário as linhas de um PDV entre start_ts e end_ts (epoch em segundos).
+
+    Returns:
+        generator: (timestamp, dados_bytes) em ordem de gravação
+    """
+    names = sorted(name[:-4] for name in os.listdir(directory) if name.startswith("journal-") and name.endswith(".seg"))
+    for position, name in enumerate(names):
+        segment_start = int(name[len("journal-"):]) / 1000
+        # Segmentos que começam depois do fim do intervalo não interessam
+        if segment_start > end_ts:
+            break
+        # O próximo segmento começou antes do intervalo: este termina antes dele
+        if position + 1 < len(names) and int(names[position + 1][len("journal-"):]) / 1000 < start_ts:
+            continue
+
+        path = os.path.join(directory, name)
+        ranges = _select_ranges(f"{path}.idx", pdv_ip, start_ts, end_ts)
+        if not ranges:
+            continue
+
+        with open(f"{path}.seg", "rb") as segment:
+            size = os.fstat(segment.fileno()).st_size
+            if not size:
+                continue
+            with mmap.mmap(segment.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                for offset, end in ranges:
+                    yield from _read_range(view, min(end, size), offset, pdv_ip, start_ts, end_ts)
+
+def _select_ranges(index_path, pdv_ip, start_ts, end_ts):
+    """Trechos (offset, fim) do segmento que contêm o PDV e se sobrepõem ao intervalo"""
+    ranges = []
+    try:
+        with open(index_path) as index:
+            for entry in index:
+                fields = entry.split()
+                if len(fields) < 5:
+                    continue   # linha incompleta (gravação interrompida)
+                first_ts, last_ts = float(fields[0]), float(fields[1])
+                if last_ts < start_ts or first_ts > end_ts:
+                    continue
+                if pdv_ip not in fields[4].split(','):
+                    continue
+                ranges.append((int(fields[2]), int(fields[3])))
+    except FileNotFoundError:
+        pass
+    return ranges
+
+def _read_range(view, end, offset, pdv_ip, start_ts, end_ts):
+    wanted = pdv_ip.encode()
+    header_size = _RECORD_HEADER.size
+    while offset + header_size <= end:
+        ts, ip_length, data_length = _RECORD_HEADER.unpack_from(view, offset)
+        offset += header_size
+        if offset + ip_length + data_length > end:
+            break   # registro ainda não gravado por inteiro
+        ip = view[offset:offset + ip_length]
+        offset += ip_length
+        if ip == wanted and start_ts <= ts <= end_ts:
+            yield ts, view[offset:offset + data_length]
+        offset += data_length
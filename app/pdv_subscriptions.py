@@ -0,0 +1,104 @@
+"""
+Registro das assinaturas dos clientes WebSocket do PDV: quais pistas cada cliente acompanha.
+
+Um cliente pode assinar várias pistas, ou todas (ALL_LANES, para painéis de supervisão da
+loja). O registro mantém o índice direto (pista -> clientes) e o reverso (cliente -> pistas):
+a desconexão remove o cliente só das pistas que ele assinou, sem varrer as demais.
+
+O fan-out por datagrama não copia conjuntos: cada pista tem uma tupla pronta com os seus
+clientes (e os de ALL_LANES), refeita só quando as assinaturas mudam.
+"""
+
+# Assinatura de todas as pistas atendidas pelo processo
+ALL_LANES = "*"
+
+# Pista sem assinantes: (todos, linha a linha, em lote)
+NO_SUBSCRIBERS = ((), (), ())
+
+class PDVSubscriptions:
+    def __init__(self):
+        # Índice direto { pdv_ip: set(ClientSender) } e assinantes de todas as pistas
+        self.lane_clients = {}
+        self.all_lanes_clients = set()
+
+        # Índice reverso { ClientSender: set(pdv_ip ou ALL_LANES) }
+        self.client_lanes = {}
+
+        # Fan-out pronto { pdv_ip: (todos, linha a linha, em lote) }; pistas sem assinantes
+        # próprios usam o dos assinantes de todas as pistas
+        self._snapshots = {}
+        self._all_lanes_snapshot = NO_SUBSCRIBERS
+
+    def subscribe(self, sender, pdv_ip):
+        """Assina uma pista (ou ALL_LANES) para o cliente"""
+        lanes = self.client_lanes.setdefault(sender, set())
+        lanes.add(pdv_ip)
+        if pdv_ip == ALL_LANES:
+            self.all_lanes_clients.add(sender)
+        else:
+            self.lane_clients.setdefault(pdv_ip, set()).add(sender)
+
+        # O modo lote do cliente pode ter mudado neste register: refaz todas as pistas dele
+        self._rebuild(lanes)
+
+    def unsubscribe(self, sender, pdv_ip):
+        """Cancela a assinatura de uma pista; retorna False se o cliente não a tinha"""
+        lanes = self.client_lanes.get(sender)
+        if not lanes or pdv_ip not in lanes:
+            return False
+        lanes.discard(pdv_ip)
+        if not lanes:
+            del self.client_lanes[sender]
+        self._discard(sender, pdv_ip)
+        self._rebuild((pdv_ip,))
+        return True
+
+    def remove(self, sender):
+        """Remove o cliente de todas as suas assinaturas (desconexão); retorna as pistas que ele assinava"""
+        lanes = self.client_lanes.pop(sender, ())
+        for pdv_ip in lanes:
+            self._discard(sender, pdv_ip)
+        self._rebuild(lanes)
+        return lanes
+
+    def subscribers(self, pdv_ip):
+        """Tuplas (todos, linha a linha, em lote) dos clientes da pista, prontas para o fan-out"""
+        return self._snapshots.get(pdv_ip, self._all_lanes_snapshot)
+
+    def clients(self, pdv_ip):
+        return self.subscribers(pdv_ip)[0]
+
+    def lanes(self, sender):
+        return self.client_lanes.get(sender, ())
+
+    def _discard(self, sender, pdv_ip):
+        if pdv_ip == ALL_LANES:
+            self.all_lanes_clients.discard(sender)
+            return
+        clients = self.lane_clients.get(pdv_ip)
+        if clients is not None:
+            clients.discard(sender)
+            if not clients:
+                del self.lane_clients[pdv_ip]
+
+    def _rebuild(self, lanes):
+        if ALL_LANES in lanes:
+            # Os assinantes de todas as pistas entram em todos os snapshots
+            self._all_lanes_snapshot = self._split(self.all_lanes_clients)
+            lanes = list(self.lane_clients) + [pdv_ip for pdv_ip in self._snapshots if pdv_ip not in self.lane_clients]
+
+        for pdv_ip in lanes:
+            clients = self.lane_clients.get(pdv_ip)
+            if clients:
+                self._snapshots[pdv_ip] = self._split(clients | self.all_lanes_clients)
+            else:
+                self._snapshots.pop(pdv_ip, None)
+
+    @staticmethod
+    def _split(clients):
+        if not clients:
+            return NO_SUBSCRIBERS
+        everyone = tuple(clients)
+        return (everyone,
+                tuple(sender for sender in everyone if not sender.batch),
+                tuple(sender for sender in everyone if sender.batch))
@@ -1,148 +1,210 @@
 import asyncio
+import heapq
+import itertools
 import json
-import re
 import time
+from message_processor import parse_line, EVENT_HEADER, EVENT_ITEM, EVENT_TOTAL, EVENT_PAYMENT
 
 class PDVTransaction:
     def __init__(self, timeout_seconds=60):
         # Tempo máximo de inatividade permitido (em segundos)
         self.timeout_seconds = timeout_seconds
-        
+
         # Dicionário para armazenar o estado de cada PDV
-        # Formato: { ip_pdv: { 'active_transaction': bool, 'last_activity': timestamp, 'timeout_task': Task } }
+        # Formato: { ip_pdv: { 'active_transaction': bool, 'last_activity': monotonic, 'armed': número do prazo ou None } }
         self.pdv_states = {}
-        
+
+        # Heap de prazos (deadline monotônico, número do prazo, ip_pdv), com no máximo uma entrada
+        # válida por PDV. Uma leitura de produto só atualiza 'last_activity' (O(1)); quando o prazo
+        # vence, o agendador confere a última atividade e, se houve atividade, reagenda o PDV.
+        # Uma entrada cujo número não é o 'armed' do estado atual (pista removida e readicionada)
+        # é descartada ao vencer
+        self.deadlines = []
+        self._deadline_ids = itertools.count()
+
+        # Acorda o agendador quando um prazo é inserido com o heap vazio
+        self._wakeup = None
+
+        # Total de alertas de inatividade disparados
+        self.alerts_fired = 0
+
+        # Callback on_transaction_change(ip_pdv, ativa), chamado quando uma transação começa ou termina
+        self.on_transaction_change = None
+
+        # Callback on_timeout(ip_pdv, tempo_inativo), chamado a cada alerta de inatividade
+        self.on_timeout = None
+
     def is_transaction_start(self, message):
         """Verifica se a mensagem indica o início de uma transação"""
-        # Identifica o padrão que indica início de transação
-        return "*PDV" in message and "*Trans:" in message and "*Atend:" in message
-        
+        # Cabeçalho *PDV / *Trans: / *Atend:
+        return parse_line(message).kind == EVENT_HEADER
+
     def is_transaction_end(self, message):
         """Verifica se a mensagem indica o fim de uma transação"""
-        # Identifica o padrão que indica pagamento/finalização
-        return "TOTAL" in message and "R$" in message or "Pagamento" in message
-        
+        # TOTAL R$ ou Pagamento
+        return parse_line(message).kind in (EVENT_TOTAL, EVENT_PAYMENT)
+
     def reset_pdv_state(self, pdv_ip):
         """Reinicia o estado de um PDV"""
         if pdv_ip in self.pdv_states:
-            # Se existir uma tarefa de timeout rodando, cancela
-            if 'timeout_task' in self.pdv_states[pdv_ip] and self.pdv_states[pdv_ip]['timeout_task']:
-                self.pdv_states[pdv_ip]['timeout_task'].cancel()
-                
-            # Reinicia o estado
-            self.pdv_states[pdv_ip] = {
-                'active_transaction': False,
-                'last_activity': time.time(),
-                'timeout_task': None
-            }
-        
+            state = self.pdv_states[pdv_ip]
+            was_active = state['active_transaction']
+            # Um prazo já agendado continua no heap e é descartado ao vencer
+            state['active_transaction'] = False
+            state['last_activity'] = time.monotonic()
+            if was_active and self.on_transaction_change:
+                self.on_transaction_change(pdv_ip, False)
+
     def register_pdv_if_needed(self, pdv_ip):
         """Registra um PDV no monitoramento se ainda não estiver registrado"""
         if pdv_ip not in self.pdv_states:
             self.pdv_states[pdv_ip] = {
                 'active_transaction': False,
-                'last_activity': time.time(),
-                'timeout_task': None
+                'last_activity': time.monotonic(),
+                'armed': None
             }
-    
-    async def timeout_checker(self, pdv_ip, websocket_clients):
-        """Tarefa que verifica timeout de inatividade do PDV"""
-        try:
-            # Espera pelo tempo de timeout
-            await asyncio.sleep(self.timeout_seconds)
-            
-            # Verifica se ainda está em uma transação ativa
-            if (pdv_ip in self.pdv_states and 
-                self.pdv_states[pdv_ip]['active_transaction']):
-                
-                # Calcula quanto tempo passou desde a última atividade
-                inactive_time = time.time() - self.pdv_states[pdv_ip]['last_activity']
-                
-                # Se passou mais tempo que o timeout, notifica
-                if inactive_time >= self.timeout_seconds:
-                    print(f"[ALERTA] PDV {pdv_ip} inativo por {inactive_time:.1f} segundos durante transação")
-                    
-                    # Prepara mensagem de timeout
-                    timeout_message = {
-                        "type": "pdv_inativo_timeout",
-                        "pdv_ip": pdv_ip,
-                        "inactive_time": round(inactive_time, 1)
-                    }
-                    
-                    # Verifica se o conjunto de clientes para este PDV existe
-                    if pdv_ip in websocket_clients:
-                        # Envia para todos os clientes conectados a este PDV
-                        for client in websocket_clients.get(pdv_ip, set()):
-                            try:
-                                await client.send(json.dumps(timeout_message))
-                            except Exception as e:
-                                print(f"Erro ao enviar notificação de timeout: {e}")
-        except asyncio.CancelledError:
-            # Tarefa cancelada (normal quando há atividade no PDV)
-            pass
-        except Exception as e:
-            print(f"Erro no verificador de timeout: {e}")
-    
-    def process_pdv_message(self, message, pdv_ip, websocket_clients, loop):
+
+    def remove_pdv(self, pdv_ip):
+        """Deixa de monitorar um PDV (pista removida do config.json); um prazo já no heap é descartado ao vencer"""
+        self.pdv_states.pop(pdv_ip, None)
+
+    def _arm(self, pdv_ip, deadline):
+        """Agenda o prazo de inatividade do PDV (apenas se ainda não houver um no heap)"""
+        state = self.pdv_states[pdv_ip]
+        if state['armed'] is not None:
+            return
+        deadline_id = state['armed'] = next(self._deadline_ids)
+        heapq.heappush(self.deadlines, (deadline, deadline_id, pdv_ip))
+        if len(self.deadlines) == 1 and self._wakeup:
+            self._wakeup.set()
+
+    async def run_timeout_scheduler(self, subscriptions):
+        """Agendador único de timeouts de inatividade para todos os PDVs do servidor (subscriptions: PDVSubscriptions)"""
+        self._wakeup = asyncio.Event()
+
+        while True:
+            try:
+                if self.deadlines:
+                    delay = self.deadlines[0][0] - time.monotonic()
+                else:
+                    delay = None
+
+                if delay is None or delay > 0:
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                expired = self._collect_expired(time.monotonic())
+                if expired:
+                    self._send_timeouts(expired, subscriptions)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Erro no verificador de timeout: {e}")
+                await asyncio.sleep(1)
+
+    def _collect_expired(self, now):
+        """Retira do heap os prazos vencidos; retorna [(ip_pdv, tempo_inativo)] dos PDVs que devem ser alertados"""
+        expired = []
+        while self.deadlines and self.deadlines[0][0] <= now:
+            _, deadline_id, pdv_ip = heapq.heappop(self.deadlines)
+            state = self.pdv_states.get(pdv_ip)
+            if not state or state['armed'] != deadline_id:
+                continue
+            state['armed'] = None
+
+            # Transação já finalizada: nada a alertar
+            if not state['active_transaction']:
+                continue
+
+            # Houve atividade depois do agendamento: reagenda para o novo prazo
+            deadline = state['last_activity'] + self.timeout_seconds
+            if deadline > now:
+                self._arm(pdv_ip, deadline)
+                continue
+
+            expired.append((pdv_ip, now - state['last_activity']))
+        return expired
+
+    def _send_timeouts(self, expired, subscriptions):
+        """Enfileira em lote as notificações de timeout nas filas de saída dos clientes"""
+        for pdv_ip, inactive_time in expired:
+            self.alerts_fired += 1
+            print(f"[ALERTA] PDV {pdv_ip} inativo por {inactive_time:.1f} segundos durante transação")
+
+            # Prepara mensagem de timeout
+            timeout_message = json.dumps({
+                "type": "pdv_inativo_timeout",
+                "pdv_ip": pdv_ip,
+                "inactive_time": round(inactive_time, 1)
+            })
+
+            # Envia para todos os clientes que assinam este PDV (ClientSender)
+            for client in subscriptions.clients(pdv_ip):
+                client.enqueue(timeout_message)
+
+            if self.on_timeout:
+                self.on_timeout(pdv_ip, inactive_time)
+
+    def process_pdv_message(self, message, pdv_ip):
         """
         Processa uma mensagem do PDV para monitorar atividade
-        
+
         Args:
             message (str): Mensagem recebida do PDV
             pdv_ip (str): Endereço IP do PDV
-            websocket_clients (dict): Dicionário com clientes WebSocket por IP
-            loop (asyncio.AbstractEventLoop): Loop de eventos atual
-            
+
         Returns:
             bool: True se a mensagem indica produto escaneado, False caso contrário
         """
+        return self.process_pdv_event(parse_line(message), pdv_ip)
+
+    def process_pdv_event(self, event, pdv_ip):
+        """
+        Processa uma linha do PDV já classificada por parse_line (sem reanalisar o texto)
+
+        Args:
+            event (PDVEvent): Evento da linha recebida
+            pdv_ip (str): Endereço IP do PDV
+
+        Returns:
+            bool: True se o evento é um produto escaneado, False caso contrário
+        """
         self.register_pdv_if_needed(pdv_ip)
-        
+        state = self.pdv_states[pdv_ip]
+        kind = event.kind
+
         # Verifica início de transação
-        if self.is_transaction_start(message):
-            # print(f"PDV {pdv_ip}: Início de transação detectado")
-            
-            # Reinicia o estado e marca como transação ativa
-            self.reset_pdv_state(pdv_ip)
-            self.pdv_states[pdv_ip]['active_transaction'] = True
-            self.pdv_states[pdv_ip]['last_activity'] = time.time()
-            
-            # Inicia tarefa de verificação de timeout
-            self.pdv_states[pdv_ip]['timeout_task'] = asyncio.create_task(
-                self.timeout_checker(pdv_ip, websocket_clients)
-            )
-            
+        if kind == EVENT_HEADER:
+            # Marca como transação ativa e agenda o prazo de inatividade
+            now = time.monotonic()
+            was_active = state['active_transaction']
+            state['active_transaction'] = True
+            state['last_activity'] = now
+            self._arm(pdv_ip, now + self.timeout_seconds)
+            if not was_active and self.on_transaction_change:
+                self.on_transaction_change(pdv_ip, True)
+
         # Verifica fim de transação
-        elif self.is_transaction_end(message):
-            # print(f"PDV {pdv_ip}: Fim de transação detectado")
-            
+        elif kind == EVENT_TOTAL or kind == EVENT_PAYMENT:
             # Reinicia o estado
             self.reset_pdv_state(pdv_ip)
-            
+
         # Verifica se é uma mensagem de produto (atividade durante transação)
-        elif self.pdv_states[pdv_ip]['active_transaction']:
-            is_product = False
-            
-            # Verifica se tem algum padrão de código de barras ou produto
-            # (Personalizar conforme formato dos dados do PDV)
-            if re.search(r'\d{8,13}', message) or 'Produto' in message or 'Item' in message:
-                is_product = True
-            
-            if is_product:
-                # print(f"PDV {pdv_ip}: Atividade detectada durante transação")
-                
-                # Atualiza timestamp de última atividade
-                self.pdv_states[pdv_ip]['last_activity'] = time.time()
-                
-                # Cancela a tarefa de timeout anterior se existir
-                if self.pdv_states[pdv_ip]['timeout_task']:
-                    self.pdv_states[pdv_ip]['timeout_task'].cancel()
-                
-                # Inicia nova tarefa de timeout
-                self.pdv_states[pdv_ip]['timeout_task'] = asyncio.create_task(
-                    self.timeout_checker(pdv_ip, websocket_clients)
-                )
-                
+        elif state['active_transaction']:
+            # Código de barras ou Produto/Item, identificados pelo tokenizador
+            # (Personalizar em message_processor conforme formato dos dados do PDV)
+            if kind == EVENT_ITEM:
+                # Atualiza timestamp de última atividade; o prazo no heap é conferido ao vencer
+                now = time.monotonic()
+                state['last_activity'] = now
+
+                # Após um alerta não há prazo agendado: a nova atividade agenda outro
+                self._arm(pdv_ip, now + self.timeout_seconds)
+
                 return True
-                
-        return False
\ No newline at end of file
+
+        return False
@@ -1,24 +1,145 @@
+import random
+import threading
+import time
 import cv2
 
+# Estados da conexão RTSP
+STATE_DISCONNECTED = "disconnected"
+STATE_CONNECTING = "connecting"
+STATE_CONNECTED = "connected"
+STATE_RECONNECTING = "reconnecting"
+STATE_CLOSED = "closed"
+
 class RTSPConnection:
-    def __init__(self, rtsp_url):
+    def __init__(self, rtsp_url, stall_timeout=10.0, max_failures=3,
+                 backoff_initial=1.0, backoff_max=30.0, open_timeout_ms=5000, read_timeout_ms=5000):
         self.rtsp_url = rtsp_url
         self.cap = None
 
+        # Detecção de travamento: falhas consecutivas ou tempo sem frames
+        self.stall_timeout = stall_timeout
+        self.max_failures = max_failures
+        self.failures = 0
+        self.last_frame_time = None
+
+        # Reconexão com backoff exponencial
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+        self.reconnect_count = 0
+
+        # Timeouts do FFmpeg, para que um DVR fora do ar não trave o grab() indefinidamente
+        self.open_timeout_ms = open_timeout_ms
+        self.read_timeout_ms = read_timeout_ms
+
+        self.state = STATE_DISCONNECTED
+        self._state_listeners = []
+        self._stopped = threading.Event()
+
+    def add_state_listener(self, listener):
+        """Registra listener(state), chamado na thread que alterou o estado"""
+        self._state_listeners.append(listener)
+
+    def _set_state(self, state):
+        if state == self.state:
+            return
+        self.state = state
+        print(f"RTSP {self.rtsp_url}: {state}")
+        for listener in self._state_listeners:
+            try:
+                listener(state)
+            except Exception as e:
+                print(f"Erro ao notificar estado RTSP: {e}")
+
+    def _open_capture(self):
+        if hasattr(cv2, "CAP_PROP_OPEN_TIMEOUT_MSEC"):
+            params = [
+                cv2.CAP_PROP_OPEN_TIMEOUT_MSEC, self.open_timeout_ms,
+                cv2.CAP_PROP_READ_TIMEOUT_MSEC, self.read_timeout_ms
+            ]
+            return cv2.VideoCapture(self.rtsp_url, cv2.CAP_FFMPEG, params)
+        return cv2.VideoCapture(self.rtsp_url)
+
     def connect(self):
-        self.cap = cv2.VideoCapture(self.rtsp_url)
-        if not self.cap.isOpened():
+        if self.state != STATE_RECONNECTING:
+            self._set_state(STATE_CONNECTING)
+
+        cap = self._open_capture()
+        if not cap.isOpened():
+            cap.release()
+            if self.state == STATE_CONNECTING:
+                self._set_state(STATE_DISCONNECTED)
             raise Exception(f"Não foi possível conectar ao RTSP: {self.rtsp_url}")
+
+        self.cap = cap
+        self.failures = 0
+        self.last_frame_time = time.monotonic()
+        self._set_state(STATE_CONNECTED)
         print(f"Conectado ao RTSP: {self.rtsp_url}")
 
     def read_frame(self):
-        if not self.cap.isOpened():
+        self.grab_frame()
+        return self.retrieve_frame()
+
+    def grab_frame(self):
+        """Avança para o próximo frame sem convertê-lo para BGR (caminho barato para frames descartados)"""
+        if not self.cap or not self.cap.isOpened():
             raise Exception("Conexão RTSP não estabelecida")
-        ret, frame = self.cap.read()
-        if not ret:
+        if not self.cap.grab():
+            self.failures += 1
             raise Exception("Falha ao capturar frame RTSP")
+        self.failures = 0
+        self.last_frame_time = time.monotonic()
+
+    def retrieve_frame(self):
+        """Converte para BGR o último frame obtido com grab_frame()"""
+        ret, frame = self.cap.retrieve()
+        if not ret:
+            raise Exception("Falha ao decodificar frame RTSP")
         return frame
 
+    def frame_timestamp(self):
+        """Timestamp do stream (ms) do último frame obtido; 0 se a fonte não informar"""
+        return self.cap.get(cv2.CAP_PROP_POS_MSEC)
+
+    def is_stalled(self):
+        """Indica se o stream deve ser reaberto"""
+        if not self.cap or not self.cap.isOpened():
+            return True
+        if self.failures >= self.max_failures:
+            return True
+        return time.monotonic() - self.last_frame_time > self.stall_timeout
+
+    def reconnect(self):
+        """
+        Reabre o stream com backoff exponencial até conseguir ou até stop_reconnecting()/close().
+        Bloqueante: deve ser chamado na thread de captura. Retorna True se reconectou.
+        """
+        self._set_state(STATE_RECONNECTING)
+        if self.cap:
+            self.cap.release()
+            self.cap = None
+
+        delay = self.backoff_initial
+        while not self._stopped.is_set():
+            try:
+                self.connect()
+                self.reconnect_count += 1
+                return True
+            except Exception as e:
+                print(f"Falha ao reconectar RTSP {self.rtsp_url}: {e}. Nova tentativa em {delay:.0f}s")
+
+            # Jitter evita que todas as câmeras de um DVR reiniciado reconectem ao mesmo tempo
+            if self._stopped.wait(delay * random.uniform(0.8, 1.2)):
+                break
+            delay = min(delay * 2, self.backoff_max)
+        return False
+
+    def stop_reconnecting(self):
+        """Interrompe uma reconexão em andamento (e impede novas)"""
+        self._stopped.set()
+
     def close(self):
+        self._stopped.set()
         if self.cap:
-            self.cap.release()
\ No newline at end of file
+            self.cap.release()
+        self._set_state(STATE_CLOSED)
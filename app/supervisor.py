@@ -0,0 +1,375 @@
+"""
+Modo supervisor: divide as pistas do config.json entre N processos de trabalho.
+
+Cada worker é um UnifiedServer completo que atende só as pistas do seu shard (portas dos
+PDVs, sockets dos DVRs, câmeras), com os WebSockets em sockets Unix. O supervisor mantém
+as portas WebSocket públicas e um roteador fino: o 'register' de cada PDV vai para o
+worker dono da pista e cada pedido RTSP vai para o worker dono da câmera. O vídeo
+(WebRTC) sai direto do worker; pelo roteador passam só a sinalização e as linhas do PDV.
+"""
+import asyncio
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import tempfile
+import zlib
+import websockets
+from pdv_subscriptions import ALL_LANES
+from websockets.exceptions import ConnectionClosed
+
+# Espera (s) antes de reiniciar um worker que caiu, dobrando a cada queda seguida
+WORKER_RESTART_DELAY = 1.0
+WORKER_RESTART_MAX_DELAY = 30.0
+
+def lane_shard(key, shard_count):
+    """Worker dono de uma pista (pdv_ip) ou câmera fora do config.json; estável entre processos e reinícios"""
+    return zlib.crc32(key.encode()) % shard_count
+
+def worker_socket_paths(socket_dir, index):
+    """Caminhos dos sockets Unix (PDV, RTSP) do worker"""
+    return (os.path.join(socket_dir, f"pdv-{index}.sock"),
+            os.path.join(socket_dir, f"rtsp-{index}.sock"))
+
+class LaneRouter:
+    """Roteia as conexões WebSocket dos navegadores para o worker dono da pista"""
+    def __init__(self, socket_dir, shard_count):
+        self.socket_dir = socket_dir
+        self.shard_count = shard_count
+
+        # Câmeras do config.json e o worker da pista a que pertencem
+        self.camera_owner = {}
+
+    def load_config(self, selfs_config):
+        self.camera_owner = {}
+        for config in selfs_config:
+            if config.get('rtsp_url') and config.get('pdv_ip'):
+                self.camera_owner[config['rtsp_url']] = lane_shard(config['pdv_ip'], self.shard_count)
+
+    def pdv_worker(self, pdv_ip):
+        return lane_shard(pdv_ip, self.shard_count)
+
+    def camera_worker(self, rtsp_url):
+        owner = self.camera_owner.get(rtsp_url)
+        return owner if owner is not None else lane_shard(rtsp_url, self.shard_count)
+
+    def mosaic_worker(self, rtsp_urls):
+        """
+        Worker que já decodifica a maior parte das câmeras do mosaico (empate: o da primeira);
+        só as câmeras de outros workers são abertas uma segunda vez para compor o mosaico
+        """
+        owners = [self.camera_worker(url) for url in rtsp_urls]
+        index = max(owners, key=lambda owner: (owners.count(owner), -owners.index(owner)))
+        foreign = [url for url, owner in zip(rtsp_urls, owners) if owner != index]
+        if foreign:
+            print(f"Roteador: mosaico no worker {index}; câmeras de outros workers decodificadas de novo: {', '.join(foreign)}")
+        return index
+
+    async def _connect(self, index, kind):
+        pdv_path, rtsp_path = worker_socket_paths(self.socket_dir, index)
+        return await websockets.unix_connect(pdv_path if kind == "pdv" else rtsp_path,
+                                             ping_interval=None, compression=None, max_size=None)
+
+    async def pdv_handler(self, websocket):
+        """Um navegador pode registrar PDVs de workers diferentes: abre uma conexão por worker envolvido"""
+        upstreams = {}  # { worker: conexão }
+        pumps = {}  # { worker: tarefa que repassa as mensagens do worker }
+        # Pistas registradas por worker { worker: { pdv_ip: batch } }, refeitas quando ele reinicia
+        registered = {}
+
+        async def reconnect(index):
+            # Só as pistas deste worker se perderam: reconecta com backoff e registra de novo
+            delay = WORKER_RESTART_DELAY
+            while True:
+                await asyncio.sleep(delay)
+                try:
+                    upstream = await self._connect(index, "pdv")
+                except OSError:
+                    delay = min(delay * 2, WORKER_RESTART_MAX_DELAY)
+                    continue
+                lanes = registered.get(index, {})
+                try:
+                    for batch in (False, True):
+                        ips = [ip for ip, lane_batch in lanes.items() if lane_batch == batch]
+                        if ips:
+                            await upstream.send(json.dumps({"command": "register", "pdv_ips": ips, "batch": batch}))
+                except ConnectionClosed:
+                    continue
+                print(f"Roteador: worker {index} de volta; PDVs registrados novamente: {', '.join(lanes)}")
+                return upstream
+
+        async def pump(index, upstream):
+            # Repassa ao navegador tudo o que o worker enviar; o worker caiu se a conexão fechar
+            try:
+                while True:
+                    try:
+                        async for message in upstream:
+                            try:
+                                await websocket.send(message)
+                            except ConnectionClosed:
+                                return
+                    except ConnectionClosed:
+                        pass
+                    if upstreams.get(index) is upstream:
+                        del upstreams[index]
+                    if not registered.get(index):
+                        return
+                    upstream = upstreams[index] = await reconnect(index)
+            finally:
+                pumps.pop(index, None)
+
+        async def get_upstream(index):
+            upstream = upstreams.get(index)
+            if upstream is None:
+                if index in pumps:
+                    raise OSError("reconectando ao worker")
+                upstream = upstreams[index] = await self._connect(index, "pdv")
+                pumps[index] = asyncio.create_task(pump(index, upstream))
+            return upstream
+
+        try:
+            async for message in websocket:
+                try:
+                    data = json.loads(message)
+                except json.JSONDecodeError:
+                    continue
+
+                pdv_ip = data.get("pdv_ip")
+                pdv_ips = data.get("pdv_ips")
+                # { worker: (mensagem, pistas) }
+                if pdv_ip == ALL_LANES or (pdv_ips and ALL_LANES in pdv_ips):
+                    # Todas as pistas: cada worker atende as do seu shard
+                    targets = {index: (message, [ALL_LANES]) for index in range(self.shard_count)}
+                elif pdv_ips:
+                    # Várias pistas: cada worker recebe o comando só com as pistas dele
+                    groups = {}
+                    for ip in pdv_ips:
+                        groups.setdefault(self.pdv_worker(ip), []).append(ip)
+                    targets = {index: (json.dumps(dict(data, pdv_ips=ips)), ips) for index, ips in groups.items()}
+                elif pdv_ip:
+                    targets = {self.pdv_worker(pdv_ip): (message, [pdv_ip])}
+                else:
+                    # Comando sem pista: vale para todos os workers desta conexão
+                    targets = {index: (message, []) for index in (list(upstreams) or [0])}
+
+                for index, (worker_message, ips) in targets.items():
+                    # Anota antes de enviar: se o worker estiver fora, o registro é refeito quando ele voltar
+                    if data.get("command") == "register":
+                        for ip in ips:
+                            registered.setdefault(index, {})[ip] = bool(data.get("batch"))
+                    elif data.get("command") == "unregister":
+                        for ip in ips:
+                            registered.get(index, {}).pop(ip, None)
+                    try:
+                        upstream = await get_upstream(index)
+                        await upstream.send(worker_message)
+                    except (OSError, ConnectionClosed) as e:
+                        print(f"Roteador: worker {index} indisponível para o PDV {', '.join(ips)}: {e}")
+                        if data.get("command") == "register":
+                            for ip in ips:
+                                await websocket.send(json.dumps({
+                                    "type": "register_response",
+                                    "success": False,
+                                    "pdv_ip": ip
+                                }))
+        except ConnectionClosed:
+            pass
+        finally:
+            for task in list(pumps.values()):
+                task.cancel()
+            for upstream in upstreams.values():
+                await upstream.close()
+
+    async def rtsp_handler(self, websocket):
+        """A primeira mensagem (URL RTSP ou pedido de mosaico) define o worker; depois só repassa nos dois sentidos"""
+        try:
+            first_message = await websocket.recv()
+        except ConnectionClosed:
+            return
+
+        rtsp_url = first_message
+        if first_message.startswith('{"mosaic":'):
+            try:
+                rtsp_urls = list(json.loads(first_message)['mosaic'] or [''])
+            except (json.JSONDecodeError, KeyError, TypeError):
+                rtsp_urls = ['']
+            index = self.mosaic_worker(rtsp_urls)
+            rtsp_url = f"mosaico de {', '.join(rtsp_urls)}"
+        else:
+            index = self.camera_worker(rtsp_url)
+
+        try:
+            upstream = await self._connect(index, "rtsp")
+        except OSError as e:
+            print(f"Roteador: worker {index} indisponível para {rtsp_url}: {e}")
+            await websocket.close(1013, "worker indisponível")
+            return
+
+        async def forward(source, destination):
+            try:
+                async for message in source:
+                    await destination.send(message)
+            except ConnectionClosed:
+                pass
+
+        try:
+            await upstream.send(first_message)
+            tasks = [asyncio.create_task(forward(websocket, upstream)),
+                     asyncio.create_task(forward(upstream, websocket))]
+            # Quando um lado fecha, fecha o outro
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in tasks:
+                task.cancel()
+        except ConnectionClosed:
+            pass
+        finally:
+            await upstream.close()
+            await websocket.close()
+
+class Supervisor:
+    """Inicia os workers, reinicia os que caírem e atende as portas públicas com o LaneRouter"""
+    def __init__(self, workers, worker_main, server_kwargs, log_level="INFO", event_loop="asyncio"):
+        self.workers = workers
+        self.worker_main = worker_main
+        self.server_kwargs = server_kwargs
+        self.log_level = log_level
+        self.event_loop = event_loop
+
+        self.socket_dir = None
+        self.router = None
+        self._context = multiprocessing.get_context("spawn")
+        self._processes = [None] * workers
+        self._restart_delay = [WORKER_RESTART_DELAY] * workers
+        self._started_at = [0.0] * workers
+        self._stopping = None
+
+    def worker_kwargs(self, index):
+        """Parâmetros do UnifiedServer do worker: portas/diretórios que não podem ser compartilhados"""
+        kwargs = dict(self.server_kwargs, shard_index=index, shard_count=self.workers,
+                      unix_socket_dir=self.socket_dir)
+        if kwargs.get('metrics_port'):
+            kwargs['metrics_port'] += index
+        if kwargs.get('journal_dir'):
+            kwargs['journal_dir'] = os.path.join(kwargs['journal_dir'], f"worker-{index}")
+        return kwargs
+
+    def _start_worker(self, index):
+        # Não-daemon: o worker pode ter seus próprios processos (DecoderPool)
+        process = self._context.Process(
+            target=self.worker_main,
+            args=(self.worker_kwargs(index), self.log_level, self.event_loop),
+            name=f"worker-{index}"
+        )
+        process.start()
+        self._processes[index] = process
+        self._started_at[index] = asyncio.get_running_loop().time()
+        print(f"Worker {index} iniciado (pid {process.pid})")
+
+    def load_config(self):
+        config_path = self.server_kwargs.get('config_path')
+        try:
+            with open(config_path, 'r') as file:
+                return json.load(file)
+        except Exception as e:
+            print(f"Erro ao carregar configuração no supervisor: {e}")
+            return None
+
+    def load_router_config(self):
+        selfs_config = self.load_config()
+        if selfs_config is None:
+            # Na recarga, o roteador (e os workers) seguem com a configuração atual
+            return
+        self.router.load_config(selfs_config)
+        counts = [0] * self.workers
+        for config in selfs_config:
+            counts[lane_shard(config.get('pdv_ip', ''), self.workers)] += 1
+        print(f"Supervisor: {len(selfs_config)} pistas em {self.workers} workers ({', '.join(map(str, counts))})")
+
+    def reload(self):
+        """SIGHUP: atualiza as câmeras do roteador e repassa o sinal para cada worker recarregar o seu shard"""
+        self.load_router_config()
+        for process in self._processes:
+            if process and process.is_alive():
+                os.kill(process.pid, signal.SIGHUP)
+
+    async def run(self):
+        self.socket_dir = tempfile.mkdtemp(prefix="selfcheckout-")
+        self.router = LaneRouter(self.socket_dir, self.workers)
+
+        self.load_router_config()
+
+        for index in range(self.workers):
+            self._start_worker(index)
+
+        # Só as portas dos serviços que os workers atendem no modo de execução
+        mode = self.server_kwargs.get('mode', 'all')
+        servers = []
+        if mode != 'video':
+            ws_ping_interval = self.server_kwargs.get('ws_ping_interval', 20)
+            servers.append(await websockets.serve(
+                self.router.pdv_handler,
+                "0.0.0.0",
+                self.server_kwargs.get('ws_port', 8765),
+                ping_interval=ws_ping_interval or None,
+                ping_timeout=ws_ping_interval or None,
+                compression="deflate" if self.server_kwargs.get('ws_compression', True) else None
+            ))
+            print(f"Roteador WebSocket PDV iniciado em 0.0.0.0:{self.server_kwargs.get('ws_port', 8765)}")
+        if mode != 'pdv':
+            servers.append(await websockets.serve(
+                self.router.rtsp_handler,
+                "0.0.0.0",
+                self.server_kwargs.get('rtsp_ws_port', 8080)
+            ))
+            print(f"Roteador WebSocket RTSP iniciado em 0.0.0.0:{self.server_kwargs.get('rtsp_ws_port', 8080)}")
+
+        self._stopping = asyncio.Event()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, self._stopping.set)
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, self.reload)
+
+        try:
+            await self._watch_workers()
+        finally:
+            for server in servers:
+                server.close()
+
+    async def _watch_workers(self):
+        """Reinicia com backoff os workers que saírem"""
+        restart_at = {}
+        loop = asyncio.get_running_loop()
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), timeout=1.0)
+                break
+            except asyncio.TimeoutError:
+                pass
+
+            for index, process in enumerate(self._processes):
+                if process.is_alive():
+                    continue
+                if index not in restart_at:
+                    # Um worker que ficou de pé por bastante tempo volta ao atraso inicial
+                    if loop.time() - self._started_at[index] > WORKER_RESTART_MAX_DELAY * 2:
+                        self._restart_delay[index] = WORKER_RESTART_DELAY
+                    delay = self._restart_delay[index]
+                    print(f"Worker {index} saiu (código {process.exitcode}); reiniciando em {delay:.0f}s")
+                    restart_at[index] = loop.time() + delay
+                    self._restart_delay[index] = min(delay * 2, WORKER_RESTART_MAX_DELAY)
+                elif loop.time() >= restart_at[index]:
+                    del restart_at[index]
+                    self._start_worker(index)
+
+    def stop(self):
+        """Encerra os workers e remove os sockets Unix"""
+        for process in self._processes:
+            if process and process.is_alive():
+                process.terminate()
+        for process in self._processes:
+            if process:
+                process.join(timeout=5.0)
+                if process.is_alive():
+                    process.kill()
+        if self.socket_dir:
+            shutil.rmtree(self.socket_dir, ignore_errors=True)
+        print("Supervisor encerrado")
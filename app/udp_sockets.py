@@ -0,0 +1,59 @@
+"""
+Opções dos sockets UDP dos PDVs e DVRs e contadores do kernel desses sockets.
+
+Um pico de cupons fechando em muitas pistas ao mesmo tempo pode encher o buffer de recepção
+(SO_RCVBUF) antes de o PDVIngest esvaziá-lo; o kernel descarta o excedente sem avisar a
+aplicação. O contador 'drops' de /proc/net/udp mostra esses descartes por socket.
+"""
+import os
+import socket
+
+# Arquivos do kernel com uma linha por socket UDP (Linux)
+PROC_NET_UDP = ("/proc/net/udp", "/proc/net/udp6")
+
+def set_socket_buffers(udp_socket, rcvbuf=0, sndbuf=0, reuseport=False):
+    """
+    Aplica SO_RCVBUF/SO_SNDBUF (0 = padrão do kernel) e SO_REUSEPORT antes do bind.
+    Retorna os tamanhos efetivos (rcvbuf, sndbuf): o Linux dobra o valor pedido e o limita a
+    net.core.rmem_max / wmem_max
+    """
+    if reuseport:
+        udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    if rcvbuf:
+        udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    if sndbuf:
+        udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+    return (udp_socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF),
+            udp_socket.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF))
+
+def check_buffer_size(name, requested, effective):
+    """Avisa quando o kernel limitou o buffer pedido (o valor efetivo é o dobro do concedido)"""
+    if requested and effective < requested * 2:
+        sysctl = "net.core.rmem_max" if name == "SO_RCVBUF" else "net.core.wmem_max"
+        print(f"AVISO: {name} pedido {requested} bytes, concedido {effective // 2}; aumente {sysctl}")
+
+def socket_inode(udp_socket):
+    """Inode do socket, a chave das linhas de /proc/net/udp"""
+    return os.fstat(udp_socket.fileno()).st_ino
+
+def read_udp_socket_stats(inodes):
+    """
+    Lê de /proc/net/udp a fila de recepção (bytes) e os descartes do kernel dos sockets
+    pedidos: { inode: (rx_queue, drops) }. Vazio fora do Linux
+    """
+    stats = {}
+    for path in PROC_NET_UDP:
+        try:
+            with open(path, 'r') as file:
+                next(file, None)
+                for line in file:
+                    fields = line.split()
+                    # sl local rem st tx_queue:rx_queue tr:tm->when retrnsmt uid timeout inode ref pointer drops
+                    if len(fields) < 13:
+                        continue
+                    inode = int(fields[9])
+                    if inode in inodes:
+                        stats[inode] = (int(fields[4].split(':')[1], 16), int(fields[12]))
+        except OSError:
+            continue
+    return stats
@@ -1,23 +1,172 @@
 import asyncio
+import random
 import time
 import threading
 import queue
-from aiortc import MediaStreamTrack, RTCPeerConnection
+from aiortc import MediaStreamTrack, RTCPeerConnection, RTCConfiguration
+from aiortc.contrib.media import MediaRelay
+from aiortc.mediastreams import MediaStreamError
 import cv2
 import numpy as np
 import fractions
 from av import VideoFrame
 
-class FrameGrabber(threading.Thread):
-    """Thread dedicada para capturar frames do RTSP com redução de qualidade para otimizar CPU"""
-    def __init__(self, rtsp_connection, max_queue_size=90, 
-                 downscale_factor=2.0, frame_skip=2, quality_reduce=50):
-        super().__init__(daemon=True)
-        self.rtsp_connection = rtsp_connection
+# Presets de qualidade disponíveis para os visualizadores
+# Cada preset ativo de uma câmera gera uma única saída redimensionada, compartilhada por todos que o assistem
+# Um preset pode informar "target_fps" para escolher os frames pelo timestamp do stream em vez do frame_skip
+QUALITY_PRESETS = {
+    "low": {"downscale_factor": 4.5, "frame_skip": 2, "quality_reduce": 85},
+    "medium-low": {"downscale_factor": 3.7, "frame_skip": 1, "quality_reduce": 80},
+    "medium": {"downscale_factor": 2.5, "frame_skip": 1, "quality_reduce": 60},
+    "high": {"downscale_factor": 1.5, "frame_skip": 1, "quality_reduce": 30}
+}
+
+# Preset usado quando o cliente não informa um preset válido
+DEFAULT_QUALITY_PRESET = "medium-low"
+
+# Idade máxima (ms) esperada de um frame entre a captura e o envio ao encoder
+FRAME_AGE_TARGET_MS = 200
+
+# Intervalo (s) entre os relatórios de idade dos frames
+FRAME_AGE_REPORT_INTERVAL = 30
+
+# Buffers I420 livres guardados por saída para reutilização (os demais ficam para o coletor)
+YUV_FREE_BUFFERS = 4
+
+# Nova tentativa de abrir uma câmera quente no DecoderPool: mesmo backoff exponencial do RTSPConnection (s)
+OPEN_RETRY_INITIAL = 1.0
+OPEN_RETRY_MAX = 30.0
+
+# Controle de taxa por movimento: variação (0-255) de um pixel da miniatura cinza que conta como mudança,
+# fração de pixels mudados que conta como movimento, taxa com a cena parada e por quanto tempo
+# a taxa cheia é mantida depois do último movimento
+MOTION_PIXEL_DELTA = 10
+MOTION_MIN_CHANGED = 0.002
+MOTION_IDLE_FPS = 1.0
+MOTION_HOLD_SECONDS = 3.0
+MOTION_THUMBNAIL_SIZE = (64, 36)
+
+class MotionGate:
+    """
+    Decide se um frame já reduzido deve seguir para a conversão e o encoder. Compara uma
+    miniatura cinza com a do frame anterior: com a cena parada deixa passar ~idle_fps,
+    com movimento (ou com a transação do PDV ativa, via forced) volta à taxa cheia
+    """
+    def __init__(self, pixel_delta=MOTION_PIXEL_DELTA, min_changed=MOTION_MIN_CHANGED, idle_fps=MOTION_IDLE_FPS,
+                 hold_seconds=MOTION_HOLD_SECONDS, thumbnail_size=MOTION_THUMBNAIL_SIZE):
+        self.pixel_delta = pixel_delta
+        self.idle_interval = 1.0 / idle_fps
+        self.hold_seconds = hold_seconds
+        self.thumbnail_size = thumbnail_size
+        
+        # Ativado de fora (loop de eventos) quando a pista tem transação em andamento
+        self.forced = False
+        
+        width, height = thumbnail_size
+        self.min_changed_pixels = max(1, int(width * height * min_changed))
+        self._small = np.empty((height, width, 3), dtype=np.uint8)
+        self._thumbnail = np.empty((height, width), dtype=np.uint8)
+        self._previous = np.empty((height, width), dtype=np.uint8)
+        self._diff = np.empty((height, width), dtype=np.uint8)
+        self._has_previous = False
+        
+        self.active_until = 0.0
+        self.next_idle_frame = 0.0
+        self.frames_gated = 0
+        
+    def should_publish(self, frame):
+        now = time.monotonic()
+        
+        cv2.resize(frame, self.thumbnail_size, dst=self._small, interpolation=cv2.INTER_AREA)
+        cv2.cvtColor(self._small, cv2.COLOR_BGR2GRAY, dst=self._thumbnail)
+        
+        if self._has_previous:
+            cv2.absdiff(self._thumbnail, self._previous, dst=self._diff)
+            cv2.threshold(self._diff, self.pixel_delta, 255, cv2.THRESH_BINARY, dst=self._diff)
+            if cv2.countNonZero(self._diff) >= self.min_changed_pixels:
+                self.active_until = now + self.hold_seconds
+        else:
+            self._has_previous = True
+            self.active_until = now + self.hold_seconds
+        self._thumbnail, self._previous = self._previous, self._thumbnail
+        
+        if self.forced or now < self.active_until:
+            return True
+        
+        # Cena parada: um frame a cada idle_interval
+        if now >= self.next_idle_frame:
+            self.next_idle_frame = now + self.idle_interval
+            return True
+        
+        self.frames_gated += 1
+        return False
+
+class FrameAgeStats:
+    """Acumula a idade dos frames no momento do envio e imprime um resumo periódico"""
+    def __init__(self, label, report_interval=FRAME_AGE_REPORT_INTERVAL):
+        self.label = label
+        self.report_interval = report_interval
+        self.last_age_ms = 0.0
+        self._reset(time.monotonic())
+        
+    def _reset(self, now):
+        self.window_start = now
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.late = 0
+        
+    def record(self, capture_time):
+        """Registra um frame enviado agora que foi capturado em capture_time (time.time())"""
+        age_ms = (time.time() - capture_time) * 1000
+        self.last_age_ms = age_ms
+        self.count += 1
+        self.total_ms += age_ms
+        if age_ms > self.max_ms:
+            self.max_ms = age_ms
+        if age_ms > FRAME_AGE_TARGET_MS:
+            self.late += 1
+            
+        now = time.monotonic()
+        if now - self.window_start >= self.report_interval:
+            print(f"[VIDEO] {self.label}: idade dos frames média {self.total_ms / self.count:.0f} ms, "
+                  f"máx {self.max_ms:.0f} ms, {self.late}/{self.count} acima de {FRAME_AGE_TARGET_MS} ms")
+            self._reset(now)
+
+class FrameOutput:
+    """
+    Saída de um preset de qualidade: aplica frame skip e redução de resolução sobre os frames decodificados.
+    Os frames publicados já estão em YUV420p (I420), o formato consumido pelos encoders, e todas as
+    etapas escrevem em buffers pré-alocados
+    """
+    def __init__(self, quality_preset, max_queue_size=90,
+                 downscale_factor=2.0, frame_skip=2, quality_reduce=50, target_fps=None, live=False,
+                 motion_gating=False):
+        self.quality_preset = quality_preset
         self.queue = queue.Queue(maxsize=max_queue_size)
-        self.running = True
         self.frame_count = 0
-        self.start_time = time.time()
+        
+        # Modo "live": slot único sobrescrito a cada frame, o consumidor sempre recebe o mais recente
+        self.live = live
+        self._latest = None
+        self._latest_lock = threading.Lock()
+        
+        # Buffers reutilizados a cada frame: redimensionamento e blur (BGR) e a saída I420.
+        # Os I420 vêm de uma lista de livres: o consumidor devolve o buffer com release() depois
+        # de copiá-lo, e os frames descartados (fila cheia, slot sobrescrito) voltam para a lista.
+        # Um novo buffer só é alocado com a lista vazia, então a memória acompanha os frames de
+        # fato pendentes, não o tamanho máximo da fila
+        self._resize_buffer = None
+        self._blur_buffer = None
+        self._free_yuv_buffers = []
+        self._yuv_shape = None
+        self.yuv_buffers_allocated = 0
+        
+        # Espera do consumidor no loop de eventos (acordado pela thread de captura, sem polling)
+        self._loop = None
+        self._event = None
+        self._waiting = False
+        self.closed = False
         
         # Parâmetros de otimização
         self.downscale_factor = downscale_factor  # Reduz tamanho da imagem (2.0 = 50% do tamanho)
@@ -25,54 +174,152 @@ class FrameGrabber(threading.Thread):
         self.quality_reduce = quality_reduce  # Reduz qualidade de JPEG (0-100, menor = mais compressão)
         self.frame_skip_counter = 0
         
-    def run(self):
-        while self.running:
+        # Modo FPS alvo: mantém um frame a cada 1/target_fps segundos do stream
+        self.target_fps = target_fps
+        self.next_frame_time = None
+        
+        # Reduz a taxa para ~1 fps com a cena parada (etapa depois do redimensionamento)
+        self.motion_gate = MotionGate() if motion_gating else None
+        
+    def wants_frame(self, stream_time_ms):
+        """Decide, antes da decodificação, se o próximo frame será usado por esta saída"""
+        if self.target_fps:
+            if self.next_frame_time is not None and stream_time_ms < self.next_frame_time:
+                return False
+            
+            interval = 1000.0 / self.target_fps
+            if self.next_frame_time is None or stream_time_ms - self.next_frame_time >= interval:
+                # Primeiro frame ou stream atrasado/reiniciado: ressincroniza com o timestamp atual
+                self.next_frame_time = stream_time_ms + interval
+            else:
+                self.next_frame_time += interval
+            return True
+        
+        # Frame skipping - ignora alguns frames para reduzir carga
+        self.frame_skip_counter += 1
+        return self.frame_skip_counter % self.frame_skip == 0
+        
+    def push(self, frame, timestamp, capture_time):
+        """Recebe um frame decodificado aceito por wants_frame() e publica a versão reduzida"""
+        self.frame_count += 1
+        if self._publish(frame, timestamp, capture_time):
+            self._notify()
+        
+    def poll(self):
+        """Retorna o próximo frame (frame, timestamp, capture_time) disponível ou None"""
+        if self.live:
+            with self._latest_lock:
+                item, self._latest = self._latest, None
+            return item
+        
+        try:
+            return self.queue.get_nowait()
+        except queue.Empty:
+            return None
+        
+    async def get(self):
+        """Aguarda o próximo frame; retorna None se a saída for fechada"""
+        if self._event is None:
+            self._loop = asyncio.get_running_loop()
+            self._event = asyncio.Event()
+            
+        while not self.closed:
+            item = self.poll()
+            if item is not None:
+                return item
+            
+            self._event.clear()
+            self._waiting = True
+            # Verifica de novo após sinalizar a espera, para não perder um frame publicado entre as duas etapas
+            item = self.poll()
+            if item is not None:
+                self._waiting = False
+                return item
+            await self._event.wait()
+        return None
+        
+    def _notify(self):
+        """Acorda o consumidor, chamado na thread de captura"""
+        if self._waiting:
+            self._waiting = False
+            self._loop.call_soon_threadsafe(self._event.set)
+            
+    def close(self):
+        self.closed = True
+        if self._loop:
+            self._loop.call_soon_threadsafe(self._event.set)
+        
+    def output_size(self, frame_shape):
+        """Calcula (largura, altura) da saída para um frame de entrada (pares, exigência do I420)"""
+        width = int(frame_shape[1] / self.downscale_factor) & ~1
+        height = int(frame_shape[0] / self.downscale_factor) & ~1
+        return width, height
+        
+    def _take_yuv_buffer(self, width, height):
+        """Retorna um buffer I420 livre para uma saída width x height, alocando só se não houver"""
+        shape = (height * 3 // 2, width)
+        if shape != self._yuv_shape:
+            # Resolução mudou (reconexão da câmera): os buffers antigos não servem mais
+            self._yuv_shape = shape
+            self._free_yuv_buffers = []
+        try:
+            return self._free_yuv_buffers.pop()
+        except IndexError:
+            self.yuv_buffers_allocated += 1
+            return np.empty(shape, dtype=np.uint8)
+        
+    def release(self, frame):
+        """Devolve um frame I420 já copiado pelo consumidor (ou descartado) à lista de livres"""
+        if frame.shape == self._yuv_shape and len(self._free_yuv_buffers) < YUV_FREE_BUFFERS:
+            self._free_yuv_buffers.append(frame)
+        
+    def _publish(self, frame, timestamp, capture_time):
+        """Reduz e converte o frame; retorna False se ele foi descartado (cena parada)"""
+        # Reduz resolução do frame e converte para I420 uma única vez, aqui na thread de captura
+        resized = self._downscale_frame(frame)
+        if self.motion_gate and not self.motion_gate.should_publish(resized):
+            return False
+        
+        frame = self._take_yuv_buffer(resized.shape[1], resized.shape[0])
+        cv2.cvtColor(resized, cv2.COLOR_BGR2YUV_I420, dst=frame)
+        
+        if self.live:
+            with self._latest_lock:
+                previous, self._latest = self._latest, (frame, timestamp, capture_time)
+            # Frame anterior não chegou ao consumidor: o buffer volta para a lista
+            if previous is not None:
+                self.release(previous[0])
+            return True
+        
+        # Se a fila estiver cheia, remove o frame mais antigo
+        if self.queue.full():
             try:
-                frame = self.rtsp_connection.read_frame()
-                if frame is not None:
-                    # Frame skipping - ignora alguns frames para reduzir carga
-                    self.frame_skip_counter += 1
-                    if self.frame_skip_counter % self.frame_skip != 0:
-                        continue
-                    
-                    # Reduz resolução do frame
-                    frame = self._downscale_frame(frame)
-                    
-                    # Calcula o timestamp
-                    self.frame_count += 1
-                    timestamp = int((time.time() - self.start_time) * 90000)  # Unidade de 90kHz para pts
-                    
-                    # Se a fila estiver cheia, remove o frame mais antigo
-                    if self.queue.full():
-                        try:
-                            self.queue.get_nowait()
-                        except queue.Empty:
-                            pass
-                    
-                    # Adiciona o novo frame
-                    try:
-                        self.queue.put((frame, timestamp), block=False)
-                    except queue.Full:
-                        pass  # Ignora se estiver cheio, pegará o próximo frame
-                else:
-                    # Pequena pausa para não sobrecarregar a CPU quando não há frames
-                    time.sleep(0.01)
-            except Exception as e:
-                print(f"Erro ao capturar frame: {e}")
-                time.sleep(0.1)  # Pausa antes de tentar novamente
+                self.release(self.queue.get_nowait()[0])
+            except queue.Empty:
+                pass
+        
+        # Adiciona o novo frame
+        try:
+            self.queue.put((frame, timestamp, capture_time), block=False)
+        except queue.Full:
+            self.release(frame)  # Ignora se estiver cheio, pegará o próximo frame
+        return True
 
     def _downscale_frame(self, frame):
         """Reduz a qualidade e tamanho da imagem para diminuir uso de CPU"""
         # Reduz resolução
-        width = int(frame.shape[1] / self.downscale_factor)
-        height = int(frame.shape[0] / self.downscale_factor)
+        width, height = self.output_size(frame.shape)
+        
+        if self._resize_buffer is None or self._resize_buffer.shape[:2] != (height, width):
+            self._resize_buffer = np.empty((height, width, 3), dtype=np.uint8)
+            self._blur_buffer = np.empty_like(self._resize_buffer)
         
         # Usa interpolação mais rápida (INTER_NEAREST é o método mais rápido)
-        resized = cv2.resize(frame, (width, height), interpolation=cv2.INTER_NEAREST)
+        resized = cv2.resize(frame, (width, height), dst=self._resize_buffer, interpolation=cv2.INTER_NEAREST)
         
         # Opcional: aplica blur para reduzir detalhes (mais compressão)
         if self.quality_reduce > 70:  # Só aplica blur se a redução for significativa
-            resized = cv2.GaussianBlur(resized, (3, 3), 0)
+            resized = cv2.GaussianBlur(resized, (3, 3), 0, dst=self._blur_buffer)
             
         # Opcionalmente, converte para escala de cinza para reduzir ainda mais o processamento
         # Se eu quiser tirar as cores:
@@ -80,174 +327,427 @@ class FrameGrabber(threading.Thread):
         # resized = cv2.cvtColor(resized, cv2.COLOR_GRAY2BGR)  # Converte de volta para BGR se necessário
         
         return resized
+
+class FrameGrabber(threading.Thread):
+    """Thread dedicada para capturar frames do RTSP: decodifica uma única vez e alimenta cada saída de qualidade ativa"""
+    def __init__(self, rtsp_connection):
+        super().__init__(daemon=True)
+        self.rtsp_connection = rtsp_connection
+        self.running = True
+        self.frame_count = 0
+        self.frames_skipped = 0
+        self.start_time = time.time()
+        
+        # Saídas ativas (uma por preset). A tupla é substituída por inteiro a cada alteração,
+        # assim a thread de captura itera sobre um snapshot sem precisar de lock
+        self.outputs = ()
+        self._outputs_lock = threading.Lock()
+        
+    def add_output(self, output):
+        with self._outputs_lock:
+            self.outputs = self.outputs + (output,)
+            
+    def remove_output(self, output):
+        with self._outputs_lock:
+            self.outputs = tuple(o for o in self.outputs if o is not output)
+        
+    def run(self):
+        while self.running:
+            try:
+                # Avança o stream sem converter o frame; só os frames usados por alguma saída são recuperados
+                self.rtsp_connection.grab_frame()
+                capture_time = time.time()
+                
+                stream_time = self.rtsp_connection.frame_timestamp()
+                if stream_time <= 0:
+                    # Fonte sem timestamp: usa o relógio local
+                    stream_time = (time.time() - self.start_time) * 1000
+                
+                outputs = [output for output in self.outputs if output.wants_frame(stream_time)]
+                if not outputs:
+                    self.frames_skipped += 1
+                    continue
+                
+                frame = self.rtsp_connection.retrieve_frame()
+                
+                # Calcula o timestamp
+                self.frame_count += 1
+                timestamp = int((time.time() - self.start_time) * 90000)  # Unidade de 90kHz para pts
+                
+                # Distribui o mesmo frame decodificado para as saídas que o aceitaram
+                for output in outputs:
+                    output.push(frame, timestamp, capture_time)
+            except Exception as e:
+                # Registra apenas a primeira falha de uma sequência
+                if self.rtsp_connection.failures <= 1:
+                    print(f"Erro ao capturar frame: {e}")
+                    
+                if self.rtsp_connection.is_stalled():
+                    # Stream travado ou caído: reabre com backoff (bloqueia apenas esta thread)
+                    if not self.rtsp_connection.reconnect():
+                        break
+                else:
+                    time.sleep(0.1)  # Pausa antes de tentar novamente
     
     def stop(self):
         self.running = False
+        self.rtsp_connection.stop_reconnecting()
         self.join(timeout=1.0)
 
 class VideoStreamTrack(MediaStreamTrack):
-    """Implementação aprimorada de MediaStreamTrack com buffering e redução de qualidade"""
+    """MediaStreamTrack de origem de um preset; os visualizadores a consomem através do MediaRelay"""
     kind = "video"
 
-    def __init__(self, rtsp_connection, downscale_factor=2.0, frame_skip=2, quality_reduce=50):
+    def __init__(self, frame_output, label=None):
         super().__init__()
-        self.rtsp_connection = rtsp_connection
-        
-        # Cria frame grabber com parâmetros de qualidade reduzida
-        self.frame_grabber = FrameGrabber(
-            rtsp_connection, 
-            downscale_factor=downscale_factor,
-            frame_skip=frame_skip,
-            quality_reduce=quality_reduce
-        )
-        self.frame_grabber.start()
+        self.frame_output = frame_output
         self.time_base = fractions.Fraction(1, 90000)  # Base de tempo padrão para vídeo
+        self.frame_age = FrameAgeStats(label or frame_output.quality_preset)
+        self.frames_sent = 0
         
     async def recv(self):
-        # Espera até que haja um frame disponível
-        while self.frame_grabber.queue.empty():
-            await asyncio.sleep(0.01)
+        if self.readyState != "live":
+            raise MediaStreamError
         
-        # Obtém o próximo frame da fila
-        frame, timestamp = self.frame_grabber.queue.get()
+        # Espera até que haja um frame disponível
+        item = await self.frame_output.get()
+        if item is None:
+            raise MediaStreamError
         
-        # Converte para formato compatível com aiortc
-        # Já estamos trabalhando com frames reduzidos, então essa conversão será mais rápida
-        frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        frame, timestamp, capture_time = item
         
-        # Cria um VideoFrame do PyAV
-        video_frame = VideoFrame.from_ndarray(frame_rgb, format="rgb24")
+        # Cria um VideoFrame do PyAV direto do I420: os encoders não precisam reformatar para cada visualizador
+        video_frame = VideoFrame.from_ndarray(frame, format="yuv420p")
+        # from_ndarray copiou os planos: o buffer pode ser reutilizado pela saída
+        self.frame_output.release(frame)
         
         # Define o timestamp correto
         video_frame.pts = timestamp
         video_frame.time_base = self.time_base
         
+        self.frame_age.record(capture_time)
+        self.frames_sent += 1
+        
         return video_frame
     
     def stop(self):
-        """Método para encerrar corretamente a captura de frames"""
-        if self.frame_grabber:
-            self.frame_grabber.stop()
+        super().stop()
+        self.frame_output.close()
 
-class WebRTCConversion:
-    # Dicionário estático para compartilhar instâncias por URL
-    _shared_instances = {}
-    _track_refs = {}  # Contador de referências para tracks
+class VideoPipeline:
+    """
+    Pipeline de vídeo compartilhado por câmera: uma única decodificação RTSP
+    alimenta uma saída redimensionada por preset ativo, e cada visualizador
+    recebe sua própria cópia da saída através de um MediaRelay
+    """
+    # Dicionário estático para compartilhar pipelines por URL
+    _instances = {}
+    
+    # Pool de processos decodificadores (DecoderPool); None decodifica em threads no próprio processo
+    decoder_pool = None
+    
+    # Modo de baixa latência: cada saída entrega sempre o frame mais recente, sem fila
+    live_mode = False
+    
+    # Taxa adaptativa por movimento nas saídas (ver MotionGate)
+    motion_gating = False
+    
+    # Câmeras cuja pista está com transação ativa: taxa cheia mesmo sem movimento
+    _active_lanes = set()
     
     @classmethod
-    def get_instance(cls, rtsp_url, **kwargs):
-        """Método para obter uma instância compartilhada ou criar uma nova"""
-        if rtsp_url not in cls._shared_instances:
-            cls._shared_instances[rtsp_url] = WebRTCConversion(**kwargs)
-            cls._track_refs[rtsp_url] = 0
-        return cls._shared_instances[rtsp_url]
+    def get_instance(cls, rtsp_url):
+        """Obtém o pipeline compartilhado da URL ou cria um novo"""
+        if rtsp_url not in cls._instances:
+            cls._instances[rtsp_url] = VideoPipeline(rtsp_url)
+        return cls._instances[rtsp_url]
     
     @classmethod
-    def release_instance(cls, rtsp_url):
-        """Libera a instância se não estiver mais em uso"""
-        if rtsp_url in cls._track_refs:
-            cls._track_refs[rtsp_url] -= 1
-            if cls._track_refs[rtsp_url] <= 0:
-                if rtsp_url in cls._shared_instances:
-                    # Fechamos de forma assíncrona em outro lugar
-                    cls._shared_instances.pop(rtsp_url, None)
-                cls._track_refs.pop(rtsp_url, None)
+    def dispatch_camera_state(cls, rtsp_url, state):
+        """Entrega ao pipeline da URL uma mudança de estado da câmera (chamado em qualquer thread)"""
+        pipeline = cls._instances.get(rtsp_url)
+        if pipeline:
+            pipeline._on_camera_state(state)
     
-    def __init__(self, reuse_connection=True, downscale_factor=2.0, frame_skip=2, quality_reduce=50):
-        self.pc_list = []  # Lista de peer connections
+    @classmethod
+    def set_lane_active(cls, rtsp_url, active):
+        """Marca a transação da pista da câmera como ativa/inativa (chamado no loop de eventos)"""
+        if active:
+            cls._active_lanes.add(rtsp_url)
+        else:
+            cls._active_lanes.discard(rtsp_url)
+        
+        if not cls.motion_gating:
+            return
+        if cls.decoder_pool:
+            cls.decoder_pool.set_lane_active(rtsp_url, active)
+            return
+        pipeline = cls._instances.get(rtsp_url)
+        if not pipeline:
+            return
+        for frame_output, _ in pipeline.outputs.values():
+            if frame_output.motion_gate:
+                frame_output.motion_gate.forced = active
+    
+    def __init__(self, rtsp_url):
+        self.rtsp_url = rtsp_url
         self.rtsp_connection = None
-        self.video_track = None
-        self.reuse_connection = reuse_connection
-        self.rtsp_url = None
+        self.frame_grabber = None
+        self.relay = MediaRelay()
         
-        # Parâmetros de qualidade
-        self.downscale_factor = downscale_factor
-        self.frame_skip = frame_skip
-        self.quality_reduce = quality_reduce
-        self.is_connected = False
-
-    async def connect(self, rtsp_url):
-        from rtsp_connection import RTSPConnection
+        # Indica se a câmera está aberta no DecoderPool
+        self.is_open = False
         
-        self.rtsp_url = rtsp_url
+        # Câmera mantida aberta mesmo sem visualizadores (pool de conexões quentes)
+        self.warm = False
         
-        if not self.is_connected:
-            # Inicializa a conexão RTSP apenas uma vez
-            if not self.rtsp_connection or not self.reuse_connection:
-                if self.rtsp_connection:
-                    self.rtsp_connection.close()
+        # Saídas por preset: { preset: (FrameOutput, VideoStreamTrack) }
+        self.outputs = {}
+        
+        # Contador de visualizadores por preset
+        self.subscribers = {}
+        
+        # Estado da câmera e listeners das sessões (chamados no loop de eventos)
+        self.camera_state = None
+        self._state_listeners = []
+        self._loop = None
+        
+        self._lock = asyncio.Lock()
+        
+    def add_state_listener(self, listener):
+        self._state_listeners.append(listener)
+        
+    def remove_state_listener(self, listener):
+        if listener in self._state_listeners:
+            self._state_listeners.remove(listener)
+        
+    def _on_camera_state(self, state):
+        """Recebe o estado da thread de captura e o repassa às sessões no loop de eventos"""
+        self.camera_state = state
+        if self._loop and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._notify_state, state)
+            
+    def _notify_state(self, state):
+        for listener in list(self._state_listeners):
+            try:
+                listener(state)
+            except Exception as e:
+                print(f"Erro ao notificar estado da câmera {self.rtsp_url}: {e}")
+        
+    async def _open(self, wait_connected=True):
+        """Inicia a decodificação da câmera, se ainda não estiver rodando (chamado com o lock)"""
+        self._loop = asyncio.get_running_loop()
+        
+        if self.decoder_pool:
+            if not self.is_open:
+                await self.decoder_pool.open_camera(self.rtsp_url)
+                self.is_open = True
+                print(f"Pipeline de vídeo iniciado para {self.rtsp_url} (processo decodificador)")
+            return
+            
+        if not self.frame_grabber:
+            from rtsp_connection import RTSPConnection
+            
+            self.rtsp_connection = RTSPConnection(self.rtsp_url)
+            self.rtsp_connection.add_state_listener(self._on_camera_state)
+            
+            if wait_connected:
+                # A abertura do RTSP é bloqueante; executa fora do loop de eventos
+                await self._loop.run_in_executor(None, self.rtsp_connection.connect)
+            
+            # Sem conexão aberta, o próprio FrameGrabber conecta (e reconecta) com backoff
+            self.frame_grabber = FrameGrabber(self.rtsp_connection)
+            self.frame_grabber.start()
+            print(f"Pipeline de vídeo iniciado para {self.rtsp_url}")
+            
+    async def keep_warm(self):
+        """
+        Mantém a câmera aberta mesmo sem visualizadores, para que a troca de quadrante seja imediata.
+        No DecoderPool a abertura espera a conexão e pode falhar: tenta de novo com backoff até
+        conseguir ou até release_warm() (sem DecoderPool, o FrameGrabber já reconecta sozinho)
+        """
+        self.warm = True
+        delay = OPEN_RETRY_INITIAL
+        while True:
+            try:
+                async with self._lock:
+                    await self._open(wait_connected=False)
+                return
+            except Exception as e:
+                print(f"Erro ao abrir câmera {self.rtsp_url}: {e}. Nova tentativa em {delay:.0f}s")
+            await asyncio.sleep(delay * random.uniform(0.8, 1.2))
+            if not self.warm:
+                raise Exception(f"câmera {self.rtsp_url} retirada da configuração")
+            delay = min(delay * 2, OPEN_RETRY_MAX)
+        
+    async def add_background_output(self, frame_output):
+        """Mantém a câmera aberta alimentando uma saída sem visualizador (ex.: buffer pré-evento de clipes)"""
+        self.warm = True
+        async with self._lock:
+            await self._open(wait_connected=False)
+            self.frame_grabber.add_output(frame_output)
+        
+    async def remove_background_output(self, frame_output):
+        """Retira uma saída adicionada por add_background_output (a câmera continua aberta)"""
+        async with self._lock:
+            if self.frame_grabber:
+                self.frame_grabber.remove_output(frame_output)
+        
+    async def release_warm(self):
+        """Desfaz o keep_warm (câmera fora da configuração): encerra a decodificação se não houver visualizadores"""
+        async with self._lock:
+            self.warm = False
+            if not self.subscribers:
+                self._shutdown()
+        
+    async def subscribe(self, quality_preset):
+        """Registra um visualizador no preset e retorna sua track de relay"""
+        # Conta o visualizador antes de qualquer await para que um unsubscribe
+        # concorrente não encerre o pipeline enquanto ele ainda está sendo configurado
+        self.subscribers[quality_preset] = self.subscribers.get(quality_preset, 0) + 1
+        
+        try:
+            async with self._lock:
+                await self._open()
+                    
+                if quality_preset not in self.outputs:
+                    if self.decoder_pool:
+                        frame_output = self.decoder_pool.add_output(
+                            self.rtsp_url, quality_preset,
+                            dict(QUALITY_PRESETS[quality_preset], motion_gating=self.motion_gating))
+                    else:
+                        frame_output = FrameOutput(quality_preset, live=self.live_mode, motion_gating=self.motion_gating,
+                                                   **QUALITY_PRESETS[quality_preset])
+                        if frame_output.motion_gate:
+                            frame_output.motion_gate.forced = self.rtsp_url in self._active_lanes
+                        self.frame_grabber.add_output(frame_output)
+                    track = VideoStreamTrack(frame_output, label=f"{self.rtsp_url} ({quality_preset})")
+                    self.outputs[quality_preset] = (frame_output, track)
+                    print(f"Saída '{quality_preset}' criada para {self.rtsp_url}")
+                    
+                _, track = self.outputs[quality_preset]
+                return self.relay.subscribe(track, buffered=False)
+        except Exception:
+            await self.unsubscribe(quality_preset)
+            raise
+            
+    async def unsubscribe(self, quality_preset, relay_track=None):
+        """Remove um visualizador do preset, liberando a saída e a decodificação quando não houver mais ninguém"""
+        if relay_track:
+            relay_track.stop()
+            
+        async with self._lock:
+            remaining = self.subscribers.get(quality_preset, 0) - 1
+            if remaining > 0:
+                self.subscribers[quality_preset] = remaining
+                return
+            
+            self.subscribers.pop(quality_preset, None)
+            if quality_preset in self.outputs:
+                frame_output, track = self.outputs.pop(quality_preset)
+                if self.frame_grabber:
+                    self.frame_grabber.remove_output(frame_output)
+                elif self.is_open:
+                    self.decoder_pool.remove_output(self.rtsp_url, quality_preset)
+                track.stop()
+                print(f"Saída '{quality_preset}' encerrada para {self.rtsp_url}")
+                
+            # Câmeras quentes continuam abertas (apenas avançando o stream, sem decodificar para BGR)
+            if not self.subscribers and not self.warm:
+                self._shutdown()
+                
+    def _shutdown(self):
+        """Encerra a decodificação e remove o pipeline compartilhado"""
+        try:
+            if self.frame_grabber:
+                self.frame_grabber.stop()
+                self.frame_grabber = None
+                
+            if self.is_open:
+                self.decoder_pool.close_camera(self.rtsp_url)
+                self.is_open = False
                 
-                self.rtsp_connection = RTSPConnection(rtsp_url)
-                self.rtsp_connection.connect()
+            if self.rtsp_connection:
+                self.rtsp_connection.close()
+                self.rtsp_connection = None
+                
+            print(f"Pipeline de vídeo para {self.rtsp_url} encerrado e recursos liberados")
+        except Exception as e:
+            print(f"Erro ao liberar recursos do pipeline de vídeo: {e}")
             
-            # Cria a track de vídeo compartilhada apenas uma vez
-            if not self.video_track:
-                self.video_track = VideoStreamTrack(
-                    self.rtsp_connection,
-                    downscale_factor=self.downscale_factor,
-                    frame_skip=self.frame_skip,
-                    quality_reduce=self.quality_reduce
-                )
+        if VideoPipeline._instances.get(self.rtsp_url) is self:
+            VideoPipeline._instances.pop(self.rtsp_url, None)
+
+class WebRTCConversion:
+    """Sessão WebRTC de um visualizador, alimentada pelo pipeline compartilhado da câmera"""
+    def __init__(self, quality_preset=DEFAULT_QUALITY_PRESET, on_camera_state=None):
+        # Usa o preset padrão se o solicitado não existir
+        if quality_preset not in QUALITY_PRESETS:
+            quality_preset = DEFAULT_QUALITY_PRESET
             
-            self.is_connected = True
-            WebRTCConversion._track_refs[rtsp_url] += 1
+        self.quality_preset = quality_preset
+        self.pc = None
+        self.pipeline = None
+        self.video_track = None
+        self.rtsp_url = None
+        self.is_connected = False
+        
+        # Callback on_camera_state(state) chamado quando a câmera cai, reconecta, etc.
+        self.on_camera_state = on_camera_state
+
+    async def connect(self, rtsp_url):
+        if self.is_connected:
+            return
             
-            print(f"WebRTC conectado e configurado com RTSP: {rtsp_url}")
-            print(f"Otimizações: downscale={self.downscale_factor}x, skip={self.frame_skip} frames, quality={self.quality_reduce}%")
+        self.rtsp_url = rtsp_url
+        self.pipeline = VideoPipeline.get_instance(rtsp_url)
+        self.video_track = await self.pipeline.subscribe(self.quality_preset)
+        self.is_connected = True
+        
+        if self.on_camera_state:
+            self.pipeline.add_state_listener(self.on_camera_state)
+        
+        preset = QUALITY_PRESETS[self.quality_preset]
+        print(f"WebRTC conectado e configurado com RTSP: {rtsp_url}")
+        print(f"Otimizações ({self.quality_preset}): downscale={preset['downscale_factor']}x, skip={preset['frame_skip']} frames, quality={preset['quality_reduce']}%")
 
     async def create_offer(self):
         if not self.is_connected:
             raise Exception("WebRTC não inicializado. Chame connect() primeiro.")
-        # Cria um novo peer connection para cada cliente
-        from aiortc import RTCConfiguration
-        config = RTCConfiguration(iceServers=[])  # Corrigi a indentação desta linha
-        pc = RTCPeerConnection(configuration=config)
-        # Reutiliza a mesma track de vídeo
-        pc.addTrack(self.video_track)
-        self.pc_list.append(pc)
-        offer = await pc.createOffer()
-        await pc.setLocalDescription(offer)
-        return pc.localDescription
+        if self.pc:
+            await self.pc.close()
+            
+        config = RTCConfiguration(iceServers=[])
+        self.pc = RTCPeerConnection(configuration=config)
+        # Cada visualizador tem sua própria track de relay
+        self.pc.addTrack(self.video_track)
+        offer = await self.pc.createOffer()
+        await self.pc.setLocalDescription(offer)
+        return self.pc.localDescription
 
     async def process_answer(self, answer):
-        if not self.pc_list:
+        if not self.pc:
             raise Exception("WebRTC não inicializado corretamente.")
         
-        # Processa a resposta no peer connection mais recente
-        await self.pc_list[-1].setRemoteDescription(answer)
+        await self.pc.setRemoteDescription(answer)
         print("Resposta SDP processada com sucesso")
 
     async def close(self):
-        """Fecha conexões WebRTC e libera recursos de forma forçada"""
-        # Fecha todos os peer connections
-        for pc in self.pc_list:
+        """Fecha a conexão WebRTC e libera a assinatura no pipeline compartilhado"""
+        if self.pc:
             try:
-                await pc.close()
+                await self.pc.close()
             except Exception as e:
                 print(f"Erro ao fechar peer connection: {e}")
-        self.pc_list.clear()
-        
-        # Libera recursos compartilhados se não houver mais referências
-        if self.rtsp_url and self.rtsp_url in WebRTCConversion._track_refs:
-            WebRTCConversion.release_instance(self.rtsp_url)
-            
-            # Só fecha efetivamente se for a última referência
-            if WebRTCConversion._track_refs.get(self.rtsp_url, 0) <= 0:
-                try:
-                    if self.video_track:
-                        self.video_track.stop()
-                        self.video_track = None
-                    
-                    if self.rtsp_connection:
-                        self.rtsp_connection.close()
-                        self.rtsp_connection = None
-                        
-                    self.is_connected = False
-                    print(f"Conexão WebRTC para {self.rtsp_url} fechada e recursos liberados")
-                except Exception as e:
-                    print(f"Erro ao liberar recursos WebRTC: {e}")
-                
-                # Forçar a remoção da instância compartilhada
-                if self.rtsp_url in WebRTCConversion._shared_instances:
-                    WebRTCConversion._shared_instances.pop(self.rtsp_url, None)
-                    print(f"Instância de WebRTCConversion para {self.rtsp_url} removida forçadamente")
\ No newline at end of file
+            self.pc = None
+        
+        if self.is_connected and self.pipeline:
+            if self.on_camera_state:
+                self.pipeline.remove_state_listener(self.on_camera_state)
+            try:
+                await self.pipeline.unsubscribe(self.quality_preset, self.video_track)
+            except Exception as e:
+                print(f"Erro ao liberar recursos WebRTC: {e}")
+            self.video_track = None
+            self.is_connected = False
+            print(f"Conexão WebRTC para {self.rtsp_url} fechada")
@@ -15,6 +15,9 @@ const Config = {
     // Porta padrão para WebSockets do PDV
     pdvWebSocketPort: 8765,
     
+    // Recebe os dados do PDV agrupados pelo servidor (pdv_batch) em vez de uma mensagem por linha
+    pdvBatching: true,
+    
     // Elementos da interface
     selectors: {
         grid: 'mainGrid',
@@ -74,6 +74,8 @@ class CameraManager {
                     if (message.sdp && message.type === 'offer') {
                         await this.handleOffer(id, message, videoElement);
                         UI.updateQuadrantStatus(id, `Conectado - Câmera ${id}`);
+                    } else if (message.type === 'camera_state') {
+                        this.handleCameraState(id, message.state);
                     } else {
                         Logger.log('info', `Câmera ${id} recebeu mensagem:`, message);
                     }
@@ -165,6 +167,21 @@ class CameraManager {
         }
     }
     
+    /**
+     * Atualiza o status do quadrante conforme o estado da câmera no servidor
+     * @param {number} id - ID da câmera/quadrante
+     * @param {string} state - Estado da conexão RTSP (connected, reconnecting, ...)
+     */
+    handleCameraState(id, state) {
+        Logger.log('info', `Câmera ${id}: estado RTSP ${state}`);
+        
+        if (state === 'reconnecting' || state === 'disconnected') {
+            UI.updateQuadrantStatus(id, `Câmera ${id}: reconectando...`);
+        } else if (state === 'connected') {
+            UI.updateQuadrantStatus(id, `Conectado - Câmera ${id}`);
+        }
+    }
+    
     /**
      * Envia a resposta SDP para o servidor
      * @param {number} id - ID da câmera/quadrante
@@ -96,7 +96,7 @@ class ConnectionManager {
             Logger.log('info', 'Mensagem recebida do servidor:', message);
             
             // Encaminha a mensagem para o módulo apropriado com base no tipo
-            if (message.type === 'register_response' || message.type === 'pdv_data') {
+            if (message.type === 'register_response' || message.type === 'pdv_data' || message.type === 'pdv_batch' || message.type === 'pdv_history') {
                 PDVManager.handleMessage(message);
             } else if (message.type === 'pdv_inativo_timeout') {
                 // Trata alertas de inatividade
@@ -76,7 +76,8 @@ class PDVManager {
         try {
             const registerCommand = {
                 command: "register",
-                pdv_ip: pdvIp
+                pdv_ip: pdvIp,
+                batch: Config.pdvBatching
             };
             
             Logger.log('info', `Enviando registro para PDV ${pdvIp}`, registerCommand);
@@ -109,6 +110,14 @@ class PDVManager {
         else if (message.type === 'pdv_data') {
             this.handlePdvData(message);
         }
+        // Lote de linhas do PDV (modo negociado no registro)
+        else if (message.type === 'pdv_batch') {
+            this.appendPdvLines(message.pdv_ip, message.lines);
+        }
+        // Histórico recente do PDV, enviado logo após o registro
+        else if (message.type === 'pdv_history') {
+            this.appendPdvLines(message.pdv_ip, message.lines, message.timestamps);
+        }
     }
     
     /**
@@ -142,7 +151,16 @@ class PDVManager {
      * @param {object} message - Mensagem com dados do PDV
      */
     handlePdvData(message) {
-        const pdvIp = message.pdv_ip;
+        this.appendPdvLines(message.pdv_ip, [message.data]);
+    }
+    
+    /**
+     * Adiciona linhas do PDV ao log do quadrante com uma única atualização do DOM
+     * @param {string} pdvIp - Endereço IP do PDV
+     * @param {string[]} lines - Linhas recebidas
+     * @param {number[]} [timestamps] - Horário de chegada de cada linha no servidor (epoch, ms), no histórico
+     */
+    appendPdvLines(pdvIp, lines, timestamps) {
         const quadrantId = this.pdvMapping[pdvIp];
         
         if (!quadrantId) {
@@ -153,16 +171,17 @@ class PDVManager {
         const logContainer = document.getElementById(`log${quadrantId}`);
         const logContent = logContainer.querySelector('.log-content') || logContainer;
         
-        // Formata a data/hora atual
+        // Linhas ao vivo: data/hora atual; histórico: horário em que cada linha chegou ao servidor
         const timestamp = formatTimestamp();
+        const stamps = timestamps ? timestamps.map(ts => formatTimestamp(new Date(ts))) : null;
         
-        // Adiciona a mensagem ao log
-        logContent.textContent += `[${timestamp}] ${message.data}\n`;
+        // Adiciona as mensagens ao log
+        logContent.textContent += lines.map((line, i) => `[${stamps ? stamps[i] : timestamp}] ${line}\n`).join('');
         
         // Mantém o scroll no final do log
         logContent.scrollTop = logContent.scrollHeight;
         
-        Logger.log('info', `Mensagem do PDV ${pdvIp} exibida no quadrante ${quadrantId}`);
+        Logger.log('info', `${lines.length} mensagem(ns) do PDV ${pdvIp} exibida(s) no quadrante ${quadrantId}`);
     }
     
     /**
@@ -4,11 +4,11 @@
  */
 
 /**
- * Formata timestamp atual para exibição
+ * Formata timestamp para exibição
+ * @param {Date} [now] - Data/hora a formatar (padrão: agora)
  * @returns {string} Timestamp no formato HH:MM:SS
  */
-export function formatTimestamp() {
-    const now = new Date();
+export function formatTimestamp(now = new Date()) {
     return `${now.getHours().toString().padStart(2, '0')}:${now.getMinutes().toString().padStart(2, '0')}:${now.getSeconds().toString().padStart(2, '0')}`;
 }
 